@@ -1,16 +1,168 @@
-import logging, json, sys, hashlib
+import logging, inspect, json, sys, hashlib, math, random, re, threading, time
+import abc, atexit, bisect, mmap, os, struct, weakref, zlib
+
+try:
+    import cPickle as pickle
+except ImportError: # Python 3
+    import pickle
 
 if (sys.version_info > (3, 0)):
     def long(value):
         return int(value)
 
-from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial, wraps
+
+try:
+    from queue import Queue, Full
+except ImportError: # Python 2
+    from Queue import Queue, Full
+
+try:
+    from concurrent import futures
+except ImportError: # Python 2; see ShardedCache and the get_timeout parameter
+    futures = None
+
+try:
+    import dataclasses
+except ImportError: # Python < 3.7
+    dataclasses = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError: # Optional; see LZ4Compressor
+    lz4_frame = None
+
+try:
+    import fcntl
+except ImportError: # Windows; see SharedMemoryCache
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError: # Pythons built without SQLite; see DiskCache
+    sqlite3 = None
 
 from redis import StrictRedis
-from pymemcache.client.base import Client as MemcachedClient
+from pymemcache.client.base import PooledClient as MemcachedClient
+from pymemcache.exceptions import MemcacheError
 
 __version__ = '0.2.2'
 
+# Monotonic clock used for in-process expiry; falls back to the wall clock on
+# Pythons that don't provide one.
+_now = getattr(time, 'monotonic', time.time)
+
+# Guards lazy creation of per-cache helpers (e.g. background thread pools).
+_init_lock = threading.Lock()
+
+class _IOLocal(threading.local):
+    # The _IOCall being made by an io thread (see _IOPool), if any.
+    call = None
+
+_io_local = _IOLocal()
+
+# Values stored with metadata (see _wrap_value) start with this byte, which can
+# never start a UTF-8 string.
+_ENVELOPE_MARKER = b'\xfe'
+
+# Values packed by a codec (see Codec.pack) start with this byte followed by
+# the id of the codec, so that values packed by another codec are recognized.
+_CODEC_MARKER = b'\xfd'
+
+# Base class for abstract classes, on both Python 2 and 3.
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+# Compressed values (see Compressor.pack) start with this byte followed by the
+# id of the compressor and whether the value was bytes or text.
+_COMPRESSED_MARKER = b'\xff'
+_COMPRESSED_BYTES, _COMPRESSED_TEXT = b'b', b's'
+
+# The manifests of values which MemcachedCache split into chunks start with
+# this byte, followed by the number of chunks, the checksum and length of the
+# value, and a 16 character nonce.
+_CHUNKED_MARKER = b'\xfc'
+_CHUNKED_MANIFEST = struct.Struct('>IIQ')
+_CHUNKED_MANIFEST_LENGTH = 1 + _CHUNKED_MANIFEST.size + 16
+
+# inspect.iscoroutinefunction only exists from Python 3.5; before that there
+# are no coroutine functions to detect.
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction',
+        lambda f: False)
+
+# Layout of the file of a SharedMemoryCache: a header (magic, buckets, ways and
+# slot size) followed by the slots, each of which starts with a header (used,
+# kind of value, key length, value length, expiry time and last access time).
+_SHM_MAGIC = b'CACHUAL\x01'
+_SHM_HEADER = struct.Struct('<8sIII')
+_SHM_SLOT = struct.Struct('<BBHIdd')
+_SHM_EMPTY = b'\x00'
+
+# Schema of the database of a DiskCache. The total size of the entries is kept
+# up to date by triggers so that it doesn't have to be summed for eviction.
+_DISK_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS cachual (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    kind INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cachual_expires ON cachual (expires);
+CREATE INDEX IF NOT EXISTS cachual_accessed ON cachual (accessed);
+CREATE TABLE IF NOT EXISTS cachual_size (size INTEGER NOT NULL);
+INSERT INTO cachual_size SELECT 0
+    WHERE NOT EXISTS (SELECT * FROM cachual_size);
+CREATE TRIGGER IF NOT EXISTS cachual_insert AFTER INSERT ON cachual BEGIN
+    UPDATE cachual_size SET size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cachual_delete AFTER DELETE ON cachual BEGIN
+    UPDATE cachual_size SET size = size - old.size;
+END;
+COMMIT;
+"""
+
+# Representations which include a memory address (e.g. the default
+# "<Foo object at 0x7f...>") differ between processes, so they can't be used
+# in cache keys.
+_ADDRESS_RE = re.compile(r' at 0x[0-9a-fA-F]+')
+
+# Marks an argument which wasn't given, where None is a valid value.
+_MISSING = object()
+
+# Deletes KEYS[1] only if its value is ARGV[1]; see RedisCache.delete_if_equal.
+_REDIS_DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Memcached treats expiry times of more than 30 days as Unix timestamps, so
+# this one is long past and an item stored with it expires immediately.
+_MEMCACHED_EXPIRED = 60 * 60 * 24 * 30 + 1
+
+# What to do with a cache hit; see _CachedFunction.hit_action.
+_FRESH, _REFRESH, _RECOMPUTE = range(3)
+
+class UnstableKeyError(ValueError):
+    """Raised when an argument of a call can't be encoded into a cache key
+    which is the same in every process, for example because its
+    representation includes its memory address.
+
+    .. versionadded:: 0.3.0
+    """
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the cache while its circuit breaker is open;
+    see :attr:`CachualCache.circuit_threshold`.
+
+    .. versionadded:: 0.3.0
+    """
+
 class CachualCache(object):
     """Base class for all cache implementations. Provides the
     :meth:`~CachualCache.cached` decorator which can be applied to methods
@@ -22,12 +174,163 @@ class CachualCache(object):
     the case of a cache miss; and a **put** method, which takes three arguments
     for the cache key, the value to store, and a TLL (which may be none) and
     puts the value in the cache.
+
+    Subclasses which support leases and namespaces (see the ``lease_ttl``
+    and ``namespace`` parameters of :meth:`~CachualCache.cached`) should also
+    define an **add** method, which
+    takes the same arguments as **put** but only stores the value if the key
+    does not already exist, returning True if it did so; and a **delete**
+    method, which takes a single key and removes it from the cache.
+
+    Subclasses may also override **get_many** and **put_many** (used by
+    :meth:`~CachualCache.cached_many`) to get or put several keys in a single
+    round trip; the default implementations call **get** and **put** for each
+    key.
+
+    :type codec: Codec or string
+    :param codec: The codec (or the name of a registered codec) used to pack
+                  and unpack the values of functions decorated with
+                  :meth:`~CachualCache.cached` or
+                  :meth:`~CachualCache.cached_many` which don't specify their
+                  own ``codec`` or ``pack``/``unpack`` functions. See
+                  :class:`Codec`.
+
+    :type compress: Compressor or string
+    :param compress: The compressor (or the name of a registered compressor)
+                     used for the values of decorated functions which don't
+                     specify their own ``compress``. See :class:`Compressor`.
+
+    :type get_timeout: float
+    :param get_timeout: The default ``get_timeout`` for decorated functions;
+                        see :meth:`~CachualCache.cached`.
+
+    :type put_timeout: float
+    :param put_timeout: The default ``put_timeout`` for decorated functions;
+                        see :meth:`~CachualCache.cached`.
+
+    .. versionchanged:: 0.3.0
+       Added ``codec``, ``compress``, ``get_timeout`` and ``put_timeout``
+       parameters.
     """
-    def __init__(self):
+    #: The default codec; see the ``codec`` parameter.
+    codec = None
+
+    #: The default compressor; see the ``compress`` parameter.
+    compress = None
+
+    #: The default get timeout; see the ``get_timeout`` parameter.
+    get_timeout = None
+
+    #: The default put timeout; see the ``put_timeout`` parameter.
+    put_timeout = None
+
+    #: The number of threads used to make cache calls with a timeout (see the
+    #: ``get_timeout``, ``put_timeout`` and ``race_origin`` parameters of
+    #: :meth:`~CachualCache.cached`).
+    io_workers = 16
+
+    #: The maximum number of cache calls with a timeout waiting for one of
+    #: the ``io_workers``. Once it is reached (i.e. the cache is slow enough
+    #: that timed out calls are building up), gets are treated as misses and
+    #: puts are skipped, without waiting, until the queue drains.
+    io_queue_size = 64
+
+    _io_pool = None
+
+    #: The number of threads used to execute functions racing the cache (see
+    #: the ``race_origin`` parameter of :meth:`~CachualCache.cached`). These
+    #: are separate from the ``io_workers``, so that slow functions can't hold
+    #: up cache calls.
+    origin_workers = 16
+
+    _origin_pool = None
+    _metrics = None
+
+    #: How long (in seconds) the generation of a namespace and the version of
+    #: a tag (see the ``namespace`` and ``tags`` parameters of
+    #: :meth:`~CachualCache.cached`) are kept in process before they are read
+    #: from the cache again. This is how long it takes other processes to
+    #: notice that a namespace or tag was invalidated.
+    generation_ttl = 1
+
+    #: The maximum number of generations and tag versions kept in process
+    #: (see :attr:`generation_ttl`); the least recently used are evicted
+    #: first, so that high-cardinality tags don't build up.
+    max_generations = 10000
+
+    _generations = None
+
+    #: How long (in seconds) the version of a tag (see the ``tags`` parameter
+    #: of :meth:`~CachualCache.cached`) is kept in the cache, so that the
+    #: versions of tags which are no longer used don't build up. A value whose
+    #: tag's version has expired is treated as a miss, so this should be at
+    #: least as long as the ``ttl`` of any function with tags; the default is
+    #: 30 days, the longest relative expiry time Memcached accepts. None keeps
+    #: versions until they are evicted.
+    tag_ttl = 60 * 60 * 24 * 30
+
+    #: The number of consecutive cache failures (from decorated functions)
+    #: after which the circuit breaker opens: the cache is skipped entirely,
+    #: as if every get missed and every put failed, so that an unreachable
+    #: cache doesn't add its timeouts to every call. None turns the circuit
+    #: breaker off.
+    circuit_threshold = 5
+
+    #: How long (in seconds) the circuit breaker stays open before a single
+    #: call is let through to probe whether the cache has recovered. If it
+    #: succeeds the circuit closes again; otherwise it stays open for another
+    #: ``circuit_reset_timeout``.
+    circuit_reset_timeout = 10
+
+    _circuit = None
+
+    #: How long (in seconds) to wait between polls of the cache while another
+    #: process holds the lease for a key.
+    lease_poll_interval = 0.05
+
+    #: The number of background threads used to refresh stale values (see the
+    #: ``stale_ttl`` parameter of :meth:`~CachualCache.cached`).
+    refresh_workers = 2
+
+    #: The maximum number of refreshes waiting for a background thread; any
+    #: more are dropped until the queue drains.
+    refresh_queue_size = 1000
+
+    _refresh_pool = None
+
+    #: Whether text which is put in the cache comes back out of it as text
+    #: (rather than as UTF-8 bytes, as with Redis and Memcached). Values
+    #: stored with metadata (see the ``stale_ttl`` parameter of
+    #: :meth:`~CachualCache.cached`) are unpacked as the same type.
+    returns_text = False
+
+    #: Whether values come back out of the cache as the same objects that were
+    #: put in it, without being serialized (as with :class:`LocalCache`). If
+    #: so, values with metadata are stored alongside it as they are, rather
+    #: than converted to text.
+    stores_objects = False
+
+    # True for caches whose methods are coroutines; see cachual_asyncio.
+    _async = False
+
+    def __init__(self, codec=None, compress=None, get_timeout=None,
+            put_timeout=None):
         self.logger = logging.getLogger("cachual")
+        if codec is not None:
+            self.codec = get_codec(codec)
+        if compress is not None:
+            self.compress = get_compressor(compress)
+        if get_timeout is not None:
+            self.get_timeout = get_timeout
+        if put_timeout is not None:
+            self.put_timeout = put_timeout
 
     def cached(self, ttl=None, pack=None, unpack=None,
-            use_class_for_self=False):
+            use_class_for_self=False, single_flight=True, lease_ttl=None,
+            stale_ttl=None, early_recompute=None, codec=None,
+            compress=None, cache_none=False, negative_ttl=None,
+            cache_errors=(), error_ttl=None, get_timeout=None,
+            put_timeout=None, race_origin=False, namespace=None, tags=None):
         """Functions decorated with this will have their return values cached.
         It should be used as follows::
 
@@ -47,6 +350,19 @@ class CachualCache(object):
         Cache get/put failures are logged but ignored; if the cache goes down,
         the function will continue to execute as normal.
 
+        By default, a return value of None is not cached, so the function is
+        executed again on the next call; see ``cache_none``.
+
+        The decorated function has an **invalidate** method, which takes the
+        same arguments as the function and deletes the cached value for that
+        call (raising any error from the cache), and an **invalidate_all**
+        method, which invalidates every cached value of the function's
+        ``namespace``.
+
+        Coroutine functions (``async def``) can be decorated too, in which case
+        the decorated function is also a coroutine function which awaits the
+        cache and the function itself. See :mod:`cachual_asyncio`.
+
         :type ttl: integer
         :param ttl: The time-to-live in seconds. For caches that support TTLs,
                     the keys will expire after this time. If None (the
@@ -69,6 +385,116 @@ class CachualCache(object):
                        hit, in case you need to process it first (e.g. turn a
                        JSON string into a Python dictionary).
 
+        :type codec: Codec or string
+        :param codec: The codec (or the name of a registered codec, e.g.
+                      ``'pickle'``) used to pack return values and unpack
+                      values from the cache, instead of separate ``pack`` and
+                      ``unpack`` functions. Values are stored with a header
+                      naming their codec, so they can still be read after
+                      switching codecs. If neither this nor ``pack``/``unpack``
+                      is specified, the cache's default ``codec`` is used.
+
+        :type compress: Compressor or string
+        :param compress: The compressor (or the name of a registered
+                         compressor, e.g. ``'zlib'``) used to compress packed
+                         values at least as large as its threshold before
+                         they are put into the cache. Compressed values are
+                         marked with a header, and are decompressed on a hit
+                         whether or not compression is still in use, so
+                         compressed and uncompressed entries can coexist. If
+                         not specified, the cache's default ``compress`` is
+                         used; pass ``False`` to turn it off.
+
+        :type cache_none: bool
+        :param cache_none: If True, a return value of None is cached too (as a
+                           marker which is never passed to ``pack`` or
+                           ``unpack``), so that calls which find nothing
+                           (e.g. looking up a user which doesn't exist) don't
+                           execute the function on every call.
+
+        :type negative_ttl: integer
+        :param negative_ttl: If specified, the time-to-live in seconds for
+                             cached None values, instead of ``ttl``. Requires
+                             ``cache_none``.
+
+        :type cache_errors: tuple
+        :param cache_errors: Exception types which, when raised by the
+                             function, are cached for ``error_ttl`` seconds
+                             and raised again on hits instead of executing
+                             the function. This sheds load from a failing
+                             dependency instead of retrying it on every call.
+                             The exception's type and arguments are stored, so
+                             it must be possible to create it again from its
+                             arguments.
+
+        :type error_ttl: integer
+        :param error_ttl: The time-to-live in seconds for cached exceptions;
+                          this should be short. Required with
+                          ``cache_errors``.
+
+        :type get_timeout: float
+        :param get_timeout: If specified, the maximum time in seconds to wait
+                            for the cache to return a value; a slower get is
+                            treated as a miss (and counted in the
+                            ``get_timeout`` metric, see
+                            :meth:`~CachualCache.record_metric`). The get is
+                            made on a thread from a pool of ``io_workers``
+                            threads, and is left to finish in the background.
+                            If not specified, the cache's default
+                            ``get_timeout`` is used.
+
+        :type put_timeout: float
+        :param put_timeout: If specified, the maximum time in seconds to wait
+                            for the cache to put the function's return value
+                            before returning it; a slower put carries on in
+                            the background (and is counted in the
+                            ``put_timeout`` metric). If not specified, the
+                            cache's default ``put_timeout`` is used.
+
+        :type race_origin: bool
+        :param race_origin: If True, the function starts executing (on a
+                            thread from a pool of ``origin_workers``) if the
+                            cache hasn't returned a value after
+                            ``get_timeout`` seconds, and whichever of the
+                            cache and the function returns a value first
+                            wins. A slow cache then costs at most as much as
+                            the function itself. Requires a ``get_timeout``
+                            (which can be 0, to start the function straight
+                            away). The wins are counted in the ``cache_won``
+                            and ``origin_won`` metrics.
+
+        :type namespace: string
+        :param namespace: If specified, the cache keys include the current
+                          generation of this namespace (or, if True, of a
+                          namespace for just this function), which is stored
+                          in the cache and kept in process for
+                          ``generation_ttl`` seconds. Calling
+                          :meth:`~CachualCache.invalidate_namespace` (or the
+                          decorated function's **invalidate_all**) starts a
+                          new generation, which invalidates every value in the
+                          namespace at once without having to find their keys.
+
+        :type tags: list or function
+        :param tags: If specified, each value is stamped with the current
+                     version of these tags (strings, e.g. ``'user:42'``),
+                     which are stored in the cache and kept in process for
+                     ``generation_ttl`` seconds. Hits whose stamp is out of
+                     date are treated as misses, so calling
+                     :meth:`~CachualCache.invalidate_tags` invalidates every
+                     value with any of the given tags, across all decorated
+                     functions. If a function is given, it is called with the
+                     return value followed by the arguments of each call, and
+                     should return the tags for that value. The versions of a
+                     list of tags are read before the decorated function is
+                     executed, so that an invalidation while it executes
+                     isn't lost. Tags returned by a function can only be
+                     read afterwards, so a value computed while one of them
+                     is invalidated may be cached with the new version;
+                     give a list of tags for data which changes often. The
+                     versions are kept in the cache for the cache's
+                     ``tag_ttl``, which should be at least as long as
+                     ``ttl``.
+
         :type use_class_for_self: bool
         :param use_class_for_self: If True, cache keys will use the class
                                    representation of the first parameter
@@ -85,79 +511,1421 @@ class CachualCache(object):
                                    instance, which is undesirable for a
                                    stateless class).
 
+        :type single_flight: bool
+        :param single_flight: If True (the default), concurrent cache misses
+                              for the same key within a process are
+                              coalesced: one caller executes the function and
+                              puts the result in the cache, while the others
+                              wait for and share its result (or exception).
+                              This keeps the load on the origin at one call
+                              per process when a hot key expires.
+
+        :type lease_ttl: float
+        :param lease_ttl: If specified, on a cache miss a short-lived lease is
+                          taken in the cache itself (e.g. ``SET NX`` in Redis
+                          or ``add`` in Memcached) with this time-to-live in
+                          seconds. Only the holder of the lease executes the
+                          function; every other caller, in any process, polls
+                          the cache for the value instead, and falls back to
+                          executing the function itself if the lease expires
+                          without a value appearing. This caps the load on
+                          the origin per key across all of your hosts. The
+                          cache must support **add** and **delete**.
+
+        :type stale_ttl: integer
+        :param stale_ttl: If specified, values are kept in the cache for this
+                          many seconds after their ``ttl`` has passed. A hit
+                          on such a stale value returns it immediately and
+                          queues a refresh of the value on a bounded pool of
+                          background threads, so callers never wait for the
+                          function on popular keys. Requires ``ttl``; the
+                          freshness time is stored alongside the packed value.
+
+        :type early_recompute: float
+        :param early_recompute: If specified, enables probabilistic early
+                                recomputation (XFetch). The time the function
+                                took to execute and the time the value expires
+                                are stored alongside the packed value, and each
+                                hit treats the value as expired early with a
+                                probability that rises as the expiry time
+                                approaches and with how long the function
+                                takes. This spreads out the recomputation of
+                                keys that were put at the same time. The value
+                                is the beta parameter of the algorithm; 1.0 is
+                                a good default, larger values recompute
+                                earlier. Requires ``ttl``.
+
         .. versionchanged:: 0.2.2
            Added ``use_class_for_self`` parameter.
+
+        .. versionchanged:: 0.3.0
+           Added ``single_flight``, ``lease_ttl``, ``stale_ttl``,
+           ``early_recompute``, ``codec``, ``compress``, ``cache_none``,
+           ``negative_ttl``, ``cache_errors``, ``error_ttl``,
+           ``get_timeout``, ``put_timeout``, ``race_origin``, ``namespace``
+           and ``tags`` parameters, and the **invalidate** and
+           **invalidate_all** methods of decorated functions. None is no
+           longer put into the cache unless ``cache_none`` is True.
         """
         def decorator(f):
-            @wraps(f)
-            def decorated(*args, **kwargs):
-                key = self._get_key_from_func(f, args, kwargs,
-                        use_class_for_self)
-                self.logger.debug("key: [%s]" % key)
-                try:
-                    value = self.get(key)
-                    if value is not None:
-                        self.logger.debug("got value from cache: %s" % value)
-                        if unpack is not None:
-                            return unpack(value)
-                        return value
-                except:
-                    self.logger.warn("Error getting value", exc_info=1)
-
-                self.logger.debug("no value from cache, calling function")
-                value = f(*args, **kwargs)
-                self.logger.debug("got value from function call: %s" % value)
-                try:
-                    packed = value if pack is None else pack(value)
-                    self.put(key, packed, ttl)
-                except:
-                    self.logger.warn("Error putting value", exc_info=1)
-                return value
-            return decorated
+            if _iscoroutinefunction(f):
+                from cachual_asyncio import (_AsyncCachedFunction,
+                        _wrap_coroutine_function)
+                function_class = _AsyncCachedFunction
+                wrap = _wrap_coroutine_function
+            elif self._async:
+                raise TypeError("%s can only decorate coroutine functions" %
+                        type(self).__name__)
+            else:
+                function_class = _CachedFunction
+                wrap = _wrap_function
+
+            cached_function = function_class(self, f, ttl, pack, unpack,
+                    use_class_for_self, single_flight, lease_ttl, stale_ttl,
+                    early_recompute, codec, compress, cache_none,
+                    negative_ttl, cache_errors, error_ttl, get_timeout,
+                    put_timeout, race_origin, namespace, tags)
+            return wrap(f, cached_function)
+        return decorator
+
+    def cached_many(self, ttl=None, pack=None, unpack=None,
+            use_class_for_self=False, ids_arg=0, codec=None, compress=None,
+            namespace=None):
+        """Like :meth:`~CachualCache.cached`, but for functions which take a
+        collection of ids and return a dictionary mapping each id to its
+        value. It should be used as follows::
+
+            cache = RedisCache()
+
+            @cache.cached_many(ttl=300)
+            def get_users(user_ids):
+                ...
+                return {user_id: user for ...}
+
+        A cache key is generated for each id as if the function had been
+        called with just that id in place of the collection, and all of the
+        keys are fetched from the cache with a single **get_many**. The
+        function is then called with only the ids that missed, and its return
+        values are put into the cache with a single **put_many**. Ids which
+        the function doesn't return a value (or returns None) for are not
+        cached, and are left out of the result; the function can also return
+        None if it found none of them.
+
+        Cache get/put failures are logged but ignored, as for
+        :meth:`~CachualCache.cached`.
+
+        :type ttl: integer
+        :param ttl: The time-to-live in seconds for each value.
+
+        :type pack: function
+        :param pack: If specified, this function will be called with each
+                     value returned by the decorated function, and the result
+                     will be stored in the cache.
+
+        :type unpack: function
+        :param unpack: If specified, this function will be called with each
+                       value from the cache in the event of a cache hit.
+
+        :type use_class_for_self: bool
+        :param use_class_for_self: As for :meth:`~CachualCache.cached`.
+
+        :type ids_arg: integer
+        :param ids_arg: The index of the positional argument which holds the
+                        collection of ids. The default is the first argument;
+                        for methods you will want to use 1, to skip over
+                        ``self`` or ``cls``. The ids can also be passed by
+                        keyword, using the name of that parameter.
+
+        :type codec: Codec or string
+        :param codec: As for :meth:`~CachualCache.cached`.
+
+        :type compress: Compressor or string
+        :param compress: As for :meth:`~CachualCache.cached`.
+
+        :type namespace: string
+        :param namespace: As for :meth:`~CachualCache.cached`. The
+                          **invalidate** method of the decorated function
+                          deletes the value of every id in the collection it
+                          is given.
+
+        .. versionadded:: 0.3.0
+        """
+        def decorator(f):
+            if _iscoroutinefunction(f) or self._async:
+                raise TypeError("cached_many does not support coroutine "
+                        "functions")
+            return _wrap_function(f, _CachedManyFunction(self, f, ttl, pack,
+                    unpack, use_class_for_self, ids_arg, codec, compress,
+                    namespace))
         return decorator
 
+    def get_many(self, keys):
+        """Get the values for several keys from the cache. This default
+        implementation calls **get** for each key.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the cache. This default implementation
+        calls **put** for each value.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        for key, value in values.items():
+            self.put(key, value, ttl)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value, e.g. so that a lease is only released by its holder. This
+        default implementation calls **get** and then **delete**, which isn't
+        atomic; caches which can should override it.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+
+        .. versionadded:: 0.3.0
+        """
+        current = self.get(key)
+        if current is None or _to_bytes(current) != _to_bytes(value):
+            return False
+        self.delete(key)
+        return True
+
+    def invalidate_namespace(self, namespace):
+        """Invalidate every value cached in the given namespace (see the
+        ``namespace`` parameter of :meth:`~CachualCache.cached`) by starting
+        a new generation of it. The old values are left to expire. Other
+        processes notice the new generation within ``generation_ttl``
+        seconds.
+
+        :type namespace: string
+        :param namespace: The namespace to invalidate.
+
+        .. versionadded:: 0.3.0
+        """
+        key = _generation_key(namespace)
+        generation = _new_generation()
+        self.put(key, generation)
+        self._remember_generation(key, generation)
+
+    def invalidate_tags(self, *tags):
+        """Invalidate every value cached with any of the given tags (see the
+        ``tags`` parameter of :meth:`~CachualCache.cached`) by starting a new
+        version of each tag, with a single **put_many**. The versions expire
+        after ``tag_ttl`` seconds, and the old values are left to expire.
+        Other processes notice the new versions within ``generation_ttl``
+        seconds.
+
+        :type tags: string
+        :param tags: The tags to invalidate.
+
+        .. versionadded:: 0.3.0
+        """
+        versions = dict((_tag_key(_unicode(tag)), _new_generation())
+                        for tag in tags)
+        self.put_many(versions, self.tag_ttl)
+        for key, version in versions.items():
+            self._remember_generation(key, version)
+
+    def _get_generation(self, namespace):
+        """Internal function to get the current generation of a namespace,
+        from the process if it was read recently and from the cache
+        otherwise. A namespace without a generation in the cache gets a new
+        one with :meth:`_add_generation`."""
+        key = _generation_key(namespace)
+        generation = self._recall_generation(key)
+        if generation is not None:
+            return generation
+        generation = self._call_cache('get', key)
+        if generation is None:
+            generation = self._add_generation(key, None)
+        generation = _decode_generation(generation)
+        self._remember_generation(key, generation)
+        return generation
+
+    def _get_tag_versions(self, tags):
+        """Internal function to get a dictionary of the current version of
+        each tag. Tags which weren't read recently are read with a single
+        **get_many**, and tags without a version in the cache get a new one
+        (which expires after ``tag_ttl`` seconds) with
+        :meth:`_add_generation`."""
+        versions, missing = self._recall_tag_versions(tags)
+        if missing:
+            found = self._call_cache('get_many',
+                    [_tag_key(tag) for tag in missing])
+            for tag in missing:
+                key = _tag_key(tag)
+                if found.get(key) is None:
+                    found[key] = self._add_generation(key, self.tag_ttl)
+            self._remember_tag_versions(versions, missing, found)
+        return versions
+
+    def _add_generation(self, key, ttl):
+        """Internal function to start the first generation (or tag version)
+        stored at the key. It is added rather than put so that processes
+        racing to do this agree on it: those which lose read the winner's."""
+        generation = _new_generation()
+        if not self._call_cache('add', key, generation, ttl):
+            generation = self._call_cache('get', key) or generation
+        return generation
+
+    def _recall_tag_versions(self, tags):
+        """Internal function to get the versions of the tags which were read
+        recently. Returns a (versions, missing) tuple, where missing is a list
+        of the other tags."""
+        versions = {}
+        missing = []
+        for tag in tags:
+            version = self._recall_generation(_tag_key(tag))
+            if version is None:
+                missing.append(tag)
+            else:
+                versions[tag] = version
+        return versions, missing
+
+    def _remember_tag_versions(self, versions, missing, found):
+        """Internal function to add the versions of the missing tags, as
+        found in the cache (by key), to the versions and keep them in
+        process."""
+        for tag in missing:
+            key = _tag_key(tag)
+            versions[tag] = _decode_generation(found[key])
+            self._remember_generation(key, versions[tag])
+
+    def _recall_generation(self, key):
+        """Internal function to get the generation (or tag version) stored at
+        the key if it was read recently, or None."""
+        if self._generations is None:
+            return None
+        return self._generations.get(key)
+
+    def _remember_generation(self, key, generation):
+        """Internal function to keep the generation (or tag version) stored at
+        the key in process for ``generation_ttl`` seconds, in a
+        :class:`LocalCache` of at most ``max_generations`` entries."""
+        if self._generations is None:
+            with _init_lock:
+                if self._generations is None:
+                    self._generations = LocalCache(
+                            max_entries=self.max_generations)
+        self._generations.put(key, generation, self.generation_ttl)
+
+    def _acquire_lease(self, key, lease_ttl):
+        """Internal function to try to take the lease for recomputing the
+        value of the key. Returns the random token stored in the lease if it
+        was taken, or None. If the cache fails, the caller is treated as the
+        lease holder so that the function still executes."""
+        token = _new_lease_token()
+        try:
+            acquired = self._call_cache('add', _lease_key(key), token,
+                    lease_ttl)
+            self.logger.debug("lease for [%s] acquired: %s", key, acquired)
+            return token if acquired else None
+        except CircuitOpenError:
+            return token
+        except:
+            self.logger.warn("Error acquiring lease", exc_info=1)
+            return token
+
+    def _release_lease(self, key, token):
+        """Internal function to release a lease taken with
+        :meth:`_acquire_lease`, unless it has expired and been taken by
+        another caller since (i.e. no longer holds the token)."""
+        try:
+            self._call_cache('delete_if_equal', _lease_key(key), token)
+        except CircuitOpenError:
+            pass
+        except:
+            self.logger.warn("Error releasing lease", exc_info=1)
+
+    def record_metric(self, name, value=1):
+        """Record a metric about the cache. The default implementation adds
+        the value to a counter in :attr:`metrics`; override it to send metrics
+        elsewhere (e.g. to statsd). The metrics recorded are:
+
+        * ``get_timeout``: a get took longer than its ``get_timeout``.
+        * ``put_timeout``: a put took longer than its ``put_timeout``.
+        * ``io_queue_full``: a get or put with a timeout was skipped because
+          :attr:`io_queue_size` calls were already waiting.
+        * ``cache_won``, ``origin_won``: which of the cache and the function
+          returned a value first, with ``race_origin``.
+
+        :type name: string
+        :param name: The name of the metric.
+
+        :type value: integer
+        :param value: The amount to add to the metric.
+
+        .. versionadded:: 0.3.0
+        """
+        with _init_lock:
+            if self._metrics is None:
+                self._metrics = {}
+            self._metrics[name] = self._metrics.get(name, 0) + value
+
+    @property
+    def metrics(self):
+        """A dictionary of the counters recorded by
+        :meth:`~CachualCache.record_metric`.
+
+        .. versionadded:: 0.3.0
+        """
+        with _init_lock:
+            return dict(self._metrics or {})
+
+    def _call_cache(self, name, *args):
+        """Internal function to call a method of the cache through its circuit
+        breaker, raising :class:`CircuitOpenError` instead if it is open."""
+        circuit = self._get_circuit()
+        if not circuit.allow():
+            raise CircuitOpenError("Circuit breaker is open")
+        try:
+            result = getattr(self, name)(*args)
+        except:
+            if not _abandoned():
+                circuit.failure()
+            raise
+        if not _abandoned():
+            circuit.success()
+        return result
+
+    def _get_circuit(self):
+        """Internal function to get the circuit breaker of the cache, creating
+        it on first use."""
+        if self._circuit is None:
+            with _init_lock:
+                if self._circuit is None:
+                    self._circuit = _CircuitBreaker(self.circuit_threshold,
+                            self.circuit_reset_timeout, self.logger)
+        return self._circuit
+
+    def _get_io_pool(self):
+        """Internal function to get the pool used for cache calls with a
+        timeout, creating it on first use."""
+        if self._io_pool is None:
+            with _init_lock:
+                if self._io_pool is None:
+                    self._io_pool = _IOPool(self.io_workers,
+                            self.io_queue_size)
+        return self._io_pool
+
+    def _submit_io(self, fn, *args):
+        """Internal function to make a cache call on the io pool. Returns the
+        :class:`_IOCall`, or None if the pool's queue is full."""
+        call = self._get_io_pool().submit(fn, *args)
+        if call is None:
+            self.logger.debug("io queue full, skipping cache call")
+            self.record_metric('io_queue_full')
+        return call
+
+    def _abandon_io(self, call, cancel=True):
+        """Internal function to give up waiting for a call made with
+        :meth:`_submit_io`. The timeout counts as a failure of the circuit
+        breaker, and whatever the call ends with is ignored by it; the call is
+        cancelled if it hasn't started (and ``cancel`` is set)."""
+        call.abandoned = True
+        if cancel:
+            call.future.cancel()
+        self._get_circuit().failure()
+
+    def _get_origin_pool(self):
+        """Internal function to get the pool used to execute functions racing
+        the cache, creating it on first use."""
+        if self._origin_pool is None:
+            with _init_lock:
+                if self._origin_pool is None:
+                    self._origin_pool = futures.ThreadPoolExecutor(
+                            self.origin_workers)
+        return self._origin_pool
+
+    def _get_refresh_pool(self):
+        """Internal function to get the pool used for background refreshes,
+        creating it on first use."""
+        if self._refresh_pool is None:
+            with _init_lock:
+                if self._refresh_pool is None:
+                    self._refresh_pool = _BackgroundPool(
+                            self.refresh_workers, self.refresh_queue_size,
+                            self.logger)
+        return self._refresh_pool
+
     def _get_key_from_func(self, f, args, kwargs, use_class_for_self=False):
         """Internal function to build the cache key from the function and the
-        args and kwargs it was called with."""
-        if use_class_for_self:
+        args and kwargs it was called with. Decorated functions prepare a
+        builder once with :meth:`_get_key_builder` instead."""
+        return self._get_key_builder(f, use_class_for_self)(args, kwargs)
+
+    def _get_key_builder(self, f, use_class_for_self=False):
+        """Internal function to prepare the cache key builder for a function.
+        The builder is called with the args and kwargs of each call and
+        returns the cache key."""
+        return _KeyBuilder(f, use_class_for_self, self.logger)
+
+class _KeyBuilder(object):
+    """Internal cache key builder for a single function, prepared once when
+    the function is decorated. Arguments are normalised against the function's
+    signature, so that calls which bind the same values to the same parameters
+    (e.g. ``f(1, 2)``, ``f(1, b=2)`` and, if 2 is the default for ``b``,
+    ``f(1)``) get the same key: every positional parameter is included
+    positionally, followed by any extra positional arguments, followed by any
+    keyword-only and extra keyword arguments in ``key=value`` form in
+    alphabetical order of the keys."""
+    __slots__ = ('prefix', 'prefix_hash', 'use_class_for_self', 'logger',
+                 'names', 'keyword_names', 'defaults', 'var_positional',
+                 'keyword_only', 'keyword_defaults', 'var_keyword',
+                 'positional_tails', 'extra_tail')
+
+    def __init__(self, f, use_class_for_self, logger):
+        self.prefix = f.__module__ + '.' + f.__name__
+        # The key is the MD5 of the prefix followed by the arguments, so the
+        # prefix only needs to be hashed once; each call copies the hash.
+        self.prefix_hash = hashlib.md5(self.prefix.encode('utf-8'))
+        self.use_class_for_self = use_class_for_self
+        self.logger = logger
+        self.names = None
+        self.positional_tails = self.extra_tail = None
+
+        parameters = _get_parameters(f)
+        if parameters is None:
+            # Without a signature, arguments are used exactly as they were
+            # passed.
+            return
+        names = []
+        keyword_names = set()
+        defaults = {}
+        keyword_only = set()
+        keyword_defaults = {}
+        self.var_positional = self.var_keyword = False
+        for parameter in parameters:
+            kind = parameter.kind
+            has_default = parameter.default is not parameter.empty
+            if kind in (parameter.POSITIONAL_ONLY,
+                    parameter.POSITIONAL_OR_KEYWORD):
+                names.append(parameter.name)
+                if kind == parameter.POSITIONAL_OR_KEYWORD:
+                    keyword_names.add(parameter.name)
+                if has_default:
+                    defaults[parameter.name] = _key_default(parameter)
+            elif kind == parameter.VAR_POSITIONAL:
+                self.var_positional = True
+            elif kind == parameter.KEYWORD_ONLY:
+                keyword_only.add(parameter.name)
+                if has_default:
+                    keyword_defaults[parameter.name] = _key_default(
+                            parameter)
+            else:
+                self.var_keyword = True
+        self.names = tuple(names)
+        self.keyword_names = keyword_names
+        self.defaults = defaults
+        self.keyword_only = keyword_only
+        self.keyword_defaults = keyword_defaults
+        self.prepare_tails()
+
+    def prepare_tails(self):
+        """Encode the key parts which calls passing only positional arguments
+        add for the parameters they leave out, so that such calls can skip
+        binding. ``positional_tails`` maps the number of arguments passed to
+        the encoded defaults of the remaining positional parameters and of the
+        keyword-only parameters (or None if a call passing that many arguments
+        has to be bound), and ``extra_tail`` is used for calls passing more
+        arguments than there are positional parameters. Only defaults of
+        scalar types are encoded up front, since others could change."""
+        encoders = _KEY_SCALAR_ENCODERS
+        n = len(self.names)
+        tails = dict.fromkeys(range(n + 1))
+        self.positional_tails = tails
+        if set(self.keyword_defaults) != self.keyword_only:
+            return
+        tail = []
+        for k, v in sorted(self.keyword_defaults.items()):
+            if type(v) not in encoders:
+                return
+            tail.append(_text(k) + '=' + encoders[type(v)](v))
+        tails[n] = tuple(tail)
+        if self.var_positional:
+            self.extra_tail = tails[n]
+        for given in range(n - 1, -1, -1):
+            v = self.defaults.get(self.names[given], tails)
+            if type(v) not in encoders:
+                return
+            tail.insert(0, encoders[type(v)](v))
+            tails[given] = tuple(tail)
+
+    def __call__(self, args, kwargs):
+        if not args:
+            args = ()
+        elif type(args) is not tuple:
+            args = tuple(args)
+        if self.use_class_for_self:
             # For instance methods, the first argument will be an object,
             # whose representation will include a memory location and result in
             # a new cache key for every instance. This behavior may be
             # undesirable, especially if the class instances are stateless.
             # use_class_from_self can be used to use the class instead of the
             # object for the first argument.
-            args = [args[0].__class__] + list(args[1:])
+            args = (args[0].__class__,) + args[1:]
 
-        if args:
-            args_str = ', '.join([_unicode(a) for a in args])
+        tail = None
+        if not kwargs and self.positional_tails is not None:
+            # Fast path for the common case of purely positional calls,
+            # which don't need to be bound.
+            tail = self.positional_tails.get(len(args), self.extra_tail)
+        if tail is not None:
+            positional = args
+            keywords = ()
         else:
-            args_str = None
+            normalized = None
+            if self.names is not None:
+                normalized = self.normalize(args, kwargs)
+            if normalized is None:
+                positional = args
+                keywords = sorted(kwargs.items()) if kwargs else ()
+            else:
+                positional, keywords = normalized
+
+        encoders = _KEY_SCALAR_ENCODERS
+        parts = [encoders[type(a)](a) if type(a) in encoders
+                 else _encode_key_arg(a) for a in positional]
+        for k, v in keywords:
+            parts.append(_text(k) + '=' + (encoders[type(v)](v)
+                    if type(v) in encoders else _encode_key_arg(v)))
+        if tail:
+            parts.extend(tail)
+        suffix = '(' + ', '.join(parts) + ')'
+        self.logger.debug('prehash key: [%s%s]', self.prefix, suffix)
+
+        m = self.prefix_hash.copy()
+        m.update(suffix.encode('utf-8'))
+        return m.hexdigest()
+
+    def normalize(self, args, kwargs):
+        """Bind the arguments to the function's parameters, returning a tuple
+        of the positional values and a sorted list of (name, value) pairs for
+        the keyword values. Returns None if the arguments don't bind, in which
+        case calling the function will fail anyway."""
+        names = self.names
+        n = len(names)
+        given = len(args)
+        if given > n and not self.var_positional:
+            return None
+        if not kwargs and given >= n and not self.keyword_defaults:
+            # Fast path for the common case of purely positional calls.
+            return args, ()
+
+        values = list(args[:n])
         if kwargs:
-            kwargs_str = ', '.join(\
-                    ['%s=%s' % (_unicode(k), _unicode(kwargs[k]))\
-                    for k in sorted(kwargs.keys())])
+            kwargs = dict(kwargs)
+            keyword_names = self.keyword_names
+            for name in names[:given]:
+                if name in kwargs and name in keyword_names:
+                    return None
         else:
-            kwargs_str = None
-
-        prefix = f.__module__ + '.' + f.__name__
-        suffix = ''
-        if args_str is not None:
-            suffix = '(' + args_str
-            if kwargs_str is not None:
-                suffix = suffix + ', ' + kwargs_str + ')'
+            kwargs = {}
+        defaults = self.defaults
+        for name in names[given:]:
+            if name in kwargs and name in self.keyword_names:
+                values.append(kwargs.pop(name))
+            elif name in defaults:
+                values.append(defaults[name])
             else:
-                suffix = suffix + ')'
+                return None
+        if self.keyword_defaults:
+            for name, default in self.keyword_defaults.items():
+                kwargs.setdefault(name, default)
+        if kwargs or self.keyword_only:
+            keyword_only = self.keyword_only
+            for name in keyword_only:
+                if name not in kwargs:
+                    return None
+            if not self.var_keyword:
+                for name in kwargs:
+                    if name not in keyword_only:
+                        return None
+
+        if given > n:
+            values.extend(args[n:])
+        return values, sorted(kwargs.items()) if kwargs else ()
+
+class _CachedFunction(object):
+    """Internal implementation of a function decorated with
+    :meth:`CachualCache.cached`. Holds the decorator's options and implements
+    the lookup, load and store steps of each call. The steps which don't do
+    any I/O (key generation, packing and deciding what to do with a hit) are
+    kept separate so that they can be shared with the asyncio implementation
+    in :mod:`cachual_asyncio`."""
+    def __init__(self, cache, f, ttl, pack, unpack, use_class_for_self,
+            single_flight, lease_ttl, stale_ttl, early_recompute,
+            codec=None, compress=None, cache_none=False, negative_ttl=None,
+            cache_errors=(), error_ttl=None, get_timeout=None,
+            put_timeout=None, race_origin=False, namespace=None, tags=None):
+        if stale_ttl is not None and ttl is None:
+            raise ValueError("stale_ttl requires a ttl")
+        if early_recompute is not None and ttl is None:
+            raise ValueError("early_recompute requires a ttl")
+        if negative_ttl is not None and not cache_none:
+            raise ValueError("negative_ttl requires cache_none")
+        if cache_errors and error_ttl is None:
+            raise ValueError("cache_errors requires an error_ttl")
+        if get_timeout is None:
+            get_timeout = cache.get_timeout
+        if put_timeout is None:
+            put_timeout = cache.put_timeout
+        if (futures is None and not cache._async and (race_origin or
+                get_timeout is not None or put_timeout is not None)):
+            raise ValueError("get_timeout, put_timeout and race_origin "
+                    "require concurrent.futures")
+        if race_origin and get_timeout is None:
+            raise ValueError("race_origin requires a get_timeout")
+        self.cache = cache
+        self.f = f
+        self.ttl = ttl
+        self.pack, self.unpack = _get_packers(cache, pack, unpack, codec)
+        self.compressor = _get_compressor(cache, compress)
+        self.use_class_for_self = use_class_for_self
+        self.key_builder = cache._get_key_builder(f, use_class_for_self)
+        self.lease_ttl = lease_ttl
+        self.stale_ttl = stale_ttl
+        self.early_recompute = early_recompute
+        self.cache_none = cache_none
+        self.negative_ttl = negative_ttl
+        self.cache_errors = tuple(cache_errors)
+        self.error_ttl = error_ttl
+        self.get_timeout = get_timeout
+        self.put_timeout = put_timeout
+        self.race_origin = race_origin
+        self.namespace = _get_namespace(f, namespace)
+        if tags is not None and not callable(tags):
+            tags = [_unicode(tag) for tag in tags]
+        self.tags = tags
+        self.flights = _SingleFlight() if single_flight else None
+        self.warned_unstable_key = False
+
+    def __call__(self, *args, **kwargs):
+        key = self.key_for(args, kwargs)
+        if key is None:
+            return self.f(*args, **kwargs)
+        if self.race_origin:
+            return self.race(key, args, kwargs)
+        if self.get_timeout is None:
+            hit, value, meta = self.lookup(key)
         else:
-            if kwargs_str is not None:
-                suffix = '(' + kwargs_str + ')'
+            hit, value, meta = self.timed_lookup(key)
+        return self.respond(key, hit, value, meta, args, kwargs)
+
+    def respond(self, key, hit, value, meta, args, kwargs):
+        """Return the value for a call given the outcome of the lookup:
+        the value from the cache on a (fresh enough) hit, or the value from
+        loading it otherwise."""
+        if hit:
+            if meta is None:
+                # Values without metadata are always fresh.
+                return value
+            action = self.hit_action(key, meta)
+            if action == _REFRESH:
+                self.refresh(key, args, kwargs)
+            if action != _RECOMPUTE:
+                return self.result(value, meta)
+        return self.fetch(key, args, kwargs)
+
+    def fetch(self, key, args, kwargs):
+        """Load the value for the key, coalescing concurrent loads."""
+        if self.flights is None:
+            return self.load(key, args, kwargs)
+        return self.flights.do(key, lambda: self.load(key, args, kwargs))
+
+    def timed_lookup(self, key):
+        """As :meth:`lookup`, but giving up (and treating it as a miss) after
+        ``get_timeout`` seconds."""
+        call = self.cache._submit_io(self.lookup, key)
+        if call is None:
+            return False, None, None
+        try:
+            return call.future.result(self.get_timeout)
+        except futures.TimeoutError:
+            self.cache._abandon_io(call)
+            self.cache.logger.debug("get for [%s] timed out", key)
+            self.cache.record_metric('get_timeout')
+            return False, None, None
+
+    def race(self, key, args, kwargs):
+        """Look up the key, and start loading it too if the cache hasn't
+        returned after ``get_timeout`` seconds; return whichever value comes
+        first. A load which loses carries on in the background, so its value
+        is still put into the cache."""
+        call = self.cache._submit_io(self.lookup, key)
+        if call is None:
+            return self.fetch(key, args, kwargs)
+        lookup = call.future
+        try:
+            hit, value, meta = lookup.result(self.get_timeout)
+        except futures.TimeoutError:
+            self.cache._abandon_io(call, cancel=False)
+            load = self.cache._get_origin_pool().submit(self.fetch, key, args,
+                    kwargs)
+            futures.wait([lookup, load], return_when=futures.FIRST_COMPLETED)
+            if lookup.done():
+                hit, value, meta = lookup.result()
+                if hit and self.hit_action(key, meta) != _RECOMPUTE:
+                    self.cache.record_metric('cache_won')
+                    return self.result(value, meta)
             else:
-                suffix = '()'
+                lookup.cancel()
+            self.cache.record_metric('origin_won')
+            return load.result()
+        return self.respond(key, hit, value, meta, args, kwargs)
 
-        m = hashlib.md5()
-        key = ('%s%s' % (prefix, suffix)).encode('utf-8')
-        self.logger.debug('prehash key: [%s]' % key)
-        m.update(key)
-        return m.hexdigest()
+    def key_for(self, args, kwargs):
+        """Get the cache key for a call with the given arguments, or None if
+        the arguments can't be encoded into a stable key (or the generation
+        of the namespace can't be read), in which case the cache should be
+        bypassed."""
+        key = self.unversioned_key_for(args, kwargs)
+        if key is None or self.namespace is None:
+            return key
+        try:
+            return _versioned_key(key,
+                    self.cache._get_generation(self.namespace))
+        except CircuitOpenError:
+            return None
+        except:
+            self.cache.logger.warn("Error getting generation", exc_info=1)
+            return None
+
+    def unversioned_key_for(self, args, kwargs):
+        """As :meth:`key_for`, but without the generation of the namespace."""
+        try:
+            key = self.key_builder(args, kwargs)
+        except UnstableKeyError as e:
+            _warn_unstable_key(self, e)
+            return None
+        self.cache.logger.debug("key: [%s]", key)
+        return key
+
+    def invalidate(self, *args, **kwargs):
+        """Delete the cached value for a call with the given arguments."""
+        key = self.key_builder(args, kwargs)
+        if self.namespace is not None:
+            key = _versioned_key(key,
+                    self.cache._get_generation(self.namespace))
+        self.cache.delete(key)
+
+    def invalidate_all(self):
+        """Invalidate every cached value in the function's namespace."""
+        if self.namespace is None:
+            raise ValueError("invalidate_all requires a namespace")
+        self.cache.invalidate_namespace(self.namespace)
+
+    def lookup(self, key):
+        """Get and unpack the value for the key from the cache. Returns a
+        (hit, value, meta) tuple, where meta is the metadata stored alongside
+        the value (if any); errors are logged and treated as a miss."""
+        try:
+            raw = self.cache._call_cache('get', key)
+            if raw is not None:
+                value, meta = self.decode(raw)
+                if meta is None or self.is_current(key, meta):
+                    return True, value, meta
+        except CircuitOpenError:
+            pass
+        except:
+            self.cache.logger.warn("Error getting value", exc_info=1)
+        return False, None, None
+
+    def is_current(self, key, meta):
+        """Whether a hit with the given metadata is stamped with the current
+        version of each of its tags (if any)."""
+        if meta is None or 'g' not in meta:
+            return True
+        return self.check_stamp(key, meta['g'],
+                self.cache._get_tag_versions(list(meta['g'])))
+
+    def check_stamp(self, key, stamp, versions):
+        """Compare the tag versions a value was stamped with to the current
+        ones."""
+        for tag, version in stamp.items():
+            if versions.get(tag) != version:
+                self.cache.logger.debug("tag %s of [%s] was invalidated",
+                        tag, key)
+                return False
+        return True
+
+    def load(self, key, args, kwargs, background=False):
+        """Execute the function and put its return value into the cache. When
+        a lease is in use and another caller holds it, wait for that caller's
+        value instead (or give up, for background refreshes)."""
+        cache = self.cache
+        holder = False
+        if self.lease_ttl is not None:
+            holder = cache._acquire_lease(key, self.lease_ttl)
+            if not holder:
+                if background:
+                    return None
+                hit, value, meta = self.wait_for_lease(key)
+                if hit:
+                    return self.result(value, meta)
+
+        try:
+            cache.logger.debug("no value from cache, calling function")
+            stamp = None
+            if self.tags is not None and not callable(self.tags):
+                stamp = self.tag_versions(self.tags)
+            start = _now()
+            try:
+                value = self.f(*args, **kwargs)
+            except self.cache_errors as e:
+                self.store_error(key, e)
+                raise
+            delta = _now() - start
+            cache.logger.debug("got value from function call: %s", value)
+            if callable(self.tags):
+                stamp = self.tag_versions(
+                        lambda: self.tags(value, *args, **kwargs))
+            self.store(key, value, delta, stamp)
+            return value
+        finally:
+            if holder:
+                cache._release_lease(key, holder)
+
+    def tag_versions(self, tags):
+        """Get the current versions of the tags to stamp a value with, or None
+        if they can't be read (errors are logged), in which case the value
+        isn't put into the cache. The tags can be given as a function which
+        returns them, whose errors are logged likewise."""
+        try:
+            if callable(tags):
+                tags = tags()
+            return self.cache._get_tag_versions(
+                    [_unicode(tag) for tag in tags])
+        except CircuitOpenError:
+            return None
+        except:
+            self.cache.logger.warn("Error getting tag versions", exc_info=1)
+            return None
+
+    def store(self, key, value, delta, stamp=None):
+        """Pack the value and put it into the cache; errors are logged. The
+        delta is how long the function took to execute, in seconds, and the
+        stamp is the versions of the value's tags. None is only put if
+        ``cache_none`` is set."""
+        if value is None and not self.cache_none:
+            return
+        if self.tags is not None and stamp is None:
+            return
+        try:
+            packed, ttl = self.encode(value, delta, stamp)
+            self.put(key, packed, ttl)
+        except CircuitOpenError:
+            pass
+        except:
+            self.cache.logger.warn("Error putting value", exc_info=1)
+
+    def put(self, key, packed, ttl):
+        """Put a packed value into the cache, waiting at most
+        ``put_timeout`` seconds for it."""
+        if self.put_timeout is None:
+            return self.cache._call_cache('put', key, packed, ttl)
+        call = self.cache._submit_io(self.cache._call_cache, 'put', key,
+                packed, ttl)
+        if call is None:
+            return
+        try:
+            call.future.result(self.put_timeout)
+        except futures.TimeoutError:
+            # Not cancelled: the put carries on in the background.
+            self.cache._abandon_io(call, cancel=False)
+            self.cache.logger.debug("put for [%s] timed out", key)
+            self.cache.record_metric('put_timeout')
+
+    def store_error(self, key, error):
+        """Put an exception raised by the function into the cache; errors are
+        logged."""
+        try:
+            packed, ttl = self.encode_error(error)
+            self.put(key, packed, ttl)
+        except CircuitOpenError:
+            pass
+        except:
+            self.cache.logger.warn("Error putting exception", exc_info=1)
+
+    def wait_for_lease(self, key):
+        """Poll the cache for the value of the key while another caller holds
+        its lease. A miss means the lease expired without the value being
+        put."""
+        deadline = _now() + self.lease_ttl
+        while _now() < deadline:
+            time.sleep(self.cache.lease_poll_interval)
+            hit, value, meta = self.lookup(key)
+            if hit:
+                return hit, value, meta
+        self.cache.logger.debug(
+                "lease for [%s] expired, calling function", key)
+        return False, None, None
+
+    def refresh(self, key, args, kwargs):
+        """Queue a background refresh of the value for the key."""
+        def run():
+            self.load(key, args, kwargs, background=True)
+        if self.cache._get_refresh_pool().submit(key, run):
+            self.cache.logger.debug("queued refresh for [%s]", key)
+
+    def decode(self, raw):
+        """Split a value from the cache into its metadata and unpack it.
+        Returns a (value, meta) tuple."""
+        self.cache.logger.debug("got value from cache: %s", raw)
+        text = self.cache.returns_text
+        value, meta = _unwrap_value(_decompress(raw, self.compressor, text),
+                text)
+        if meta is not None and meta.get('n'):
+            return None, meta
+        if meta is not None and 'e' in meta:
+            return self.decode_error(value, meta['e']), meta
+        if self.unpack is not None:
+            value = self.unpack(value)
+        return value, meta
+
+    def encode(self, value, delta, stamp=None):
+        """Pack a return value of the function, adding any metadata needed by
+        the options in use (and the tag versions in the stamp, if any).
+        Returns a (packed, ttl) tuple, where ttl is the
+        time-to-live to put the packed value with. None is stored as an empty
+        value with a marker in its metadata."""
+        meta = {}
+        if value is None:
+            packed = b''
+            meta['n'] = 1
+            ttl = self.ttl if self.negative_ttl is None else self.negative_ttl
+        else:
+            packed = value if self.pack is None else self.pack(value)
+            ttl = self.ttl
+        if self.stale_ttl is not None or self.early_recompute is not None:
+            meta['f'] = time.time() + ttl
+        if self.early_recompute is not None:
+            meta['d'] = delta
+        if self.stale_ttl is not None:
+            ttl = ttl + self.stale_ttl
+        if stamp:
+            meta['g'] = stamp
+        if meta:
+            packed = self.wrap(packed, meta)
+        if self.compressor is not None:
+            packed = self.compressor.pack(packed)
+        return packed, ttl
+
+    def encode_error(self, error):
+        """Encode an exception raised by the function as its type and
+        arguments. Returns a (packed, ttl) tuple."""
+        cls = type(error)
+        args = json.dumps(list(error.args), default=_unicode)
+        meta = {'e': '%s.%s' % (cls.__module__, _qualname(cls))}
+        return self.wrap(args, meta), self.error_ttl
+
+    def wrap(self, packed, meta):
+        """Store metadata alongside a packed value: as they are, if the cache
+        stores objects, or with :func:`_wrap_value` otherwise."""
+        if self.cache.stores_objects:
+            return _MetaValue(packed, meta)
+        return _wrap_value(packed, meta)
+
+    def decode_error(self, args, name):
+        """Create an exception encoded by :meth:`encode_error` again. Only
+        the types in ``cache_errors`` (and their subclasses) are created;
+        anything else raises ValueError, i.e. is treated as a miss."""
+        classes = list(self.cache_errors)
+        while classes:
+            cls = classes.pop()
+            if '%s.%s' % (cls.__module__, _qualname(cls)) == name:
+                if isinstance(args, bytes):
+                    args = args.decode('utf-8')
+                return cls(*json.loads(args))
+            classes.extend(cls.__subclasses__())
+        raise ValueError("Not caching exceptions of type %s" % name)
+
+    def result(self, value, meta):
+        """Return a value from the cache to the caller, raising it instead if
+        it is a cached exception."""
+        if meta is not None and 'e' in meta:
+            self.cache.logger.debug("raising cached exception %s", meta['e'])
+            raise value
+        return value
+
+    def hit_action(self, key, meta):
+        """Decide what to do with a hit with the given metadata: return it
+        (_FRESH), return it and refresh it in the background (_REFRESH), or
+        treat it as a miss (_RECOMPUTE)."""
+        if meta is None:
+            return _FRESH
+        if self.is_stale(meta):
+            return _REFRESH
+        if not self.should_recompute_early(meta):
+            return _FRESH
+        self.cache.logger.debug("recomputing [%s] early", key)
+        if self.stale_ttl is not None:
+            return _REFRESH
+        return _RECOMPUTE
+
+    def is_stale(self, meta):
+        """Whether a hit with the given metadata is past its freshness time
+        and should be refreshed."""
+        return (self.stale_ttl is not None and meta is not None and
+                'f' in meta and meta['f'] <= time.time())
+
+    def should_recompute_early(self, meta):
+        """Whether a fresh hit with the given metadata should be recomputed
+        early, as per the XFetch algorithm: the expiry time is brought forward
+        by a random, exponentially distributed amount scaled by the time the
+        function took to execute and the beta parameter."""
+        if (self.early_recompute is None or meta is None or
+                'f' not in meta or 'd' not in meta):
+            return False
+        # 1 - random() is in (0, 1], so the log is always defined.
+        gap = -meta['d'] * self.early_recompute * math.log(
+                1.0 - random.random())
+        return time.time() + gap >= meta['f']
+
+class _CachedManyFunction(object):
+    """Internal implementation of a function decorated with
+    :meth:`CachualCache.cached_many`."""
+    def __init__(self, cache, f, ttl, pack, unpack, use_class_for_self,
+            ids_arg, codec=None, compress=None, namespace=None):
+        self.cache = cache
+        self.f = f
+        self.ttl = ttl
+        self.pack, self.unpack = _get_packers(cache, pack, unpack, codec)
+        self.compressor = _get_compressor(cache, compress)
+        self.use_class_for_self = use_class_for_self
+        self.key_builder = cache._get_key_builder(f, use_class_for_self)
+        self.ids_arg = ids_arg
+        # The name of the ids parameter, so that the ids can also be passed
+        # by keyword.
+        parameters = _get_parameters(f)
+        self.ids_name = None
+        if parameters is not None and ids_arg < len(parameters):
+            parameter = parameters[ids_arg]
+            if parameter.kind == parameter.POSITIONAL_OR_KEYWORD:
+                self.ids_name = parameter.name
+        self.namespace = _get_namespace(f, namespace)
+        self.warned_unstable_key = False
+
+    def __call__(self, *args, **kwargs):
+        cache = self.cache
+        ids, with_ids = self.split_ids(args, kwargs)
+        try:
+            keys = self.keys_for(args, kwargs)
+        except UnstableKeyError as e:
+            _warn_unstable_key(self, e)
+            return self.f(*args, **kwargs)
+        except CircuitOpenError:
+            return self.f(*args, **kwargs)
+        except:
+            cache.logger.warn("Error getting generation", exc_info=1)
+            return self.f(*args, **kwargs)
+
+        results = self.lookup(keys)
+        missing = [id_ for id_ in keys if id_ not in results]
+        if not missing:
+            return results
+
+        cache.logger.debug("%d of %d ids missed, calling function",
+                len(missing), len(keys))
+        try:
+            missing_ids = type(ids)(missing)
+        except TypeError:
+            missing_ids = missing
+        missing_args, missing_kwargs = with_ids(missing_ids)
+        values = self.f(*missing_args, **missing_kwargs)
+        if values is None:
+            # Nothing was found for any of the missing ids.
+            values = {}
+        self.store(keys, values)
+        results.update(values)
+        return results
+
+    def split_ids(self, args, kwargs):
+        """Get the collection of ids in the call, passed either by position
+        or by keyword, and a function which returns the call's (args, kwargs)
+        with the ids replaced."""
+        i = self.ids_arg
+        if len(args) > i:
+            return args[i], lambda ids: (args[:i] + (ids,) + args[i + 1:],
+                    kwargs)
+        name = self.ids_name
+        if name is None or name not in kwargs:
+            raise TypeError("%s() is missing its ids argument (position %d)"
+                    % (self.f.__name__, i))
+        def with_ids(ids):
+            replaced = dict(kwargs)
+            replaced[name] = ids
+            return args, replaced
+        return kwargs[name], with_ids
+
+    def keys_for(self, args, kwargs):
+        """Get an ordered mapping of each id in the call to its cache key."""
+        ids, with_ids = self.split_ids(args, kwargs)
+        keys = OrderedDict()
+        for id_ in ids:
+            if id_ not in keys:
+                keys[id_] = self.key_builder(*with_ids(id_))
+        if self.namespace is not None:
+            generation = self.cache._get_generation(self.namespace)
+            for id_, key in keys.items():
+                keys[id_] = _versioned_key(key, generation)
+        return keys
+
+    def invalidate(self, *args, **kwargs):
+        """Delete the cached value of every id in the call."""
+        for key in self.keys_for(args, kwargs).values():
+            self.cache.delete(key)
+
+    def invalidate_all(self):
+        """Invalidate every cached value in the function's namespace."""
+        if self.namespace is None:
+            raise ValueError("invalidate_all requires a namespace")
+        self.cache.invalidate_namespace(self.namespace)
+
+    def lookup(self, keys):
+        """Get and unpack the values for the keys (a mapping of id to key)
+        from the cache, returning a dictionary of id to value for the hits.
+        Errors are logged and treated as misses."""
+        cache = self.cache
+        try:
+            found = cache._call_cache('get_many', list(keys.values()))
+        except CircuitOpenError:
+            return {}
+        except:
+            cache.logger.warn("Error getting values", exc_info=1)
+            return {}
+
+        results = {}
+        text = cache.returns_text
+        for id_, key in keys.items():
+            raw = found.get(key)
+            if raw is None:
+                continue
+            try:
+                value, _ = _unwrap_value(_decompress(raw, self.compressor,
+                        text), text)
+                if self.unpack is not None:
+                    value = self.unpack(value)
+                results[id_] = value
+            except:
+                cache.logger.warn("Error unpacking value", exc_info=1)
+        return results
+
+    def store(self, keys, values):
+        """Pack the function's return values and put them into the cache
+        with a single put_many; errors are logged."""
+        cache = self.cache
+        try:
+            packed = {}
+            for id_, value in values.items():
+                if id_ in keys and value is not None:
+                    value = value if self.pack is None else self.pack(value)
+                    if self.compressor is not None:
+                        value = self.compressor.pack(value)
+                    packed[keys[id_]] = value
+            if packed:
+                cache._call_cache('put_many', packed, self.ttl)
+        except CircuitOpenError:
+            pass
+        except:
+            cache.logger.warn("Error putting values", exc_info=1)
+
+class _BackgroundPool(object):
+    """Internal bounded pool of daemon threads which run queued tasks. Tasks
+    are identified by a key; a task is not queued if one with the same key is
+    already waiting or running, or if the queue is full."""
+    def __init__(self, workers, max_queue, logger):
+        self.workers = workers
+        self.logger = logger
+        self._queue = Queue(max_queue)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, key, fn):
+        """Queue the task, returning False if it was dropped."""
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, fn))
+            except Full:
+                self.logger.warn("Background queue full, dropping task")
+                return False
+            self._pending.add(key)
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run,
+                        name="cachual-background")
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return True
+
+    def _run(self):
+        while True:
+            key, fn = self._queue.get()
+            try:
+                fn()
+            except:
+                self.logger.warn("Error running background task",
+                        exc_info=1)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+class _IOPool(object):
+    """Internal pool of threads for cache calls made with a timeout. At most
+    ``max_queue`` calls wait for a thread; any more are refused, so that calls
+    which have timed out can't build up without bound behind a slow cache."""
+    def __init__(self, workers, max_queue):
+        self._executor = futures.ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def submit(self, fn, *args):
+        """Start the call, returning an :class:`_IOCall` for it, or None if
+        the queue is full."""
+        if not self._slots.acquire(False):
+            return None
+        call = _IOCall()
+        try:
+            call.future = self._executor.submit(call.run, fn, args)
+        except:
+            self._slots.release()
+            raise
+        call.future.add_done_callback(lambda future: self._slots.release())
+        return call
+
+class _IOCall(object):
+    """Internal handle for a call made on an :class:`_IOPool`. Once its
+    caller has given up waiting for it, the call is abandoned: its outcome no
+    longer counts towards the circuit breaker (see
+    :meth:`CachualCache._abandon_io`)."""
+    def __init__(self):
+        self.future = None
+        self.abandoned = False
+
+    def run(self, fn, args):
+        _io_local.call = self
+        try:
+            return fn(*args)
+        finally:
+            _io_local.call = None
+
+def _abandoned():
+    """Helper function to check whether the current thread is making a cache
+    call which its caller has abandoned; see :class:`_IOCall`."""
+    call = _io_local.call
+    return call is not None and call.abandoned
+
+class _CircuitBreaker(object):
+    """Internal circuit breaker which opens after a number of consecutive
+    failures, and lets a single call through to probe for recovery each time
+    the reset timeout passes while it is open."""
+    def __init__(self, threshold, reset_timeout, logger):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call should be made."""
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if _now() - self.opened_at < self.reset_timeout:
+                return False
+            # Half open: let this call probe the cache, and keep everything
+            # else out until the reset timeout passes again.
+            self.opened_at = _now()
+            self.logger.debug("probing cache with circuit breaker open")
+            return True
+
+    def success(self):
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                if self.opened_at is not None:
+                    self.logger.info("Cache recovered, closing circuit")
+                self.failures = 0
+                self.opened_at = None
+
+    def failure(self):
+        if self.threshold is None:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                self.opened_at = _now()
+            elif self.failures >= self.threshold:
+                self.logger.warn("Cache failed %d times in a row, opening "
+                        "circuit for %ss", self.failures, self.reset_timeout)
+                self.opened_at = _now()
+
+class _SingleFlight(object):
+    """Internal helper which coalesces concurrent calls for the same key, so
+    that only one of them (the leader) runs and the rest wait for its
+    outcome."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value
+
+class _Call(object):
+    """Internal record of an in-flight call for :class:`_SingleFlight`."""
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
 
 class RedisCache(CachualCache):
     """A cache using `Redis <https://redis.io/>`_ as the backing cache. All
@@ -166,25 +1934,2031 @@ class RedisCache(CachualCache):
     to alter this behavior e.g. to store Python dictionaries, use the
     pack/unpack arguments when you specify your @cached decorator.
 
-    :type host: string
-    :param host: The Redis host to use for the cache.
+    :type host: string
+    :param host: The Redis host to use for the cache.
+
+    :type port: integer
+    :param port: The port to use for the Redis server.
+
+    :type db: integer
+    :param db: The Redis database to use on the server for the cache.
+
+    :type connection_pool: redis.ConnectionPool
+    :param connection_pool: If specified, the connection pool to use instead
+                            of creating one, e.g. to share connections
+                            between several caches. The host, port, db and
+                            other connection arguments are then ignored.
+
+    :type unix_socket_path: string
+    :param unix_socket_path: If specified, connect to Redis over this unix
+                             socket instead of TCP (host and port are then
+                             ignored).
+
+    :type max_connections: integer
+    :param max_connections: The maximum number of connections in the pool
+                            (unbounded by default).
+
+    :type socket_timeout: float
+    :param socket_timeout: The timeout in seconds for reading from and
+                           writing to Redis.
+
+    :type socket_connect_timeout: float
+    :param socket_connect_timeout: The timeout in seconds for connecting to
+                                   Redis.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionchanged:: 0.3.0
+       Added ``connection_pool``, ``unix_socket_path``, ``max_connections``,
+       ``socket_timeout`` and ``socket_connect_timeout`` parameters.
+    """
+    def __init__(self, host='localhost', port=6379, db=0,
+            connection_pool=None, unix_socket_path=None, max_connections=None,
+            socket_timeout=None, socket_connect_timeout=None, **kwargs):
+        super(RedisCache, self).__init__(**kwargs)
+        if connection_pool is not None:
+            self.client = StrictRedis(connection_pool=connection_pool)
+            return
+
+        options = {}
+        if max_connections is not None:
+            options['max_connections'] = max_connections
+        if socket_timeout is not None:
+            options['socket_timeout'] = socket_timeout
+        if socket_connect_timeout is not None:
+            options['socket_connect_timeout'] = socket_connect_timeout
+        if unix_socket_path is not None:
+            self.client = StrictRedis(unix_socket_path=unix_socket_path,
+                    db=db, **options)
+        else:
+            self.client = StrictRedis(host=host, port=port, db=db, **options)
+
+    def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        return self.client.get(key)
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key. If the value is not a
+        string, its unicode value will be used. This behavior is defined by the
+        underlying Redis library, and could be subject to change in future
+        versions; thus it is safest to only store strings in Redis (although
+        basic types should serialize into a string cleanly, you will need to
+        unpack them when they are retrieved from the cache).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self.client.set(key, value, ex=ttl)
+
+    def get_many(self, keys):
+        """Get the values for several keys with a single ``MGET``.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        if not keys:
+            return {}
+        return dict((key, value) for key, value in
+                zip(keys, self.client.mget(keys)) if value is not None)
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the cache with a single pipelined round
+        trip.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key, value, ex=ttl)
+        pipeline.execute()
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, only if the key does
+        not already exist (``SET NX``).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire. Fractions of a second are honoured.
+
+        :rtype: bool
+        :returns: True if the value was stored, False if the key already
+                  existed.
+        """
+        px = None if ttl is None else int(ttl * 1000)
+        return bool(self.client.set(key, value, px=px, nx=True))
+
+    def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self.client.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value, atomically with a Lua script.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        return bool(self.client.eval(_REDIS_DELETE_IF_EQUAL, 1, key, value))
+
+class MemcachedCache(CachualCache):
+    """A cache using `Memcached <https://memcached.org/>`_ as the backing
+    cache. The same caveats apply to keys and values as for Redis - you should
+    only try to store strings (using the packing/unpacking functions). See the
+    documentation on Keys and Values here:
+    :class:`pymemcache.client.base.Client`.
+
+    The cache uses a :class:`pymemcache.client.base.PooledClient`, so it can
+    be shared between threads, each of which uses its own connection from a
+    bounded pool. When every connection is in use, threads wait for one to be
+    returned to the pool.
+
+    Values larger than ``max_item_size`` bytes, which Memcached would reject,
+    are split into chunks stored under keys of their own, and a small
+    manifest with the number of chunks, their total length and a checksum is
+    stored at the key. The chunks and the manifest are written with a single
+    ``set_many`` and read with a ``get_many``. If a chunk is missing (e.g.
+    evicted, or not written because another put failed halfway), or the
+    checksum doesn't match, the value is treated as a miss. Chunked values are
+    read back as bytes.
+
+    :type host: string
+    :param host: The Memcached host to use for the cache.
+
+    :type port: integer
+    :param port: The port to use for the Memcached server.
+
+    :type pool_size: integer
+    :param pool_size: The maximum number of connections in the pool.
+
+    :type connect_timeout: float
+    :param connect_timeout: The timeout in seconds for connecting to
+                            Memcached (no timeout by default).
+
+    :type timeout: float
+    :param timeout: The timeout in seconds for reading from and writing to
+                    Memcached (no timeout by default).
+
+    :type no_delay: bool
+    :param no_delay: Whether to set ``TCP_NODELAY`` on connections, so that
+                     small requests are sent immediately.
+
+    :type keepalive: bool or pymemcache.client.base.KeepaliveOpts
+    :param keepalive: If True (or a
+                      :class:`pymemcache.client.base.KeepaliveOpts`), enable
+                      TCP keepalive on connections, so that connections to a
+                      host which has gone away are detected.
+
+    :type max_item_size: integer
+    :param max_item_size: The size in bytes above which values are split into
+                          chunks. The default is a little under Memcached's
+                          default item size limit of 1 MB, leaving room for
+                          the key and item header. If None, values are never
+                          split.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionchanged:: 0.3.0
+       Connections are now pooled. Added ``pool_size``, ``connect_timeout``,
+       ``timeout``, ``no_delay``, ``keepalive`` and ``max_item_size``
+       parameters, and values larger than ``max_item_size`` are now split
+       into chunks.
+    """
+    def __init__(self, host='localhost', port=11211, pool_size=16,
+            connect_timeout=None, timeout=None, no_delay=True,
+            keepalive=False, max_item_size=1000000, **kwargs):
+        super(MemcachedCache, self).__init__(**kwargs)
+        self.max_item_size = max_item_size
+        options = {'max_pool_size': pool_size, 'no_delay': no_delay}
+        if connect_timeout is not None:
+            options['connect_timeout'] = connect_timeout
+        if timeout is not None:
+            options['timeout'] = timeout
+        if keepalive is True:
+            from pymemcache.client.base import KeepaliveOpts
+            keepalive = KeepaliveOpts()
+        if keepalive:
+            options['socket_keepalive'] = keepalive
+        self.client = MemcachedClient((host, port), **options)
+        # The pool raises an error rather than waiting when it is exhausted.
+        self.client.client_pool = _BlockingPool(self.client.client_pool,
+                pool_size)
+
+    def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        return self._join_chunks({key: self.client.get(key)}).get(key)
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, splitting it into
+        chunks if it is larger than ``max_item_size``. For constraints on keys
+        and values, see :class:`pymemcache.client.base.Client`.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        if ttl is None:
+            ttl = 0
+        items = self._split_chunks({key: value})
+        if items is None:
+            self.client.set(key, value, expire=ttl)
+        else:
+            self._set_chunks(items, ttl)
+
+    def get_many(self, keys):
+        """Get the values for several keys with a single ``get_many``.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        if not keys:
+            return {}
+        return self._join_chunks(self.client.get_many(keys))
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the cache with a single ``set_many``,
+        splitting any which are larger than ``max_item_size`` into chunks.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        if ttl is None:
+            ttl = 0
+        items = self._split_chunks(values)
+        if items is None:
+            self.client.set_many(values, expire=ttl)
+        else:
+            self._set_chunks(items, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, only if the key does
+        not already exist.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire. Memcached only supports whole seconds, so this is
+                    rounded up.
+
+        :rtype: bool
+        :returns: True if the value was stored, False if the key already
+                  existed.
+        """
+        expire = 0 if ttl is None else int(math.ceil(ttl))
+        items = self._split_chunks({key: value})
+        if items is not None:
+            # Write the chunks first, so that the manifest is only added once
+            # they are all there.
+            value = items.pop(key)
+            failed = self.client.set_many(items, expire=expire, noreply=False)
+            if failed:
+                raise MemcacheError("Failed to store %d chunks" % len(failed))
+        return self.client.add(key, value, expire=expire, noreply=False)
+
+    def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self.client.delete(key, noreply=False)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value, atomically with ``gets`` and ``cas``.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        current, cas = self.client.gets(key)
+        if current is None or current != _to_bytes(value):
+            return False
+        # Memcached has no conditional delete, so replace the value with one
+        # which has already expired instead.
+        return bool(self.client.cas(key, b'', cas, expire=_MEMCACHED_EXPIRED,
+                noreply=False))
+
+    def _split_chunks(self, values):
+        """Internal function to split the values which are larger than
+        ``max_item_size`` into chunks. Returns a dictionary of every item to
+        set (the chunks, the manifests at the keys of the values which were
+        split, and the other values), or None if no value had to be split."""
+        items = None
+        for key, value in values.items():
+            data = self._oversized(value)
+            if data is not None:
+                if items is None:
+                    items = dict(values)
+                items[key] = _chunk_value(data, self.max_item_size, items)
+        return items
+
+    def _oversized(self, value):
+        """Internal function to return the value as bytes if it is larger than
+        ``max_item_size``, or None otherwise."""
+        if self.max_item_size is None:
+            return None
+        if isinstance(value, bytes):
+            data = value
+        elif (isinstance(value, type(u'')) and
+                len(value) * 4 > self.max_item_size):
+            # Only encode strings which may be too large once encoded.
+            data = value.encode('utf-8')
+        else:
+            return None
+        return data if len(data) > self.max_item_size else None
+
+    def _set_chunks(self, items, ttl):
+        """Internal function to set the items of chunked values. If any item
+        isn't stored, the manifests are deleted so that readers don't have to
+        find out that the value is torn."""
+        failed = self.client.set_many(items, expire=ttl, noreply=False)
+        if failed:
+            manifests = [key for key, value in items.items()
+                         if _read_manifest(value) is not None]
+            self.client.delete_many(manifests)
+            raise MemcacheError("Failed to store %d items" % len(failed))
+
+    def _join_chunks(self, values):
+        """Internal function to replace the manifests among the values read
+        from Memcached with the values they describe, reading every chunk
+        with a single ``get_many``. Values whose chunks are missing or don't
+        match their checksum are left out."""
+        manifests = {}
+        for key, value in values.items():
+            manifest = _read_manifest(value)
+            if manifest is not None:
+                manifests[key] = manifest
+        if not manifests:
+            return values
+        chunk_keys = []
+        for manifest in manifests.values():
+            chunk_keys.extend(_chunk_keys(manifest))
+        chunks = self.client.get_many(chunk_keys)
+        values = dict(values)
+        for key, manifest in manifests.items():
+            value = _assemble_chunks(manifest, chunks)
+            if value is None:
+                self.logger.debug("chunks of [%s] are missing or torn", key)
+                del values[key]
+            else:
+                values[key] = value
+        return values
+
+class _BlockingPool(object):
+    """Internal wrapper around the connection pool of a pymemcache
+    PooledClient, which waits for a connection to be returned to the pool
+    when they are all in use rather than raising an error."""
+    def __init__(self, pool, size):
+        self.pool = pool
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def get_and_release(self, destroy_on_fail=False):
+        with self._slots:
+            with self.pool.get_and_release(destroy_on_fail) as client:
+                yield client
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+class LocalCache(CachualCache):
+    """An in-process cache, for single-process programs and tests which
+    shouldn't need a cache server (or as the in-process tier of a
+    :class:`TieredCache`). Values are stored as they are, without being
+    copied or encoded, and expire after their ``ttl``.
+
+    The cache is bounded either by the number of entries or by the total
+    size of the keys and values in bytes (the length of strings and bytes,
+    and ``sys.getsizeof`` of anything else). When it is full, entries are
+    evicted according to the eviction policy:
+
+    * ``'lru'`` evicts the least recently used entry.
+    * ``'lfu'`` evicts the least frequently used entry (the least recently
+      used one of those, on a tie).
+    * ``'tinylfu'`` is W-TinyLFU: new entries go into a small LRU window, and
+      entries leaving the window are only admitted into the main, segmented
+      LRU area if they have been used more often (as estimated by a compact,
+      periodically aged frequency sketch) than the entry they would evict.
+      This keeps one-off scans from flushing out popular entries, and suits
+      skewed workloads.
+
+    Keys are spread over several shards, each with its own lock, its own
+    share of the capacity and its own eviction policy, so that threads using
+    different keys rarely wait for each other. Small caches use a single
+    shard so that eviction is exact.
+
+    :type max_entries: integer
+    :param max_entries: The maximum number of entries to keep; 10000 if
+                        neither ``max_entries`` nor ``max_bytes`` is given.
+
+    :type max_bytes: integer
+    :param max_bytes: The maximum total size of the keys and values in bytes.
+                      Values larger than the capacity of a shard are not
+                      stored.
+
+    :type policy: string
+    :param policy: The eviction policy: ``'lru'`` (the default), ``'lfu'`` or
+                   ``'tinylfu'``.
+
+    :type shards: integer
+    :param shards: The maximum number of shards.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionadded:: 0.3.0
+    """
+    returns_text = True
+    stores_objects = True
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru',
+            shards=16, **kwargs):
+        if max_entries is not None and max_bytes is not None:
+            raise ValueError("Only one of max_entries and max_bytes can be "
+                    "given")
+        if policy not in _EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy %r" % policy)
+        super(LocalCache, self).__init__(**kwargs)
+        if max_bytes is None:
+            capacity = 10000 if max_entries is None else max_entries
+            min_shard_capacity = 64
+        else:
+            capacity = max_bytes
+            min_shard_capacity = 1 << 16
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        n = max(1, min(shards, capacity // min_shard_capacity))
+        self._shards = [_LocalShard(
+                _EVICTION_POLICIES[policy](capacity // n +
+                        (1 if i < capacity % n else 0)),
+                max_bytes is not None) for i in range(n)]
+
+    def _shard_for(self, key):
+        """Internal function to get the shard holding the key."""
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        return self._shard_for(key).get(key)
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, evicting other entries
+        if the cache is full.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self._shard_for(key).put(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the cache only if the key does not already exist
+        (or has expired).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        return self._shard_for(key).put(key, value, ttl, only_new=True)
+
+    def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self._shard_for(key).delete(key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        return self._shard_for(key).delete(key, value)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+class TieredCache(CachualCache):
+    """A two-tier cache which keeps a small, bounded in-process cache (L1) in
+    front of any other :class:`CachualCache` (the remote tier, e.g. a
+    :class:`RedisCache`). Hits in L1 are served without any network I/O; the
+    remote tier is only consulted when L1 misses, and values fetched from the
+    remote tier are then kept in L1 for at most ``local_ttl`` seconds.
+
+    Values are only stored in L1 once they have been read back from the
+    remote tier, so that L1 hits always return exactly what the remote tier
+    would have returned (e.g. bytes rather than the unicode string that was
+    put). Putting a value evicts the key from L1.
+
+    :type remote: CachualCache
+    :param remote: The cache to use as the remote tier.
+
+    :type max_entries: integer
+    :param max_entries: The maximum number of entries to keep in process.
+
+    :type local_ttl: float
+    :param local_ttl: The time-to-live in seconds for entries in L1. This
+                      should be short, since L1 is not invalidated when other
+                      processes put new values into the remote tier.
+
+    :type policy: string
+    :param policy: The eviction policy of L1, which is a :class:`LocalCache`:
+                   ``'lru'`` (the default), ``'lfu'`` or ``'tinylfu'``.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionadded:: 0.3.0
+    """
+    def __init__(self, remote, max_entries=1024, local_ttl=5, policy='lru',
+            **kwargs):
+        super(TieredCache, self).__init__(**kwargs)
+        self.remote = remote
+        self.local_ttl = local_ttl
+        self.local = LocalCache(max_entries=max_entries, policy=policy)
+
+    @property
+    def returns_text(self):
+        return self.remote.returns_text
+
+    @property
+    def stores_objects(self):
+        return self.remote.stores_objects
+
+    def get(self, key):
+        """Get a value from L1, falling back to the remote tier on a miss.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = self.remote.get(key)
+        if value is not None:
+            self.local.put(key, value, self.local_ttl)
+        return value
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the remote tier and evict it from L1.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self.local.delete(key)
+        self.remote.put(key, value, ttl)
+
+    def get_many(self, keys):
+        """Get the values for several keys from L1, fetching any that miss
+        from the remote tier with a single **get_many**.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            remote_values = self.remote.get_many(missing)
+            for key, value in remote_values.items():
+                self.local.put(key, value, self.local_ttl)
+            values.update(remote_values)
+        return values
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the remote tier and evict them from L1.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        for key in values:
+            self.local.delete(key)
+        self.remote.put_many(values, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the remote tier only if the key does not already
+        exist there.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        return self.remote.add(key, value, ttl)
+
+    def delete(self, key):
+        """Remove the given key from both tiers.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self.local.delete(key)
+        self.remote.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from both tiers, only if it has the given
+        value in the remote tier.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        self.local.delete(key)
+        return self.remote.delete_if_equal(key, value)
+
+class _LocalShard(object):
+    """Internal shard of a :class:`LocalCache`: a dictionary of entries and
+    an eviction policy, guarded by a lock."""
+    def __init__(self, policy, by_size):
+        self.policy = policy
+        self.by_size = by_size
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is None:
+                self.policy.record(key)
+                return None
+            if node.expires is not None and node.expires <= _now():
+                self._remove(node)
+                return None
+            self.policy.hit(node)
+            return node.value
+
+    def put(self, key, value, ttl=None, only_new=False):
+        expires = None if ttl is None else _now() + ttl
+        size = _entry_size(key, value) if self.by_size else 1
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                if (only_new and (node.expires is None or
+                        node.expires > _now())):
+                    return False
+                self._remove(node)
+            if size > self.policy.capacity:
+                return False
+            node = _LocalNode(key, value, expires, size)
+            self._nodes[key] = node
+            for evicted in self.policy.insert(node):
+                del self._nodes[evicted.key]
+            return key in self._nodes
+
+    def delete(self, key, value=_MISSING):
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is None or (value is not _MISSING and
+                    node.value != value):
+                return False
+            self._remove(node)
+            return node.expires is None or node.expires > _now()
+
+    def _remove(self, node):
+        del self._nodes[node.key]
+        self.policy.remove(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+class _LocalNode(object):
+    """Internal entry of a :class:`LocalCache`, which is also a node of the
+    doubly linked list it is in."""
+    __slots__ = ('key', 'value', 'expires', 'size', 'prev', 'next', 'queue',
+                 'freq')
+
+    def __init__(self, key, value, expires, size):
+        self.key = key
+        self.value = value
+        self.expires = expires
+        self.size = size
+        self.prev = self.next = self.queue = None
+        self.freq = 0
+
+class _LinkedList(object):
+    """Internal doubly linked list of :class:`_LocalNode`, most recently
+    added first, which keeps track of the total size of its nodes."""
+    __slots__ = ('head', 'size')
+
+    def __init__(self):
+        # The head is a sentinel; head.next is the first node and head.prev
+        # the last.
+        self.head = _LocalNode(None, None, None, 0)
+        self.head.prev = self.head.next = self.head
+        self.size = 0
+
+    def push(self, node):
+        head = self.head
+        node.prev = head
+        node.next = head.next
+        head.next.prev = node
+        head.next = node
+        node.queue = self
+        self.size += node.size
+
+    def remove(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = node.next = node.queue = None
+        self.size -= node.size
+
+    def last(self):
+        node = self.head.prev
+        return None if node is self.head else node
+
+    def move_to_front(self, node):
+        self.remove(node)
+        self.push(node)
+
+class _LRUPolicy(object):
+    """Internal least recently used eviction policy. Policies are given the
+    capacity of a shard (in entries or bytes), and their methods are called
+    with the lock of the shard held."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.queue = _LinkedList()
+
+    def record(self, key):
+        """Record an access to a key which isn't in the cache."""
+
+    def hit(self, node):
+        self.queue.move_to_front(node)
+
+    def insert(self, node):
+        """Add a new node, returning the nodes to evict (which may include the
+        new node itself)."""
+        self.queue.push(node)
+        evicted = []
+        while self.queue.size > self.capacity:
+            victim = self.queue.last()
+            self.queue.remove(victim)
+            evicted.append(victim)
+        return evicted
+
+    def remove(self, node):
+        node.queue.remove(node)
+
+class _LFUPolicy(object):
+    """Internal least frequently used eviction policy, with a list of nodes
+    for each access count so that every operation is O(1)."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.queues = {}
+        self.min_freq = 1
+
+    def record(self, key):
+        pass
+
+    def hit(self, node):
+        self._unlink(node)
+        if node.freq == self.min_freq and self.min_freq not in self.queues:
+            self.min_freq += 1
+        node.freq += 1
+        self._link(node)
+
+    def insert(self, node):
+        # Evict before adding the new node, which would otherwise always be
+        # the least frequently used one.
+        evicted = []
+        while self.size + node.size > self.capacity:
+            while self.min_freq not in self.queues:
+                self.min_freq += 1
+            victim = self.queues[self.min_freq].last()
+            self.remove(victim)
+            evicted.append(victim)
+        node.freq = 1
+        self.min_freq = 1
+        self._link(node)
+        self.size += node.size
+        return evicted
+
+    def remove(self, node):
+        self._unlink(node)
+        self.size -= node.size
+
+    def _link(self, node):
+        queue = self.queues.get(node.freq)
+        if queue is None:
+            queue = self.queues[node.freq] = _LinkedList()
+        queue.push(node)
+
+    def _unlink(self, node):
+        queue = node.queue
+        queue.remove(node)
+        if queue.head.next is queue.head:
+            del self.queues[node.freq]
+
+class _TinyLFUPolicy(object):
+    """Internal W-TinyLFU eviction policy: an LRU window (1% of the capacity)
+    in front of a segmented LRU main area, split into probation and
+    protected (80% of the main area) lists. Entries leaving the window are
+    admitted into the main area only if the frequency sketch estimates that
+    they are used more often than the victim they would evict."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.window_capacity = max(1, capacity // 100)
+        self.main_capacity = capacity - self.window_capacity
+        self.protected_capacity = self.main_capacity * 4 // 5
+        self.window = _LinkedList()
+        self.probation = _LinkedList()
+        self.protected = _LinkedList()
+        self.sketch = _FrequencySketch()
+        self.entries = 0
+
+    def record(self, key):
+        self.sketch.increment(key)
+
+    def hit(self, node):
+        self.sketch.increment(node.key)
+        queue = node.queue
+        if queue is self.probation:
+            queue.remove(node)
+            self.protected.push(node)
+            while self.protected.size > self.protected_capacity:
+                demoted = self.protected.last()
+                self.protected.remove(demoted)
+                self.probation.push(demoted)
+        else:
+            queue.move_to_front(node)
+
+    def insert(self, node):
+        self.entries += 1
+        self.sketch.ensure_capacity(self.entries)
+        self.sketch.increment(node.key)
+        self.window.push(node)
+        evicted = []
+        while self.window.size > self.window_capacity:
+            candidate = self.window.last()
+            self.window.remove(candidate)
+            self._admit(candidate, evicted)
+        self.entries -= len(evicted)
+        return evicted
+
+    def _admit(self, candidate, evicted):
+        """Move a candidate from the window into the main area, evicting
+        either it or the victims it would replace."""
+        freq = self.sketch.frequency(candidate.key)
+        while (self.probation.size + self.protected.size + candidate.size >
+                self.main_capacity):
+            victim = self.probation.last() or self.protected.last()
+            if victim is None or self.sketch.frequency(victim.key) >= freq:
+                evicted.append(candidate)
+                return
+            victim.queue.remove(victim)
+            evicted.append(victim)
+        self.probation.push(candidate)
+
+    def remove(self, node):
+        node.queue.remove(node)
+        self.entries -= 1
+
+_EVICTION_POLICIES = {
+    'lru': _LRUPolicy,
+    'lfu': _LFUPolicy,
+    'tinylfu': _TinyLFUPolicy,
+}
+
+class _FrequencySketch(object):
+    """Internal count-min sketch of how often keys were accessed, with four
+    rows of counters which saturate at 15. All counters are halved once the
+    number of increments reaches ten times the width, so that the estimates
+    favour recent accesses."""
+    _ROWS = tuple(enumerate((0x97CB3127, 0xB9F31A3B, 0xE6A8C1D3,
+                             0x5C72E8B5)))
+
+    def __init__(self):
+        self._resize(16)
+
+    def _resize(self, width):
+        self.width = width
+        self.mask = width - 1
+        self.table = bytearray(4 * width)
+        self.additions = 0
+        self.sample_size = 10 * width
+
+    def ensure_capacity(self, entries):
+        """Grow the sketch (forgetting all counts) if it is too small for the
+        given number of entries."""
+        if entries > self.width:
+            width = self.width
+            while width < entries:
+                width *= 2
+            self._resize(width)
+
+    def _indexes(self, key):
+        h = hash(key)
+        width = self.width
+        mask = self.mask
+        # One counter in each row, at a different hash of the key.
+        return [i * width + (((h * seed) >> 16) & mask)
+                for i, seed in self._ROWS]
+
+    def increment(self, key):
+        table = self.table
+        added = False
+        for i in self._indexes(key):
+            if table[i] < 15:
+                table[i] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.table = bytearray(count >> 1 for count in table)
+                self.additions //= 2
+
+    def frequency(self, key):
+        table = self.table
+        return min([table[i] for i in self._indexes(key)])
+
+def _entry_size(key, value):
+    """Helper function to return the size in bytes of an entry of a
+    :class:`LocalCache`."""
+    return _value_size(key) + _value_size(value)
+
+def _value_size(value):
+    """Helper function to return the size in bytes of a key or value of a
+    :class:`LocalCache`."""
+    if isinstance(value, (bytes, type(u''))):
+        return len(value)
+    return sys.getsizeof(value)
+
+class SharedMemoryCache(CachualCache):
+    """A cache kept in a memory-mapped file, which every process on the host
+    that opens the same file shares (e.g. the workers of a prefork server).
+    Reads and writes don't do any network I/O, and the entries are stored
+    once per host rather than once per process. Put the file on a
+    memory-backed file system such as ``/dev/shm`` to keep it out of the
+    page cache writeback.
+
+    The file is a fixed-size hash table of ``buckets`` buckets, each of which
+    has ``ways`` slots of ``slot_size`` bytes. A key can only be stored in
+    the slots of its bucket; when they are all taken, the least recently
+    used entry of the bucket is evicted. Each bucket is locked separately
+    (with ``fcntl`` byte-range locks between processes and thread locks
+    within a process), so operations on different buckets never wait for
+    each other. Entries whose key and value don't fit into a slot (along with
+    a 24 byte header) are not stored.
+
+    Values are returned as they were put if they are bytes or unicode
+    strings; anything else is stored as its unicode string. The file is
+    created the first time it is opened, and every process must open it
+    with the same ``buckets``, ``ways`` and ``slot_size``. This cache is only
+    available on platforms with ``fcntl`` (i.e. not on Windows).
+
+    :type path: string
+    :param path: The path of the file to map.
+
+    :type buckets: integer
+    :param buckets: The number of buckets in the hash table.
+
+    :type ways: integer
+    :param ways: The number of slots in each bucket.
+
+    :type slot_size: integer
+    :param slot_size: The size of each slot in bytes.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionadded:: 0.3.0
+    """
+    returns_text = True
+
+    def __init__(self, path, buckets=8192, ways=4, slot_size=2048,
+            **kwargs):
+        if fcntl is None:
+            raise ImportError("SharedMemoryCache requires fcntl")
+        if slot_size <= _SHM_SLOT.size:
+            raise ValueError("slot_size must be larger than %d" %
+                    _SHM_SLOT.size)
+        super(SharedMemoryCache, self).__init__(**kwargs)
+        self.path = path
+        self.buckets = buckets
+        self.ways = ways
+        self.slot_size = slot_size
+        self._bucket_size = ways * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = self._init_file()
+            self._mm = mmap.mmap(self._fd, size)
+        except:
+            os.close(self._fd)
+            raise
+        self._thread_locks = [threading.Lock() for _ in range(64)]
+
+    def _init_file(self):
+        """Internal function to create the hash table in the file (if it is
+        empty) or check that it has the expected layout, holding a lock on
+        the header. Returns the size of the file."""
+        header = _SHM_HEADER.pack(_SHM_MAGIC, self.buckets, self.ways,
+                self.slot_size)
+        size = len(header) + self.buckets * self._bucket_size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, len(header), 0)
+        try:
+            existing = os.read(self._fd, len(header))
+            if not existing:
+                os.ftruncate(self._fd, size)
+                os.write(self._fd, header)
+            elif existing != header:
+                raise ValueError("%s is not a shared memory cache with the "
+                        "same layout" % self.path)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, len(header), 0)
+        return size
+
+    def _bucket_for(self, key):
+        """Internal function to get the offset of the key's bucket in the
+        file."""
+        bucket = (zlib.crc32(key) & 0xFFFFFFFF) % self.buckets
+        return _SHM_HEADER.size + bucket * self._bucket_size
+
+    def _lock(self, bucket):
+        """Internal function to lock a bucket for this thread and process.
+        Locks taken with ``fcntl`` belong to the process, so threads also
+        need a thread lock."""
+        lock = self._thread_lock(bucket)
+        lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._bucket_size, bucket)
+        except:
+            lock.release()
+            raise
+
+    def _unlock(self, bucket):
+        """Internal function to unlock a bucket locked by :meth:`_lock`."""
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._bucket_size, bucket)
+        finally:
+            self._thread_lock(bucket).release()
+
+    def _thread_lock(self, bucket):
+        """Internal function to get the thread lock of a bucket."""
+        index = (bucket - _SHM_HEADER.size) // self._bucket_size
+        return self._thread_locks[index % len(self._thread_locks)]
+
+    def _find(self, bucket, key, now):
+        """Internal function to find the slot holding the key in a locked
+        bucket. Returns a (slot, free) tuple, where slot is the offset of the
+        key's slot (or None) and free the offset of the slot a new entry
+        should go into: an empty or expired slot, or else the least recently
+        used one. Expired entries are removed along the way."""
+        mm = self._mm
+        found = empty = oldest = None
+        for slot in range(bucket, bucket + self._bucket_size,
+                self.slot_size):
+            used, _, key_len, _, expires, accessed = _SHM_SLOT.unpack_from(
+                    mm, slot)
+            if used and expires and expires <= now:
+                mm[slot:slot + 1] = _SHM_EMPTY
+                used = 0
+            if not used:
+                if empty is None:
+                    empty = slot
+                continue
+            if found is None and key_len == len(key):
+                start = slot + _SHM_SLOT.size
+                if mm[start:start + key_len] == key:
+                    found = slot
+            if oldest is None or accessed < oldest[1]:
+                oldest = (slot, accessed)
+        return found, empty if empty is not None else oldest[0]
+
+    def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        key = _to_bytes(key)
+        bucket = self._bucket_for(key)
+        now = time.time()
+        self._lock(bucket)
+        try:
+            slot, _ = self._find(bucket, key, now)
+            if slot is None:
+                return None
+            mm = self._mm
+            used, kind, key_len, value_len, expires, _ = _SHM_SLOT.unpack_from(
+                    mm, slot)
+            _SHM_SLOT.pack_into(mm, slot, used, kind, key_len, value_len,
+                    expires, now)
+            start = slot + _SHM_SLOT.size + key_len
+            value = mm[start:start + value_len]
+        finally:
+            self._unlock(bucket)
+        return value.decode('utf-8') if kind else value
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, evicting the least
+        recently used entry of its bucket if the bucket is full.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self._put(key, value, ttl, False)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the cache only if the key does not already exist
+        (or has expired).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        return self._put(key, value, ttl, True)
+
+    def _put(self, key, value, ttl, only_new):
+        """Internal function to put a value into the key's bucket. Returns
+        whether the value was stored."""
+        key = _to_bytes(key)
+        kind = 0 if isinstance(value, bytes) else 1
+        value = _to_bytes(value)
+        now = time.time()
+        expires = 0 if ttl is None else now + ttl
+        fits = (_SHM_SLOT.size + len(key) + len(value) <= self.slot_size)
+        bucket = self._bucket_for(key)
+        self._lock(bucket)
+        try:
+            slot, free = self._find(bucket, key, now)
+            if slot is not None:
+                if only_new:
+                    return False
+                if not fits:
+                    # Don't leave the old value behind.
+                    self._mm[slot:slot + 1] = _SHM_EMPTY
+            if not fits:
+                self.logger.debug("value for [%s] doesn't fit into a slot",
+                        key)
+                return False
+            if slot is None:
+                slot = free
+            entry = _SHM_SLOT.pack(1, kind, len(key), len(value), expires,
+                    now) + key + value
+            self._mm[slot:slot + len(entry)] = entry
+            return True
+        finally:
+            self._unlock(bucket)
+
+    def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        key = _to_bytes(key)
+        bucket = self._bucket_for(key)
+        self._lock(bucket)
+        try:
+            slot, _ = self._find(bucket, key, time.time())
+            if slot is not None:
+                self._mm[slot:slot + 1] = _SHM_EMPTY
+        finally:
+            self._unlock(bucket)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        key = _to_bytes(key)
+        value = _to_bytes(value)
+        bucket = self._bucket_for(key)
+        self._lock(bucket)
+        try:
+            slot, _ = self._find(bucket, key, time.time())
+            if slot is None:
+                return False
+            _, _, key_len, value_len, _, _ = _SHM_SLOT.unpack_from(self._mm,
+                    slot)
+            start = slot + _SHM_SLOT.size + key_len
+            if self._mm[start:start + value_len] != value:
+                return False
+            self._mm[slot:slot + 1] = _SHM_EMPTY
+            return True
+        finally:
+            self._unlock(bucket)
+
+    def close(self):
+        """Unmap and close the file. The cache can't be used afterwards."""
+        self._mm.close()
+        os.close(self._fd)
+
+class DiskCache(CachualCache):
+    """A persistent cache in a SQLite database, for results which are
+    expensive enough to keep across restarts (or when there is no cache
+    server). Any number of threads and processes can share the same file:
+    the database uses write-ahead logging, so readers never wait for writers,
+    and is read through a memory map of ``mmap_size`` bytes.
+
+    Puts are buffered in process and written in a single transaction once
+    ``batch_size`` of them are waiting or ``flush_interval`` seconds after
+    the first one, so other processes see them after at most that long (the
+    process which put them sees them straight away). Batches are written by a
+    single background thread, over one connection which is kept for all of
+    the cache's writes. The times entries are read, which eviction is based
+    on, are kept in process and written with the next batch of puts (or once
+    :attr:`access_batch_size` of them are waiting), so reads alone rarely
+    write to the database. Call :meth:`flush` to write them at once; this is
+    also done when the interpreter exits.
+
+    When the keys and values take up more than ``max_bytes``, expired
+    entries and then the least recently read ones are evicted until they
+    take up 90% of it. Values are returned as they were put if they are
+    bytes or unicode strings; anything else is stored as its unicode string.
+
+    :type path: string
+    :param path: The path of the database file.
+
+    :type max_bytes: integer
+    :param max_bytes: The maximum total size of the keys and values in bytes.
+
+    :type mmap_size: integer
+    :param mmap_size: How much of the database to read through a memory map,
+                      in bytes (SQLite's ``mmap_size``).
+
+    :type batch_size: integer
+    :param batch_size: How many puts to buffer before writing them. 1 writes
+                       every put straight away.
+
+    :type flush_interval: float
+    :param flush_interval: How long in seconds puts are buffered for at
+                           most.
+
+    :type timeout: float
+    :param timeout: How long in seconds to wait for another process which is
+                    writing to the database.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionadded:: 0.3.0
+    """
+    returns_text = True
+
+    #: The number of read times kept in process before they are written
+    #: without waiting for a put.
+    access_batch_size = 10000
+
+    def __init__(self, path, max_bytes=1 << 30, mmap_size=1 << 28,
+            batch_size=100, flush_interval=0.05, timeout=10, **kwargs):
+        if sqlite3 is None:
+            raise ImportError("DiskCache requires sqlite3")
+        super(DiskCache, self).__init__(**kwargs)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_size = mmap_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._pending = {}
+        self._accessed = {}
+        self._flusher = None
+        with self._write_lock:
+            conn = self._write_connection()
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(_DISK_SCHEMA)
+        # Weak, so that the hook doesn't keep the cache alive.
+        atexit.register(partial(_flush_disk_cache, weakref.ref(self)))
+
+    def _open(self):
+        """Internal function to open a connection to the database."""
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+        # So that replacing a row runs the delete trigger, which keeps the
+        # total size up to date.
+        conn.execute('PRAGMA recursive_triggers = ON')
+        return conn
+
+    def _connection(self):
+        """Internal function to get this thread's connection to the database
+        for reads, opening it if needed (including after a fork, since
+        connections can't be shared between processes)."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self._open()
+            local.pid = os.getpid()
+        return local.conn
+
+    def _write_connection(self):
+        """Internal function to get the connection used for every write,
+        opening it if needed (as with :meth:`_connection`). The caller must
+        hold the write lock."""
+        if self._writer_pid != os.getpid():
+            self._writer = self._open()
+            self._writer_pid = os.getpid()
+        return self._writer
+
+    def _transaction(self, fn):
+        """Internal function to call fn with the write connection in a write
+        transaction, which is committed if fn returns and rolled back if it
+        raises. The caller must hold the write lock."""
+        conn = self._write_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(conn)
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return result
+
+    def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        key = _unicode(key)
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(key)
+        if entry is None:
+            entry = self._connection().execute(
+                    'SELECT value, kind, expires FROM cachual WHERE key = ?',
+                    (key,)).fetchone()
+            if entry is None:
+                return None
+            with self._lock:
+                self._accessed[key] = now
+                if len(self._accessed) >= self.access_batch_size:
+                    self._start_flusher()
+        value, kind, expires = entry[:3]
+        if expires is not None and expires <= now:
+            return None
+        value = bytes(value)
+        return value.decode('utf-8') if kind else value
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key. The value is buffered
+        and written with the next batch.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self.put_many({key: value}, ttl)
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the cache, buffering them to be written
+        with the next batch.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: float
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with self._lock:
+            for key, value in values.items():
+                key = _unicode(key)
+                self._pending[key] = _disk_entry(key, value, expires, now)
+        self._schedule_flush()
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the cache only if the key does not already exist
+        (or has expired). Unlike **put**, the value is written straight away,
+        so that only one process can add it.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        key = _unicode(key)
+        now = time.time()
+        entry = _disk_entry(key, value, None if ttl is None else now + ttl,
+                now)
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None and (pending[2] is None or pending[2] > now):
+            return False
+
+        def add(conn):
+            conn.execute('DELETE FROM cachual WHERE key = ? AND '
+                    'expires <= ?', (key, now))
+            cursor = conn.execute('INSERT OR IGNORE INTO cachual (key, '
+                    'value, kind, expires, accessed, size) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (key,) + entry)
+            return cursor.rowcount == 1
+        with self._write_lock:
+            return self._transaction(add)
+
+    def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        key = _unicode(key)
+        with self._write_lock:
+            with self._lock:
+                self._pending.pop(key, None)
+                self._accessed.pop(key, None)
+            self._write_connection().execute('DELETE FROM cachual WHERE '
+                    'key = ?', (key,))
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        key = _unicode(key)
+        value = _to_bytes(value)
+        with self._write_lock:
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    if bytes(pending[0]) != value:
+                        return False
+                    del self._pending[key]
+            if pending is not None:
+                # The stored row is older than the pending put, so it goes.
+                self._write_connection().execute('DELETE FROM cachual WHERE '
+                        'key = ?', (key,))
+                return True
+            cursor = self._write_connection().execute('DELETE FROM cachual '
+                    'WHERE key = ? AND value = ? AND (expires IS NULL OR '
+                    'expires > ?)', (key, sqlite3.Binary(value), time.time()))
+            return cursor.rowcount == 1
+
+    def flush(self):
+        """Write the buffered puts (and read times) in a single transaction,
+        evicting entries if the cache has grown too large."""
+        with self._write_lock:
+            with self._lock:
+                pending = dict(self._pending)
+                accessed, self._accessed = self._accessed, {}
+            if not pending and not accessed:
+                return
+
+            def write(conn):
+                conn.executemany('INSERT OR REPLACE INTO cachual (key, '
+                        'value, kind, expires, accessed, size) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        [(key,) + entry for key, entry in pending.items()])
+                conn.executemany('UPDATE cachual SET accessed = ? '
+                        'WHERE key = ?',
+                        [(t, key) for key, t in accessed.items()
+                         if key not in pending])
+                self._evict(conn)
+            self._transaction(write)
+            with self._lock:
+                # Keep anything which was put again while writing.
+                for key, entry in pending.items():
+                    if self._pending.get(key) is entry:
+                        del self._pending[key]
+
+    def _schedule_flush(self):
+        """Internal function to flush the buffer if it is full, or else make
+        sure that it is flushed within ``flush_interval`` seconds. Errors
+        are logged."""
+        with self._lock:
+            full = len(self._pending) >= self.batch_size
+            if not full:
+                self._start_flusher()
+        if full:
+            self._flush_logged()
+
+    def _start_flusher(self):
+        """Internal function to wake the flusher thread, starting it if it
+        isn't running (e.g. after a fork). The caller must hold the lock."""
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=_run_disk_flusher,
+                    args=(weakref.ref(self),), name="cachual-disk-flush")
+            self._flusher.daemon = True
+            self._flusher.start()
+        self._wakeup.notify_all()
+
+    def _flush_when_due(self):
+        """Internal function run in a loop by the flusher thread: wait for
+        puts (or ``access_batch_size`` read times) to be buffered, and flush
+        them ``flush_interval`` seconds later. Returns False once the thread
+        should exit, and True after each flush or after waiting idle for
+        ``_DISK_FLUSHER_IDLE`` seconds."""
+        me = threading.current_thread()
+        with self._lock:
+            if not self._flush_due():
+                self._wakeup.wait(_DISK_FLUSHER_IDLE)
+                if self._flusher is not me or not self._flush_due():
+                    return self._flusher is me
+            deadline = _now() + self.flush_interval
+            remaining = self.flush_interval
+            while remaining > 0 and self._flusher is me:
+                self._wakeup.wait(remaining)
+                remaining = deadline - _now()
+            if self._flusher is not me:
+                return False
+        self._flush_logged()
+        return True
+
+    def _flush_due(self):
+        """Internal function to check whether there is anything for the
+        flusher thread to write. The caller must hold the lock."""
+        return (bool(self._pending) or
+                len(self._accessed) >= self.access_batch_size)
+
+    def _flush_logged(self):
+        """Internal function to flush the buffer, logging any error."""
+        try:
+            self.flush()
+        except:
+            self.logger.warn("Error writing to %s", self.path, exc_info=1)
+
+    def _evict(self, conn):
+        """Internal function to evict expired and then least recently read
+        entries (in a write transaction) if the cache is larger than
+        ``max_bytes``."""
+        size = conn.execute('SELECT size FROM cachual_size').fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        conn.execute('DELETE FROM cachual WHERE expires <= ?', (time.time(),))
+        size = conn.execute('SELECT size FROM cachual_size').fetchone()[0]
+        target = self.max_bytes * 0.9
+        victims = []
+        for key, entry_size in conn.execute(
+                'SELECT key, size FROM cachual ORDER BY accessed'):
+            if size <= target:
+                break
+            victims.append((key,))
+            size -= entry_size
+        conn.executemany('DELETE FROM cachual WHERE key = ?', victims)
+        self.logger.debug("evicted %d entries from %s", len(victims),
+                self.path)
+
+    def close(self):
+        """Write the buffered puts, stop the flusher thread and close the
+        write connection and this thread's connection."""
+        with self._lock:
+            flusher, self._flusher = self._flusher, None
+            self._wakeup.notify_all()
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+        self.flush()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = self._writer_pid = None
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.pid = None
+
+# How long (in seconds) the flusher thread of a DiskCache waits for puts
+# before checking whether the cache has been garbage collected.
+_DISK_FLUSHER_IDLE = 1
+
+def _run_disk_flusher(ref):
+    """Helper function run by the flusher thread of a :class:`DiskCache`. It
+    only holds a weak reference to the cache between flushes, so that the
+    thread exits once the cache is closed or garbage collected."""
+    while True:
+        cache = ref()
+        if cache is None or not cache._flush_when_due():
+            return
+        del cache
+
+def _flush_disk_cache(ref):
+    """Helper function to flush a :class:`DiskCache` (if it is still alive)
+    when the interpreter exits."""
+    cache = ref()
+    if cache is not None:
+        cache._flush_logged()
+
+def _disk_entry(key, value, expires, now):
+    """Helper function to return the columns of a :class:`DiskCache` entry
+    after its key: the value, its kind (0 for bytes and 1 for unicode
+    strings), the expiry and read times, and the size of the key and
+    value."""
+    kind = 0 if isinstance(value, bytes) else 1
+    value = _to_bytes(value)
+    size = len(_to_bytes(key)) + len(value)
+    return sqlite3.Binary(value), kind, expires, now, size
+
+class BatchingCache(CachualCache):
+    """A cache which transparently batches concurrent **get** calls from
+    different threads into a single **get_many** on another
+    :class:`CachualCache` (e.g. a single ``MGET`` for a :class:`RedisCache`).
+
+    The first **get** to arrive opens a batch and waits up to ``window``
+    seconds (or until ``max_batch_size`` distinct keys have joined) for other
+    threads to join it; it then fetches every key in the batch in one round
+    trip and hands each waiting thread its value. This trades up to
+    ``window`` seconds of extra latency on each **get** for far fewer round
+    trips when many threads are reading at once. All other operations are
+    passed straight through.
+
+    :type backend: CachualCache
+    :param backend: The cache to batch **get** calls for.
+
+    :type window: float
+    :param window: How long in seconds a batch stays open for other threads
+                   to join it.
+
+    :type max_batch_size: integer
+    :param max_batch_size: The maximum number of distinct keys in a batch. A
+                           full batch is fetched immediately.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+
+    .. versionadded:: 0.3.0
+    """
+    def __init__(self, backend, window=0.001, max_batch_size=100, **kwargs):
+        super(BatchingCache, self).__init__(**kwargs)
+        self.backend = backend
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._batch = None
+
+    @property
+    def returns_text(self):
+        return self.backend.returns_text
+
+    @property
+    def stores_objects(self):
+        return self.backend.stores_objects
+
+    def get(self, key):
+        """Get a value from the cache as part of the current batch.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.keys[key] = True
+            if len(batch.keys) >= self.max_batch_size:
+                # Close the batch so that later arrivals start a new one.
+                self._batch = None
+                batch.full.set()
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.values.get(key)
+
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+        try:
+            batch.values = self.backend.get_many(list(batch.keys))
+        except BaseException as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+        return batch.values.get(key)
+
+    def put(self, key, value, ttl=None):
+        """Put a value into the backend cache.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        self.backend.put(key, value, ttl)
+
+    def get_many(self, keys):
+        """Get the values for several keys from the backend cache directly,
+        without batching.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        return self.backend.get_many(keys)
+
+    def put_many(self, values, ttl=None):
+        """Put several values into the backend cache.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        self.backend.put_many(values, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the backend cache only if the key does not already
+        exist.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        return self.backend.add(key, value, ttl)
+
+    def delete(self, key):
+        """Remove the given key from the backend cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self.backend.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the backend cache only if it has the
+        given value.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        return self.backend.delete_if_equal(key, value)
+
+class _Batch(object):
+    """Internal record of a batch of keys being collected by
+    :class:`BatchingCache`."""
+    __slots__ = ('keys', 'full', 'done', 'values', 'error')
+
+    def __init__(self):
+        self.keys = OrderedDict()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.values = {}
+        self.error = None
+
+class ShardedCache(CachualCache):
+    """A cache which spreads keys over several other caches (nodes), e.g. a
+    :class:`RedisCache` per Redis server, to add up their capacity and
+    throughput.
 
-    :type port: integer
-    :param port: The port to use for the Redis server.
+    Each key is routed to a node with a consistent hash ring: every node is
+    placed on the ring at ``vnodes`` points derived from its name, and a key
+    belongs to the first node after the key's own hash. Adding or removing a
+    node thus only moves the keys between it and its neighbours, about 1/N of
+    all keys. The ring only depends on the names of the nodes, so every
+    process with the same names routes keys the same way.
 
-    :type db: integer
-    :param db: The Redis database to use on the server for the cache.
+    **get_many** and **put_many** are split into one call per node, which run
+    in parallel on a pool of threads.
+
+    A node whose operation raises an exception is ejected from the ring for
+    ``retry_delay`` seconds, during which its keys are routed to the next node
+    on the ring, and is then tried again. The exception is still raised (and,
+    as usual, logged and ignored by :meth:`~CachualCache.cached`), except by
+    **get_many** and **put_many**, which log it and carry on with the other
+    nodes.
+
+    :type nodes: dict
+    :param nodes: A dictionary mapping the name of each node (e.g. its
+                  ``host:port``) to its :class:`CachualCache`.
+
+    :type vnodes: integer
+    :param vnodes: The number of points on the ring for each node. More
+                   points spread the keys more evenly.
+
+    :type retry_delay: float
+    :param retry_delay: How long in seconds a failed node is ejected for.
 
     :type kwargs: dict
     :param kwargs: Any additional args to pass to the :class:`CachualCache`
                    constructor.
+
+    .. versionadded:: 0.3.0
     """
-    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
-        super(RedisCache, self).__init__(**kwargs)
-        self.client = StrictRedis(host=host, port=port, db=db)
+    def __init__(self, nodes, vnodes=160, retry_delay=30, **kwargs):
+        super(ShardedCache, self).__init__(**kwargs)
+        if not nodes:
+            raise ValueError("ShardedCache needs at least one node")
+        self.nodes = dict(nodes)
+        self.vnodes = vnodes
+        self.retry_delay = retry_delay
+        self._ejected = {}
+        self._executor = None
+
+        points = []
+        for name in self.nodes:
+            for i in range(vnodes):
+                points.append((_ring_hash('%s-%d' % (name, i)), name))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._names = [point[1] for point in points]
+
+    @property
+    def returns_text(self):
+        return all(node.returns_text for node in self.nodes.values())
+
+    @property
+    def stores_objects(self):
+        return all(node.stores_objects for node in self.nodes.values())
 
     def get(self, key):
-        """Get a value from the cache using the given key.
+        """Get a value from the node for the key.
 
         :type key: string
         :param key: The cache key to get the value for.
@@ -192,15 +3966,10 @@ class RedisCache(CachualCache):
         :returns: The value for the cache key, or None in the case of cache
                   miss.
         """
-        return self.client.get(key)
+        return self._call(self.node_for(key), 'get', key)
 
     def put(self, key, value, ttl=None):
-        """Put a value into the cache at the given key. If the value is not a
-        string, its unicode value will be used. This behavior is defined by the
-        underlying Redis library, and could be subject to change in future
-        versions; thus it is safest to only store strings in Redis (although
-        basic types should serialize into a string cleanly, you will need to
-        unpack them when they are retrieved from the cache).
+        """Put a value into the node for the key.
 
         :type key: string
         :param key: The cache key to use for the value.
@@ -211,31 +3980,217 @@ class RedisCache(CachualCache):
         :param ttl: The time-to-live for key in seconds, after which it will
                     expire.
         """
-        self.client.set(key, value, ex=ttl)
+        self._call(self.node_for(key), 'put', key, value, ttl)
 
-class MemcachedCache(CachualCache):
-    """A cache using `Memcached <https://memcached.org/>`_ as the backing
-    cache. The same caveats apply to keys and values as for Redis - you should
-    only try to store strings (using the packing/unpacking functions). See the
-    documentation on Keys and Values here:
-    :class:`pymemcache.client.base.Client`.
+    def get_many(self, keys):
+        """Get the values for several keys with one **get_many** per node,
+        in parallel. Keys on nodes which fail are treated as misses.
 
-    :type host: string
-    :param host: The Memcached host to use for the cache.
+        :type keys: list
+        :param keys: The cache keys to get the values for.
 
-    :type port: integer
-    :param port: The port to use for the Memcached server.
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.node_for(key), []).append(key)
+        values = {}
+        for result in self._map('get_many', shards):
+            if result:
+                values.update(result)
+        return values
+
+    def put_many(self, values, ttl=None):
+        """Put several values with one **put_many** per node, in parallel.
+        Failures are logged.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        shards = {}
+        for key, value in values.items():
+            shards.setdefault(self.node_for(key), {})[key] = value
+        self._map('put_many', shards, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the node for the key only if the key does not
+        already exist.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        return self._call(self.node_for(key), 'add', key, value, ttl)
+
+    def delete(self, key):
+        """Remove the given key from its node.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        self._call(self.node_for(key), 'delete', key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from its node only if it has the given value.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        return self._call(self.node_for(key), 'delete_if_equal', key, value)
+
+    def node_for(self, key):
+        """Get the name of the node which the key is routed to: the first
+        node after the key on the ring which hasn't been ejected. If every
+        node has been ejected, the key's own node is used anyway.
+
+        :type key: string
+        :param key: The cache key.
+
+        :rtype: string
+        :returns: The name of the node.
+        """
+        i = bisect.bisect(self._hashes, _ring_hash(key))
+        if not self._ejected:
+            return self._names[i % len(self._names)]
+
+        now = _now()
+        for name, until in list(self._ejected.items()):
+            if until <= now:
+                self._ejected.pop(name, None)
+        n = len(self._names)
+        for j in range(i, i + n):
+            name = self._names[j % n]
+            if name not in self._ejected:
+                return name
+        return self._names[i % n]
+
+    def _call(self, name, method, *args):
+        """Internal function to call a method of a node, ejecting the node if
+        it fails."""
+        try:
+            return getattr(self.nodes[name], method)(*args)
+        except:
+            self.logger.warn("Ejecting cache node %s for %ss", name,
+                    self.retry_delay)
+            self._ejected[name] = _now() + self.retry_delay
+            raise
+
+    def _map(self, method, shards, *args):
+        """Internal function to call a multi-key method on each node with its
+        share of the keys, in parallel, returning the results of the calls
+        which didn't fail."""
+        def call(item):
+            try:
+                return self._call(item[0], method, item[1], *args)
+            except:
+                self.logger.warn("Error calling %s on cache node %s", method,
+                        item[0], exc_info=1)
+                return None
+        items = list(shards.items())
+        if len(items) < 2 or futures is None:
+            return [call(item) for item in items]
+        return list(self._get_executor().map(call, items))
+
+    def _get_executor(self):
+        """Internal function to get the thread pool for multi-key operations,
+        creating it on first use."""
+        if self._executor is None:
+            with _init_lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                            len(self.nodes))
+        return self._executor
+
+class WriteBehindCache(CachualCache):
+    """A cache which puts values into another :class:`CachualCache` in the
+    background, so that callers of a decorated function get its return value
+    without waiting for the put.
+
+    **put** adds the value to a bounded in-process queue and returns
+    immediately; a background thread takes up to ``batch_size`` queued values
+    at a time and writes them with a single **put_many** (a pipeline for
+    :class:`RedisCache`, a ``noreply`` ``set_many`` for
+    :class:`MemcachedCache`). Putting a key which is still queued replaces its
+    value. Until a value has been written, **get** returns it from the queue,
+    so a process always reads its own writes (as the backend would return it,
+    e.g. as bytes rather than the unicode string that was put).
+
+    Queued values are flushed when the interpreter exits; call
+    :meth:`~WriteBehindCache.flush` to wait for them to be written at any
+    other time. Values which are still queued when the process is killed are
+    lost, which is usually fine for a cache. **add** and **delete** are not
+    queued.
+
+    :type backend: CachualCache
+    :param backend: The cache to write to.
+
+    :type max_queue: integer
+    :param max_queue: The maximum number of keys waiting to be written.
+
+    :type batch_size: integer
+    :param batch_size: The maximum number of values written with each
+                       **put_many**.
+
+    :type drop_policy: string
+    :param drop_policy: What to do with a put when the queue is full:
+                        ``'newest'`` drops the new value, ``'oldest'`` drops
+                        the value which has been queued the longest to make
+                        room for it, and ``'block'`` waits for room (which
+                        gives up write-behind's latency benefit while the
+                        backend is falling behind).
 
     :type kwargs: dict
     :param kwargs: Any additional args to pass to the :class:`CachualCache`
                    constructor.
+
+    .. versionadded:: 0.3.0
     """
-    def __init__(self, host='localhost', port=11211, **kwargs):
-        super(MemcachedCache, self).__init__(**kwargs)
-        self.client = MemcachedClient((host, port))
+    #: How long (in seconds) to wait for queued values to be written when the
+    #: interpreter exits.
+    exit_flush_timeout = 5
+
+    def __init__(self, backend, max_queue=10000, batch_size=100,
+            drop_policy='newest', **kwargs):
+        super(WriteBehindCache, self).__init__(**kwargs)
+        if drop_policy not in ('newest', 'oldest', 'block'):
+            raise ValueError("Unknown drop_policy %r" % (drop_policy,))
+        self.backend = backend
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.drop_policy = drop_policy
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def returns_text(self):
+        return self.backend.returns_text
+
+    @property
+    def stores_objects(self):
+        return self.backend.stores_objects
 
     def get(self, key):
-        """Get a value from the cache using the given key.
+        """Get a value which is waiting to be written, or from the backend
+        cache.
 
         :type key: string
         :param key: The cache key to get the value for.
@@ -243,11 +4198,14 @@ class MemcachedCache(CachualCache):
         :returns: The value for the cache key, or None in the case of cache
                   miss.
         """
-        return self.client.get(key)
+        with self._cond:
+            entry = self._pending.get(key) or self._writing.get(key)
+        if entry is not None:
+            return self._as_returned(entry[0])
+        return self.backend.get(key)
 
     def put(self, key, value, ttl=None):
-        """Put a value into the cache at the given key. For constraints on keys
-        and values, see :class:`pymemcache.client.base.Client`.
+        """Queue a value to be put into the backend cache.
 
         :type key: string
         :param key: The cache key to use for the value.
@@ -258,9 +4216,545 @@ class MemcachedCache(CachualCache):
         :param ttl: The time-to-live for key in seconds, after which it will
                     expire.
         """
-        if ttl is None:
-            ttl = 0
-        self.client.set(key, value, expire=ttl)
+        self._enqueue({key: value}, ttl)
+
+    def get_many(self, keys):
+        """Get the values for several keys, from the queue where they are
+        waiting to be written and from the backend cache otherwise.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        values = {}
+        missing = []
+        with self._cond:
+            for key in keys:
+                entry = self._pending.get(key) or self._writing.get(key)
+                if entry is None:
+                    missing.append(key)
+                else:
+                    values[key] = self._as_returned(entry[0])
+        if missing:
+            values.update(self.backend.get_many(missing))
+        return values
+
+    def put_many(self, values, ttl=None):
+        """Queue several values to be put into the backend cache.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        self._enqueue(values, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Put a value into the backend cache only if the key does not already
+        exist (or is waiting to be written).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored.
+        """
+        with self._cond:
+            if key in self._pending or key in self._writing:
+                return False
+        return self.backend.add(key, value, ttl)
+
+    def delete(self, key):
+        """Remove the given key from the queue and the backend cache. If the
+        key is being written, wait for that first so that the write doesn't
+        overwrite the delete.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        with self._cond:
+            self._pending.pop(key, None)
+            while key in self._writing:
+                self._cond.wait()
+        self.backend.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """Remove the given key from the queue (if it is queued with the given
+        value) or else from the backend cache (if it has the given value
+        there).
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        with self._cond:
+            while key in self._writing:
+                self._cond.wait()
+            entry = self._pending.get(key)
+            if entry is not None:
+                if _to_bytes(entry[0]) != _to_bytes(value):
+                    return False
+                del self._pending[key]
+                return True
+        return self.backend.delete_if_equal(key, value)
+
+    def flush(self, timeout=None):
+        """Wait for every queued value to be written.
+
+        :type timeout: float
+        :param timeout: The maximum time to wait in seconds, or None to wait
+                        for as long as it takes.
+
+        :rtype: bool
+        :returns: True if everything was written, False if the timeout
+                  passed first.
+        """
+        deadline = None if timeout is None else _now() + timeout
+        with self._cond:
+            if self._pending or self._writing:
+                self._start_writer()
+            while self._pending or self._writing:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - _now()
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def _as_returned(self, value):
+        """Internal function to return a queued value as the backend would
+        return it once written: as bytes, unless the backend returns text."""
+        if self.backend.returns_text:
+            return value
+        return _to_bytes(value)
+
+    def _enqueue(self, values, ttl):
+        """Internal function to queue values, applying the drop policy when
+        the queue is full, and to start the writer thread if needed."""
+        with self._cond:
+            self._start_writer()
+            for key, value in values.items():
+                if key in self._pending:
+                    del self._pending[key]
+                elif len(self._pending) >= self.max_queue:
+                    if self.drop_policy == 'newest':
+                        self.logger.warn("Write-behind queue full, dropping "
+                                "put of [%s]", key)
+                        continue
+                    if self.drop_policy == 'oldest':
+                        dropped, _ = self._pending.popitem(last=False)
+                        self.logger.warn("Write-behind queue full, dropping "
+                                "put of [%s]", dropped)
+                    else:
+                        while len(self._pending) >= self.max_queue:
+                            # Wake the writer, so that it makes room.
+                            self._cond.notify_all()
+                            self._cond.wait()
+                        self._pending.pop(key, None)
+                self._pending[key] = (value, ttl)
+            self._cond.notify_all()
+
+    def _start_writer(self):
+        """Internal function to start the writer thread if it isn't running
+        (e.g. after a fork). The caller must hold the lock."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._thread is None:
+            # Weak, so that the hook doesn't keep the cache alive.
+            atexit.register(partial(_flush_write_behind_cache,
+                    weakref.ref(self)))
+        self._thread = threading.Thread(target=_run_write_behind,
+                args=(weakref.ref(self),), name="cachual-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_batch(self):
+        """Internal function run in a loop by the writer thread: wait for
+        queued values and write up to ``batch_size`` of them with
+        **put_many**. Returns without writing anything if nothing is queued
+        within ``_WRITE_BEHIND_IDLE`` seconds."""
+        with self._cond:
+            self._writing = {}
+            self._cond.notify_all()
+            if not self._pending:
+                self._cond.wait(_WRITE_BEHIND_IDLE)
+                if not self._pending:
+                    return
+            while self._pending and len(self._writing) < self.batch_size:
+                key, entry = self._pending.popitem(last=False)
+                self._writing[key] = entry
+            batch = self._writing
+
+        by_ttl = {}
+        for key, (value, ttl) in batch.items():
+            by_ttl.setdefault(ttl, {})[key] = value
+        for ttl, values in by_ttl.items():
+            try:
+                self.backend.put_many(values, ttl)
+            except:
+                self.logger.warn("Error writing %d values", len(values),
+                        exc_info=1)
+
+# How long (in seconds) the writer thread of a WriteBehindCache waits for puts
+# before checking whether the cache has been garbage collected.
+_WRITE_BEHIND_IDLE = 1
+
+def _run_write_behind(ref):
+    """Helper function run by the writer thread of a :class:`WriteBehindCache`.
+    It only holds a weak reference to the cache between batches, so that the
+    thread exits once the cache is garbage collected."""
+    while True:
+        cache = ref()
+        if cache is None:
+            return
+        cache._write_batch()
+        del cache
+
+def _flush_write_behind_cache(ref):
+    """Helper function to flush a :class:`WriteBehindCache` (if it is still
+    alive) when the interpreter exits."""
+    cache = ref()
+    if cache is not None:
+        cache.flush(cache.exit_flush_timeout)
+
+def _to_bytes(value):
+    """Helper function to return the value as bytes, encoding anything else as
+    its UTF-8 unicode value."""
+    if isinstance(value, bytes):
+        return value
+    return _unicode(value).encode('utf-8')
+
+def _ring_hash(value):
+    """Helper function to hash a key or node name onto the consistent hash
+    ring of a :class:`ShardedCache`."""
+    if not isinstance(value, bytes):
+        value = _unicode(value).encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+def _get_parameters(f):
+    """Helper function to return the parameters of the function's signature,
+    or None if it can't be inspected (e.g. on Python 2)."""
+    signature = getattr(inspect, 'signature', None)
+    if signature is None:
+        return None
+    try:
+        return list(signature(f).parameters.values())
+    except (TypeError, ValueError):
+        return None
+
+def _encode_key_arg(value):
+    """Helper function to encode an argument for a cache key, so that the
+    same argument gets the same encoding in every process, and different
+    arguments get different encodings. Strings are quoted, and other basic
+    types are encoded as their repr. Dictionaries and sets are encoded in
+    sorted order, so their (hash randomized) iteration order doesn't matter.
+    Objects can define a ``__cachual_key__`` method to return a value to
+    encode in their place; otherwise dataclasses are encoded field by field,
+    and functions and classes by name. Anything else is encoded as the name
+    of its type and its quoted unicode value, and :class:`UnstableKeyError`
+    is raised if that includes a memory address."""
+    cls = type(value)
+    encode = _KEY_SCALAR_ENCODERS.get(cls)
+    if encode is not None:
+        return encode(value)
+
+    hook = getattr(value, '__cachual_key__', None)
+    if hook is not None and not isinstance(value, type):
+        return _encode_key_arg(hook())
+
+    if isinstance(value, tuple):
+        items = [_encode_key_arg(v) for v in value]
+        fields = getattr(value, '_fields', None)
+        if fields is not None: # namedtuple
+            return '%s(%s)' % (cls.__name__, ', '.join(
+                    ['%s=%s' % f for f in zip(fields, items)]))
+        if len(items) == 1:
+            return '(%s,)' % items[0]
+        return '(%s)' % ', '.join(items)
+    if isinstance(value, list):
+        return '[%s]' % ', '.join([_encode_key_arg(v) for v in value])
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted([_encode_key_arg(k) + ': ' +
+                _encode_key_arg(v) for k, v in value.items()]))
+    if isinstance(value, (set, frozenset)):
+        name = 'frozenset' if isinstance(value, frozenset) else 'set'
+        if not value:
+            return name + '()'
+        items = '{%s}' % ', '.join(sorted(
+                [_encode_key_arg(v) for v in value]))
+        return items if name == 'set' else '%s(%s)' % (name, items)
+    if (dataclasses is not None and dataclasses.is_dataclass(value) and
+            not isinstance(value, type)):
+        return '%s(%s)' % (_qualname(cls), ', '.join(
+                ['%s=%s' % (f.name, _encode_key_arg(getattr(value, f.name)))
+                for f in dataclasses.fields(value)]))
+    if (inspect.isfunction(value) or inspect.isbuiltin(value) or
+            inspect.isclass(value)):
+        return '%s.%s' % (value.__module__, _qualname(value))
+
+    text = _text(value)
+    if _ADDRESS_RE.search(text):
+        raise UnstableKeyError("Can't build a stable cache key from %s: its "
+                "representation includes a memory address. Define "
+                "__cachual_key__ on %s, or use use_class_for_self for "
+                "methods." % (text, cls.__name__))
+    return '%s(%s)' % (_qualname(cls), _quote_key_text(text))
+
+def _key_default(parameter):
+    """Helper function to return the value to use in cache keys for the
+    default of a parameter, when a call doesn't pass it: the default itself,
+    or if that can't be encoded into a stable key (e.g. a sentinel
+    ``object()``), an :class:`_OmittedDefault` naming the parameter."""
+    try:
+        _encode_key_arg(parameter.default)
+    except UnstableKeyError:
+        return _OmittedDefault(parameter.name)
+    return parameter.default
+
+class _OmittedDefault(object):
+    """Internal placeholder for a default which can't be encoded into a
+    cache key. It is encoded as ``<default name>``, which no argument can be
+    encoded as (strings are quoted, and other encodings start with a digit, a
+    bracket, a quote or a name)."""
+    __slots__ = ('text',)
+
+    def __init__(self, name):
+        self.text = '<default %s>' % name
+
+def _qualname(obj):
+    """Helper function to return the qualified name of a class or function,
+    falling back to its name on Python 2."""
+    return getattr(obj, '__qualname__', obj.__name__)
+
+def _warn_unstable_key(cached_function, error):
+    """Helper function to log that calls to a decorated function aren't
+    cached because their arguments can't be encoded into a stable key. This is
+    logged once per function, since it is usually true of every call."""
+    if cached_function.warned_unstable_key:
+        return
+    cached_function.warned_unstable_key = True
+    cached_function.cache.logger.warn("Not caching calls to %s: %s",
+            cached_function.f.__name__, error)
+
+def _wrap_function(f, cached_function):
+    """Helper function to wrap an internal cached function implementation so
+    that it looks like the decorated function."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        return cached_function(*args, **kwargs)
+    decorated.invalidate = cached_function.invalidate
+    decorated.invalidate_all = cached_function.invalidate_all
+    return decorated
+
+def _get_packers(cache, pack, unpack, codec):
+    """Helper function to return the (pack, unpack) functions to use for a
+    decorated function: the given functions, or those of the given codec, or
+    those of the cache's default codec if neither is given."""
+    if codec is not None:
+        if pack is not None or unpack is not None:
+            raise ValueError("codec can't be used with pack or unpack")
+    elif pack is None and unpack is None:
+        codec = cache.codec
+    if codec is None:
+        return pack, unpack
+    codec = get_codec(codec)
+    return codec.pack, codec.unpack
+
+def _get_compressor(cache, compress):
+    """Helper function to return the compressor to use for a decorated
+    function, or None if values shouldn't be compressed."""
+    if compress is None:
+        compress = cache.compress
+    if compress is None or compress is False:
+        return None
+    return get_compressor(compress)
+
+def _decompress(raw, compressor=None, text=False):
+    """Helper function to decompress a value from the cache which was
+    compressed with :meth:`Compressor.pack`, by the given compressor or a
+    registered one. Anything else (including values which merely look
+    compressed) is returned as is. Decompressed values are bytes, unless
+    text is True (see :attr:`CachualCache.returns_text`) and they were
+    compressed from text."""
+    if not isinstance(raw, bytes) or not raw.startswith(_COMPRESSED_MARKER):
+        return raw
+    compressor_id, kind = raw[1:2], raw[2:3]
+    if compressor is None or compressor.id != compressor_id:
+        compressor = _COMPRESSORS_BY_ID.get(compressor_id)
+    if compressor is None or kind not in (_COMPRESSED_BYTES,
+            _COMPRESSED_TEXT):
+        return raw
+    try:
+        data = compressor.decompress(raw[3:])
+        if text and kind == _COMPRESSED_TEXT:
+            return data.decode('utf-8')
+        return data
+    except Exception:
+        return raw
+
+def _wrap_value(value, meta):
+    """Helper function to store metadata (a dict which can be serialized as
+    JSON) alongside a packed value. Bytes are stored as is; anything else is
+    stored as its UTF-8 encoded unicode value."""
+    if isinstance(value, bytes):
+        meta['t'] = 'b'
+        payload = value
+    else:
+        meta['t'] = 's'
+        payload = _unicode(value).encode('utf-8')
+    header = json.dumps(meta, separators=(',', ':'), sort_keys=True)
+    return _ENVELOPE_MARKER + header.encode('utf-8') + b'\n' + payload
+
+class _MetaValue(object):
+    """Internal pairing of a packed value with its metadata, stored as is in
+    caches which store objects (see :attr:`CachualCache.stores_objects`)
+    instead of a value wrapped by :func:`_wrap_value`."""
+    __slots__ = ('value', 'meta')
+
+    def __init__(self, value, meta):
+        self.value = value
+        self.meta = meta
+
+def _unwrap_value(raw, text=False):
+    """Helper function to split a value from the cache into the packed value
+    and its metadata, which may also have been stored as a
+    :class:`_MetaValue`. Values which weren't stored with either are returned
+    as is, with None for the metadata. Packed values come back
+    as bytes, as they would from Redis or Memcached without the metadata,
+    unless text is True (see :attr:`CachualCache.returns_text`) and they
+    were packed as text."""
+    if not isinstance(raw, bytes) or not raw.startswith(_ENVELOPE_MARKER):
+        if type(raw) is _MetaValue:
+            return raw.value, raw.meta
+        return raw, None
+    end = raw.find(b'\n')
+    if end < 0:
+        return raw, None
+    try:
+        meta = json.loads(raw[1:end].decode('utf-8'))
+    except ValueError:
+        return raw, None
+    if not isinstance(meta, dict) or 't' not in meta:
+        return raw, None
+    payload = raw[end + 1:]
+    if text and meta['t'] == 's':
+        payload = payload.decode('utf-8')
+    return payload, meta
+
+def _get_namespace(f, namespace):
+    """Helper function to return the namespace of a decorated function: the
+    given namespace, or the function's own if it is True."""
+    if namespace is True:
+        return '%s.%s' % (f.__module__, _qualname(f))
+    return namespace or None
+
+def _generation_key(namespace):
+    """Helper function to return the key the generation of a namespace is
+    stored at. The namespace is hashed, as value keys are, so that any
+    namespace makes a valid key for every cache (e.g. Memcached)."""
+    return 'cachual:generation:' + _hash_name(namespace)
+
+def _new_generation():
+    """Helper function to return a new, random generation for a namespace.
+    Random rather than incrementing generations mean that if the generation
+    is evicted from the cache, the values of old generations aren't
+    resurrected."""
+    return '%012x' % random.getrandbits(48)
+
+def _tag_key(tag):
+    """Helper function to return the key the version of a tag is stored at;
+    the tag is hashed as in :func:`_generation_key`."""
+    return 'cachual:tag:' + _hash_name(tag)
+
+def _hash_name(name):
+    """Helper function to return the MD5 of a namespace or tag as hex."""
+    return hashlib.md5(_unicode(name).encode('utf-8')).hexdigest()
+
+def _decode_generation(generation):
+    """Helper function to return a generation read from the cache as a
+    unicode string."""
+    if isinstance(generation, bytes):
+        return generation.decode('utf-8')
+    return _unicode(generation)
+
+def _versioned_key(key, generation):
+    """Helper function to fold the generation of a namespace into a key."""
+    return key + ':' + generation
+
+def _chunk_value(data, chunk_size, items):
+    """Helper function to split data into chunks of at most chunk_size bytes,
+    adding them to the items under keys of their own. Returns the manifest to
+    store at the key of the data: the chunked marker followed by the number
+    of chunks, the CRC-32 and length of the data, and a random nonce which the
+    keys of the chunks are made from, so that chunks of different puts are
+    never mixed up."""
+    count = (len(data) + chunk_size - 1) // chunk_size
+    nonce = ('%016x' % random.getrandbits(64)).encode('ascii')
+    manifest = (_CHUNKED_MARKER + _CHUNKED_MANIFEST.pack(count,
+            zlib.crc32(data) & 0xFFFFFFFF, len(data)) + nonce)
+    view = memoryview(data)
+    for i, key in enumerate(_chunk_keys(_read_manifest(manifest))):
+        items[key] = view[i * chunk_size:(i + 1) * chunk_size].tobytes()
+    return manifest
+
+def _read_manifest(value):
+    """Helper function to parse a manifest written by :func:`_chunk_value`
+    into a (count, checksum, length, nonce) tuple, or return None if the value
+    isn't one."""
+    if (not isinstance(value, bytes) or
+            len(value) != _CHUNKED_MANIFEST_LENGTH or
+            value[:1] != _CHUNKED_MARKER):
+        return None
+    header = _CHUNKED_MANIFEST.unpack_from(value, 1)
+    return header + (value[1 + _CHUNKED_MANIFEST.size:].decode('ascii'),)
+
+def _chunk_keys(manifest):
+    """Helper function to return the keys of the chunks described by a
+    manifest."""
+    count, _, _, nonce = manifest
+    return ['cachual:chunk:%s:%d' % (nonce, i) for i in range(count)]
+
+def _assemble_chunks(manifest, chunks):
+    """Helper function to reassemble the data described by a manifest from
+    its chunks (a dictionary of key to chunk) into a single preallocated
+    buffer. Returns None if a chunk is missing or the data is torn."""
+    _, checksum, length, _ = manifest
+    data = bytearray(length)
+    view = memoryview(data)
+    position = 0
+    for key in _chunk_keys(manifest):
+        chunk = chunks.get(key)
+        if chunk is None or position + len(chunk) > length:
+            return None
+        view[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    if position != length or zlib.crc32(data) & 0xFFFFFFFF != checksum:
+        return None
+    return bytes(data)
+
+def _new_lease_token():
+    """Helper function to return a random token which identifies the holder
+    of a lease."""
+    return '%016x' % random.getrandbits(64)
+
+def _lease_key(key):
+    """Helper function to return the key used for the recompute lease of the
+    given cache key."""
+    return key + ':lease'
 
 def pack_json(value):
     """Pack the given JSON structure for storage in the cache by dumping it as
@@ -354,6 +4848,326 @@ def unpack_bool(value):
          return False
     raise ValueError("Cannot convert %s to bool" % value)
 
+class Codec(_ABC):
+    """Base class for codecs, which convert values to and from bytes for
+    storage in the cache. Codecs can be passed to
+    :meth:`~CachualCache.cached` (or to any cache as its default) in place of
+    separate pack and unpack functions.
+
+    Subclasses should set **name**, a unique name to look the codec up by,
+    and **id**, a unique single byte; and must define **dumps**, which takes
+    a value and returns it as bytes, and **loads**, which does the opposite.
+    Packed values start with a header which includes the id of their codec.
+    A codec only unpacks its own values: those packed by any other codec
+    (which might not be safe to unpack, e.g. with pickle) are rejected, so a
+    cache which is read with the JSON codec never unpickles a value.
+
+    .. versionadded:: 0.3.0
+    """
+    #: The name of the codec.
+    name = None
+
+    #: The single byte identifying the codec in packed values.
+    id = None
+
+    @abc.abstractmethod
+    def dumps(self, value):
+        """Convert the value to bytes.
+
+        :param value: The value to convert.
+
+        :rtype: bytes
+        :returns: The value as bytes.
+        """
+
+    @abc.abstractmethod
+    def loads(self, data):
+        """Convert bytes returned by :meth:`dumps` back into a value.
+
+        :type data: bytes
+        :param data: The bytes to convert.
+
+        :returns: The value.
+        """
+
+    def pack(self, value):
+        """Pack the value for storage in the cache, with a header naming this
+        codec.
+
+        :param value: The value to pack.
+
+        :rtype: bytes
+        :returns: The packed value.
+        """
+        return _CODEC_MARKER + self.id + self.dumps(value)
+
+    def unpack(self, value):
+        """Unpack a value from the cache which was packed by this codec.
+        Values without a header (e.g. those put before the codec was in use)
+        are also unpacked with this codec.
+
+        :type value: bytes
+        :param value: The value to unpack.
+
+        :returns: The unpacked value.
+
+        :raises ValueError: If the value was packed by a different codec.
+                            Decorated functions treat this as a cache miss.
+        """
+        if isinstance(value, bytes) and value.startswith(_CODEC_MARKER):
+            codec_id = value[1:2]
+            if codec_id != self.id:
+                raise ValueError("Value was packed by codec %r, not %r" % (
+                        codec_id, self.id))
+            return self.loads(value[2:])
+        return self.loads(value)
+
+class JSONCodec(Codec):
+    """A codec which stores values as compact JSON. Only JSON types (dicts,
+    lists, strings, numbers, booleans and None) are supported, and tuples come
+    back as lists.
+
+    .. versionadded:: 0.3.0
+    """
+    name = 'json'
+    id = b'j'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+class PickleCodec(Codec):
+    """A codec which stores values with :mod:`pickle`, using the highest
+    protocol available by default. Any picklable value (e.g. datetimes,
+    tuples, bytes and your own classes) round trips with its type, and
+    encoding and decoding are several times faster than JSON.
+
+    Since unpickling can execute arbitrary code, only use this codec with a
+    cache which can't be written to by untrusted parties.
+
+    :type protocol: integer
+    :param protocol: The pickle protocol to use. Every process reading the
+                     cache must support it.
+
+    .. versionadded:: 0.3.0
+    """
+    name = 'pickle'
+    id = b'p'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+_CODECS = {}
+
+def register_codec(codec):
+    """Register a codec so that it can be looked up by name.
+
+    :type codec: Codec
+    :param codec: The codec to register. It replaces any codec registered
+                  with the same name.
+
+    .. versionadded:: 0.3.0
+    """
+    if not isinstance(codec.id, bytes) or len(codec.id) != 1:
+        raise ValueError("Codec id must be a single byte")
+    _CODECS[codec.name] = codec
+
+def get_codec(codec):
+    """Look up a registered codec by name. Codec instances are returned as
+    is.
+
+    :type codec: Codec or string
+    :param codec: The codec, or its name.
+
+    :rtype: Codec
+    :returns: The codec.
+
+    .. versionadded:: 0.3.0
+    """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return _CODECS[codec]
+    except KeyError:
+        raise ValueError("Unknown codec %r" % (codec,))
+
+register_codec(JSONCodec())
+register_codec(PickleCodec())
+
+class Compressor(_ABC):
+    """Base class for compressors, which compress packed values before they
+    are put into the cache. Compressors can be passed to
+    :meth:`~CachualCache.cached` (or to any cache as its default) with the
+    ``compress`` parameter.
+
+    Subclasses should set **name**, a unique name to look the compressor up
+    by, and **id**, a unique single byte; and must define **compress** and
+    **decompress**. Compressed values start with a header which includes the
+    id of their compressor, so they can be decompressed as long as it is the
+    compressor in use or is registered with :func:`register_compressor`.
+
+    :type threshold: integer
+    :param threshold: Values smaller than this many bytes are stored
+                      uncompressed, since compressing them saves little (or
+                      even makes them larger).
+
+    .. versionadded:: 0.3.0
+    """
+    #: The name of the compressor.
+    name = None
+
+    #: The single byte identifying the compressor in compressed values.
+    id = None
+
+    def __init__(self, threshold=1024):
+        self.threshold = threshold
+
+    @abc.abstractmethod
+    def compress(self, data):
+        """Compress the data.
+
+        :type data: bytes
+        :param data: The data to compress.
+
+        :rtype: bytes
+        :returns: The compressed data.
+        """
+
+    @abc.abstractmethod
+    def decompress(self, data):
+        """Decompress data returned by :meth:`compress`.
+
+        :type data: bytes
+        :param data: The data to decompress.
+
+        :rtype: bytes
+        :returns: The decompressed data.
+        """
+
+    def pack(self, value):
+        """Compress a packed value, with a header naming this compressor, if
+        it is at least as large as the threshold. Values which aren't bytes
+        are compressed as their UTF-8 encoded unicode value, and the header
+        records that, so they come back from the cache as the same type as
+        uncompressed values would (see :attr:`CachualCache.returns_text`).
+        Smaller values are returned as is.
+
+        :param value: The packed value.
+
+        :returns: The value to put into the cache.
+        """
+        if isinstance(value, bytes):
+            data, kind = value, _COMPRESSED_BYTES
+        else:
+            data, kind = _unicode(value).encode('utf-8'), _COMPRESSED_TEXT
+        if len(data) < self.threshold:
+            return value
+        return _COMPRESSED_MARKER + self.id + kind + self.compress(data)
+
+class ZlibCompressor(Compressor):
+    """A compressor using :mod:`zlib`, which is always available.
+
+    :type level: integer
+    :param level: The compression level, from 1 (fastest) to 9 (smallest).
+
+    :type threshold: integer
+    :param threshold: As for :class:`Compressor`.
+
+    .. versionadded:: 0.3.0
+    """
+    name = 'zlib'
+    id = b'z'
+
+    def __init__(self, level=6, threshold=1024):
+        super(ZlibCompressor, self).__init__(threshold)
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class LZ4Compressor(Compressor):
+    """A compressor using `LZ4 <https://python-lz4.readthedocs.io/>`_, which
+    compresses and decompresses several times faster than zlib at the cost of
+    larger output. Requires the ``lz4`` package; it is only registered (as
+    ``'lz4'``) if that is installed.
+
+    :type level: integer
+    :param level: The compression level; 0 is the fastest.
+
+    :type threshold: integer
+    :param threshold: As for :class:`Compressor`.
+
+    .. versionadded:: 0.3.0
+    """
+    name = 'lz4'
+    id = b'4'
+
+    def __init__(self, level=0, threshold=1024):
+        if lz4_frame is None:
+            raise ImportError("LZ4Compressor requires the lz4 package")
+        super(LZ4Compressor, self).__init__(threshold)
+        self.level = level
+
+    def compress(self, data):
+        return lz4_frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(data)
+
+_COMPRESSORS = {}
+_COMPRESSORS_BY_ID = {}
+
+def register_compressor(compressor):
+    """Register a compressor so that it can be looked up by name, and so that
+    values compressed with it can be decompressed.
+
+    :type compressor: Compressor
+    :param compressor: The compressor to register. It replaces any compressor
+                       registered with the same name or id.
+
+    .. versionadded:: 0.3.0
+    """
+    if not isinstance(compressor.id, bytes) or len(compressor.id) != 1:
+        raise ValueError("Compressor id must be a single byte")
+    _COMPRESSORS[compressor.name] = compressor
+    _COMPRESSORS_BY_ID[compressor.id] = compressor
+
+def get_compressor(compressor):
+    """Look up a registered compressor by name. Compressor instances are
+    returned as is.
+
+    :type compressor: Compressor or string
+    :param compressor: The compressor, or its name.
+
+    :rtype: Compressor
+    :returns: The compressor.
+
+    .. versionadded:: 0.3.0
+    """
+    if isinstance(compressor, Compressor):
+        return compressor
+    try:
+        return _COMPRESSORS[compressor]
+    except KeyError:
+        raise ValueError("Unknown compressor %r" % (compressor,))
+
+register_compressor(ZlibCompressor())
+if lz4_frame is not None:
+    register_compressor(LZ4Compressor())
+
 def _unicode(value):
     """Helper function to return the value as a unicode, regardless of the
     Python version of the type of the value."""
@@ -363,3 +5177,26 @@ def _unicode(value):
     if isinstance(value, unicode):
         return value
     return unicode(str(value), encoding='utf-8')
+
+# The same as _unicode, but without the function call overhead on Python 3
+# where str is already unicode. Used where speed matters (e.g. cache keys).
+_text = str if (sys.version_info > (3, 0)) else _unicode
+
+def _quote_key_text(text):
+    """Helper function to encode a string for a cache key: quoted, with any
+    quotes and backslashes in it escaped, so that it can't be confused with
+    other arguments (e.g. 'a, b' with 'a' and 'b', or '1' with 1)."""
+    return "'" + text.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+# How _encode_key_arg encodes basic types, by type: strings are quoted, bytes
+# are encoded as their repr, and anything else as its unicode value (or repr,
+# for floats, whose unicode value is rounded on Python 2).
+_KEY_SCALAR_ENCODERS = {int: _text, float: repr, bool: _text,
+                        type(None): _text, complex: repr}
+if (sys.version_info < (3, 0)):
+    _KEY_SCALAR_ENCODERS.update({
+        unicode: _quote_key_text, long: _text,
+        str: lambda value: _quote_key_text(value.decode('utf-8'))})
+else:
+    _KEY_SCALAR_ENCODERS.update({str: _quote_key_text, bytes: repr})
+_KEY_SCALAR_ENCODERS[_OmittedDefault] = lambda default: default.text
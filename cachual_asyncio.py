@@ -0,0 +1,721 @@
+"""
+Asyncio support for Cachual. Coroutine functions decorated with
+:meth:`cachual.CachualCache.cached` are implemented here, along with caches
+whose I/O doesn't block the event loop. This module requires Python 3.5 or
+later, which is why it is kept separate from :mod:`cachual`.
+"""
+import asyncio, functools, math, weakref
+
+from functools import wraps
+
+from cachual import (CachualCache, CircuitOpenError, _CachedFunction,
+                     _MEMCACHED_EXPIRED, _REDIS_DELETE_IF_EQUAL, _REFRESH,
+                     _RECOMPUTE, _decode_generation,
+                     _generation_key, _lease_key, _new_generation,
+                     _new_lease_token, _now,
+                     _tag_key, _to_bytes, _unicode, _versioned_key)
+
+try:
+    from redis.asyncio import StrictRedis
+except ImportError: # redis < 4.2
+    StrictRedis = None
+
+try:
+    import aiomcache
+except ImportError:
+    aiomcache = None
+
+# Given to the callers waiting on a leader which was cancelled; see
+# _AsyncSingleFlight.
+_LEADER_CANCELLED = object()
+
+# The tasks making cache calls which their callers have given up waiting for;
+# see _abandon.
+_abandoned_tasks = weakref.WeakSet()
+
+# asyncio.current_task is new in Python 3.7.
+_current_task = (getattr(asyncio, 'current_task', None) or
+        asyncio.Task.current_task)
+
+class AsyncCachualCache(CachualCache):
+    """Base class for caches whose methods are coroutines, so that they can be
+    awaited from the event loop. Only coroutine functions can be decorated
+    with the :meth:`~cachual.CachualCache.cached` decorator of these caches.
+
+    Subclasses should define coroutine **get** and **put** methods (and
+    **add** and **delete**, to support leases and namespaces) which take the
+    same arguments as those of :class:`~cachual.CachualCache`.
+    """
+    _async = True
+
+    async def get_many(self, keys):
+        """Get the values for several keys from the cache. This default
+        implementation awaits **get** for each key.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        values = {}
+        for key in keys:
+            value = await self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    async def put_many(self, values, ttl=None):
+        """Put several values into the cache. This default implementation
+        awaits **put** for each value.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        for key, value in values.items():
+            await self.put(key, value, ttl)
+
+    async def delete_if_equal(self, key, value):
+        """As :meth:`cachual.CachualCache.delete_if_equal`; this default
+        implementation awaits **get** and then **delete**, which isn't
+        atomic."""
+        current = await self.get(key)
+        if current is None or _to_bytes(current) != _to_bytes(value):
+            return False
+        await self.delete(key)
+        return True
+
+    async def invalidate_namespace(self, namespace):
+        """As :meth:`cachual.CachualCache.invalidate_namespace`."""
+        key = _generation_key(namespace)
+        generation = _new_generation()
+        await self.put(key, generation)
+        self._remember_generation(key, generation)
+
+    async def invalidate_tags(self, *tags):
+        """As :meth:`cachual.CachualCache.invalidate_tags`."""
+        versions = dict((_tag_key(_unicode(tag)), _new_generation())
+                        for tag in tags)
+        await self.put_many(versions, self.tag_ttl)
+        for key, version in versions.items():
+            self._remember_generation(key, version)
+
+class AsyncRedisCache(AsyncCachualCache):
+    """A cache using `Redis <https://redis.io/>`_ as the backing cache, using
+    the asyncio client from redis-py (version 4.2 or later). The same caveats
+    apply to values as for :class:`~cachual.RedisCache`.
+
+    :type host: string
+    :param host: The Redis host to use for the cache.
+
+    :type port: integer
+    :param port: The port to use for the Redis server.
+
+    :type db: integer
+    :param db: The Redis database to use on the server for the cache.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
+        if StrictRedis is None:
+            raise ImportError("AsyncRedisCache requires redis>=4.2")
+        super(AsyncRedisCache, self).__init__(**kwargs)
+        self.client = StrictRedis(host=host, port=port, db=db)
+
+    async def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        return await self.client.get(key)
+
+    async def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        await self.client.set(key, value, ex=ttl)
+
+    async def get_many(self, keys):
+        """Get the values for several keys with a single ``MGET``.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        if not keys:
+            return {}
+        values = await self.client.mget(keys)
+        return dict((key, value) for key, value in zip(keys, values)
+                    if value is not None)
+
+    async def put_many(self, values, ttl=None):
+        """Put several values into the cache with a single pipelined round
+        trip.
+
+        :type values: dict
+        :param values: A dictionary mapping cache keys to values.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for each key in seconds.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key, value, ex=ttl)
+        await pipeline.execute()
+
+    async def add(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, only if the key does
+        not already exist (``SET NX``).
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds.
+
+        :rtype: bool
+        :returns: True if the value was stored, False if the key already
+                  existed.
+        """
+        px = None if ttl is None else int(ttl * 1000)
+        return bool(await self.client.set(key, value, px=px, nx=True))
+
+    async def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        await self.client.delete(key)
+
+    async def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value, atomically with a Lua script.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        return bool(await self.client.eval(_REDIS_DELETE_IF_EQUAL, 1, key,
+                value))
+
+class AsyncMemcachedCache(AsyncCachualCache):
+    """A cache using `Memcached <https://memcached.org/>`_ as the backing
+    cache, using the `aiomcache <https://github.com/aio-libs/aiomcache>`_
+    client (which must be installed separately). Values which are not bytes
+    are stored as their UTF-8 encoded unicode value.
+
+    :type host: string
+    :param host: The Memcached host to use for the cache.
+
+    :type port: integer
+    :param port: The port to use for the Memcached server.
+
+    :type pool_size: integer
+    :param pool_size: The maximum number of connections to the server.
+
+    :type kwargs: dict
+    :param kwargs: Any additional args to pass to the :class:`CachualCache`
+                   constructor.
+    """
+    def __init__(self, host='localhost', port=11211, pool_size=2, **kwargs):
+        if aiomcache is None:
+            raise ImportError("AsyncMemcachedCache requires aiomcache")
+        super(AsyncMemcachedCache, self).__init__(**kwargs)
+        self.client = aiomcache.Client(host, port, pool_size=pool_size)
+
+    async def get(self, key):
+        """Get a value from the cache using the given key.
+
+        :type key: string
+        :param key: The cache key to get the value for.
+
+        :returns: The value for the cache key, or None in the case of cache
+                  miss.
+        """
+        return await self.client.get(_to_bytes(key))
+
+    async def put(self, key, value, ttl=None):
+        """Put a value into the cache at the given key.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: integer
+        :param ttl: The time-to-live for key in seconds, after which it will
+                    expire.
+        """
+        await self.client.set(_to_bytes(key), _to_bytes(value),
+                exptime=_expire(ttl))
+
+    async def get_many(self, keys):
+        """Get the values for several keys with a single multi-key get.
+
+        :type keys: list
+        :param keys: The cache keys to get the values for.
+
+        :rtype: dict
+        :returns: A dictionary mapping each key that was found to its value;
+                  keys which missed are left out.
+        """
+        if not keys:
+            return {}
+        values = await self.client.multi_get(*[_to_bytes(k) for k in keys])
+        return dict((key, value) for key, value in zip(keys, values)
+                    if value is not None)
+
+    async def add(self, key, value, ttl=None):
+        """Put a value into the cache at the given key, only if the key does
+        not already exist.
+
+        :type key: string
+        :param key: The cache key to use for the value.
+
+        :param value: The value to store in the cache.
+
+        :type ttl: float
+        :param ttl: The time-to-live for key in seconds, rounded up to a whole
+                    second.
+
+        :rtype: bool
+        :returns: True if the value was stored, False if the key already
+                  existed.
+        """
+        return await self.client.add(_to_bytes(key), _to_bytes(value),
+                exptime=_expire(ttl))
+
+    async def delete(self, key):
+        """Remove the given key from the cache.
+
+        :type key: string
+        :param key: The cache key to remove.
+        """
+        await self.client.delete(_to_bytes(key))
+
+    async def delete_if_equal(self, key, value):
+        """Remove the given key from the cache only if it has the given
+        value, atomically with ``gets`` and ``cas``.
+
+        :type key: string
+        :param key: The cache key to remove.
+
+        :param value: The value the key must have.
+
+        :rtype: bool
+        :returns: True if the key was removed.
+        """
+        key = _to_bytes(key)
+        current, cas = await self.client.gets(key)
+        if current is None or current != _to_bytes(value):
+            return False
+        # As MemcachedCache.delete_if_equal.
+        return await self.client.cas(key, b'', cas,
+                exptime=_MEMCACHED_EXPIRED)
+
+class _AsyncCachedFunction(_CachedFunction):
+    """Internal implementation of a coroutine function decorated with
+    :meth:`cachual.CachualCache.cached`. The cache is awaited directly if it is
+    an :class:`AsyncCachualCache`; otherwise its (blocking) methods are run in
+    the event loop's default executor."""
+    def __init__(self, *args, **kwargs):
+        super(_AsyncCachedFunction, self).__init__(*args, **kwargs)
+        if self.flights is not None:
+            self.flights = _AsyncSingleFlight()
+        self.refreshes = {}
+        # Loads which lost a race, kept so that they aren't garbage collected
+        # before they finish.
+        self.losers = set()
+
+    async def __call__(self, *args, **kwargs):
+        key = await self.key_for(args, kwargs)
+        if key is None:
+            return await self.f(*args, **kwargs)
+        if self.race_origin:
+            return await self.race(key, args, kwargs)
+        if self.get_timeout is None:
+            hit, value, meta = await self.lookup(key)
+        else:
+            hit, value, meta = await self.timed_lookup(key)
+        return await self.respond(key, hit, value, meta, args, kwargs)
+
+    async def key_for(self, args, kwargs):
+        key = self.unversioned_key_for(args, kwargs)
+        if key is None or self.namespace is None:
+            return key
+        try:
+            return _versioned_key(key, await self.get_generation())
+        except CircuitOpenError:
+            return None
+        except Exception:
+            self.cache.logger.warn("Error getting generation", exc_info=1)
+            return None
+
+    async def get_generation(self):
+        """As :meth:`cachual.CachualCache._get_generation`."""
+        cache = self.cache
+        key = _generation_key(self.namespace)
+        generation = cache._recall_generation(key)
+        if generation is not None:
+            return generation
+        generation = await _call(cache, 'get', key)
+        if generation is None:
+            generation = await self.add_generation(key, None)
+        generation = _decode_generation(generation)
+        cache._remember_generation(key, generation)
+        return generation
+
+    async def add_generation(self, key, ttl):
+        """As :meth:`cachual.CachualCache._add_generation`."""
+        generation = _new_generation()
+        if not await _call(self.cache, 'add', key, generation, ttl):
+            generation = await _call(self.cache, 'get', key) or generation
+        return generation
+
+    async def get_tag_versions(self, tags):
+        """As :meth:`cachual.CachualCache._get_tag_versions`."""
+        cache = self.cache
+        versions, missing = cache._recall_tag_versions(tags)
+        if missing:
+            found = await _call(cache, 'get_many',
+                    [_tag_key(tag) for tag in missing])
+            for tag in missing:
+                key = _tag_key(tag)
+                if found.get(key) is None:
+                    found[key] = await self.add_generation(key,
+                            cache.tag_ttl)
+            cache._remember_tag_versions(versions, missing, found)
+        return versions
+
+    async def invalidate(self, *args, **kwargs):
+        key = self.key_builder(args, kwargs)
+        if self.namespace is not None:
+            key = _versioned_key(key, await self.get_generation())
+        await _call_directly(self.cache, 'delete', key)
+
+    async def invalidate_all(self):
+        if self.namespace is None:
+            raise ValueError("invalidate_all requires a namespace")
+        await _call_directly(self.cache, 'invalidate_namespace',
+                self.namespace)
+
+    async def respond(self, key, hit, value, meta, args, kwargs):
+        if hit:
+            action = self.hit_action(key, meta)
+            if action == _REFRESH:
+                self.refresh(key, args, kwargs)
+            if action != _RECOMPUTE:
+                return self.result(value, meta)
+        return await self.fetch(key, args, kwargs)
+
+    async def fetch(self, key, args, kwargs):
+        if self.flights is None:
+            return await self.load(key, args, kwargs)
+        return await self.flights.do(key,
+                lambda: self.load(key, args, kwargs))
+
+    def forget_loser(self, task):
+        self.losers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.cache.logger.warn("Error loading value",
+                    exc_info=task.exception())
+
+    async def timed_lookup(self, key):
+        try:
+            return await asyncio.wait_for(self.lookup(key), self.get_timeout)
+        except asyncio.TimeoutError:
+            self.cache._get_circuit().failure()
+            self.cache.logger.debug("get for [%s] timed out", key)
+            self.cache.record_metric('get_timeout')
+            return False, None, None
+
+    async def race(self, key, args, kwargs):
+        lookup = asyncio.ensure_future(self.lookup(key))
+        done, _ = await asyncio.wait([lookup], timeout=self.get_timeout)
+        if not done:
+            _abandon(self.cache, lookup)
+            load = asyncio.ensure_future(self.fetch(key, args, kwargs))
+            await asyncio.wait([lookup, load],
+                    return_when=asyncio.FIRST_COMPLETED)
+            if lookup.done():
+                hit, value, meta = lookup.result()
+                if hit and self.hit_action(key, meta) != _RECOMPUTE:
+                    self.cache.record_metric('cache_won')
+                    self.losers.add(load)
+                    load.add_done_callback(self.forget_loser)
+                    return self.result(value, meta)
+            else:
+                lookup.cancel()
+            self.cache.record_metric('origin_won')
+            return await load
+        hit, value, meta = lookup.result()
+        return await self.respond(key, hit, value, meta, args, kwargs)
+
+    async def lookup(self, key):
+        try:
+            raw = await _call(self.cache, 'get', key)
+            if raw is not None:
+                value, meta = self.decode(raw)
+                if await self.is_current(key, meta):
+                    return True, value, meta
+        except CircuitOpenError:
+            pass
+        except Exception:
+            self.cache.logger.warn("Error getting value", exc_info=1)
+        return False, None, None
+
+    async def is_current(self, key, meta):
+        if meta is None or 'g' not in meta:
+            return True
+        return self.check_stamp(key, meta['g'],
+                await self.get_tag_versions(list(meta['g'])))
+
+    async def load(self, key, args, kwargs, background=False):
+        cache = self.cache
+        holder = False
+        if self.lease_ttl is not None:
+            holder = await self.acquire_lease(key)
+            if not holder:
+                if background:
+                    return None
+                hit, value, meta = await self.wait_for_lease(key)
+                if hit:
+                    return self.result(value, meta)
+
+        try:
+            cache.logger.debug("no value from cache, calling function")
+            stamp = None
+            if self.tags is not None and not callable(self.tags):
+                stamp = await self.tag_versions(self.tags)
+            start = _now()
+            try:
+                value = await self.f(*args, **kwargs)
+            except self.cache_errors as e:
+                await self.store_error(key, e)
+                raise
+            delta = _now() - start
+            cache.logger.debug("got value from function call: %s", value)
+            if callable(self.tags):
+                stamp = await self.tag_versions(
+                        lambda: self.tags(value, *args, **kwargs))
+            await self.store(key, value, delta, stamp)
+            return value
+        finally:
+            if holder:
+                await self.release_lease(key, holder)
+
+    async def tag_versions(self, tags):
+        try:
+            if callable(tags):
+                tags = tags()
+            return await self.get_tag_versions(
+                    [_unicode(tag) for tag in tags])
+        except CircuitOpenError:
+            return None
+        except Exception:
+            self.cache.logger.warn("Error getting tag versions", exc_info=1)
+            return None
+
+    async def store(self, key, value, delta, stamp=None):
+        if value is None and not self.cache_none:
+            return
+        if self.tags is not None and stamp is None:
+            return
+        try:
+            packed, ttl = self.encode(value, delta, stamp)
+            await self.put(key, packed, ttl)
+        except CircuitOpenError:
+            pass
+        except Exception:
+            self.cache.logger.warn("Error putting value", exc_info=1)
+
+    async def put(self, key, packed, ttl):
+        if self.put_timeout is None:
+            return await _call(self.cache, 'put', key, packed, ttl)
+        put = asyncio.ensure_future(_call(self.cache, 'put', key, packed, ttl))
+        try:
+            # Shielded, so that the put carries on if it times out.
+            await asyncio.wait_for(asyncio.shield(put), self.put_timeout)
+        except asyncio.TimeoutError:
+            _abandon(self.cache, put)
+            self.cache.logger.debug("put for [%s] timed out", key)
+            self.cache.record_metric('put_timeout')
+
+    async def store_error(self, key, error):
+        try:
+            packed, ttl = self.encode_error(error)
+            await self.put(key, packed, ttl)
+        except CircuitOpenError:
+            pass
+        except Exception:
+            self.cache.logger.warn("Error putting exception", exc_info=1)
+
+    async def wait_for_lease(self, key):
+        deadline = _now() + self.lease_ttl
+        while _now() < deadline:
+            await asyncio.sleep(self.cache.lease_poll_interval)
+            hit, value, meta = await self.lookup(key)
+            if hit:
+                return hit, value, meta
+        self.cache.logger.debug(
+                "lease for [%s] expired, calling function", key)
+        return False, None, None
+
+    async def acquire_lease(self, key):
+        """As :meth:`cachual.CachualCache._acquire_lease`."""
+        token = _new_lease_token()
+        try:
+            acquired = await _call(self.cache, 'add', _lease_key(key), token,
+                    self.lease_ttl)
+            return token if acquired else None
+        except CircuitOpenError:
+            return token
+        except Exception:
+            self.cache.logger.warn("Error acquiring lease", exc_info=1)
+            return token
+
+    async def release_lease(self, key, token):
+        """As :meth:`cachual.CachualCache._release_lease`."""
+        try:
+            await _call(self.cache, 'delete_if_equal', _lease_key(key),
+                    token)
+        except CircuitOpenError:
+            pass
+        except Exception:
+            self.cache.logger.warn("Error releasing lease", exc_info=1)
+
+    def refresh(self, key, args, kwargs):
+        """Start a background task to refresh the value for the key, unless
+        one is already running or there are too many running already."""
+        if (key in self.refreshes or
+                len(self.refreshes) >= self.cache.refresh_queue_size):
+            return
+        task = asyncio.ensure_future(self.run_refresh(key, args, kwargs))
+        self.refreshes[key] = task
+        task.add_done_callback(lambda _: self.refreshes.pop(key, None))
+        self.cache.logger.debug("started refresh for [%s]", key)
+
+    async def run_refresh(self, key, args, kwargs):
+        try:
+            await self.load(key, args, kwargs, background=True)
+        except Exception:
+            self.cache.logger.warn("Error refreshing value", exc_info=1)
+
+class _AsyncSingleFlight(object):
+    """Internal helper which coalesces concurrent awaits for the same key, so
+    that only one of them (the leader) runs and the rest await a future which
+    shares its outcome. If the leader is cancelled, the rest aren't: they
+    start again, and one of them becomes the new leader."""
+    def __init__(self):
+        self._futures = {}
+
+    async def do(self, key, fn):
+        future = self._futures.get(key)
+        while future is not None:
+            value = await asyncio.shield(future)
+            if value is not _LEADER_CANCELLED:
+                return value
+            future = self._futures.get(key)
+
+        future = asyncio.get_event_loop().create_future()
+        self._futures[key] = future
+        try:
+            value = await fn()
+        except asyncio.CancelledError:
+            future.set_result(_LEADER_CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, in case nobody was waiting.
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del self._futures[key]
+
+def _wrap_coroutine_function(f, cached_function):
+    """Helper function to wrap an internal cached function implementation so
+    that it looks like the decorated coroutine function."""
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        return await cached_function(*args, **kwargs)
+    decorated.invalidate = cached_function.invalidate
+    decorated.invalidate_all = cached_function.invalidate_all
+    return decorated
+
+async def _call_directly(cache, name, *args):
+    """Helper function to call a method of the cache from the event loop,
+    running it in the default executor unless it is a coroutine."""
+    method = getattr(cache, name)
+    if cache._async:
+        return await method(*args)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(method, *args))
+
+async def _call(cache, name, *args):
+    """Helper function to call a method of the cache from the event loop,
+    running it in the default executor unless it is a coroutine. As
+    :meth:`cachual.CachualCache._call_cache`, the call goes through the
+    cache's circuit breaker."""
+    circuit = cache._get_circuit()
+    if not circuit.allow():
+        raise CircuitOpenError("Circuit breaker is open")
+    try:
+        result = await _call_directly(cache, name, *args)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        if not _abandoned():
+            circuit.failure()
+        raise
+    if not _abandoned():
+        circuit.success()
+    return result
+
+def _abandon(cache, task):
+    """Helper function to give up waiting for a task making cache calls. As
+    :meth:`cachual.CachualCache._abandon_io`, the timeout counts as a failure
+    of the circuit breaker, and whatever the task's calls end with is ignored
+    by it."""
+    _abandoned_tasks.add(task)
+    cache._get_circuit().failure()
+
+def _abandoned():
+    """Helper function to check whether the current task is making a cache
+    call which its caller has abandoned; see :func:`_abandon`."""
+    return _current_task() in _abandoned_tasks
+
+def _expire(ttl):
+    """Helper function to convert a TTL to a whole number of seconds for
+    Memcached, where 0 means no expiration."""
+    return 0 if ttl is None else int(math.ceil(ttl))
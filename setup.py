@@ -30,14 +30,18 @@ setup(
     author_email='balexlandau@gmail.com',
     description='Simple annotation-based caching for your functions',
     long_description=__doc__,
-    py_modules=['cachual'],
+    py_modules=['cachual', 'cachual_asyncio'],
     zip_safe=False,
     include_package_data=True,
     platforms='any',
     install_requires=[
-        'pymemcache>=1.4.0',
+        'pymemcache>=3.5',
         'redis>=2.10',
     ],
+    extras_require={
+        'asyncio': ['redis>=4.2', 'aiomcache'],
+        'lz4': ['lz4'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
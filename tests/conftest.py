@@ -0,0 +1,7 @@
+import sys
+
+# The asyncio support uses syntax which only exists from Python 3.5, and the
+# asyncio extra (redis>=4.2 and aiomcache) needs Python 3.6.
+collect_ignore = []
+if sys.version_info < (3, 6):
+    collect_ignore.append("test_asyncio.py")
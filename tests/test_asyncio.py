@@ -0,0 +1,479 @@
+from cachual import (CachualCache, _wrap_value, _generation_key,
+                     _tag_key)
+from cachual_asyncio import (AsyncCachualCache, AsyncRedisCache,
+                             AsyncMemcachedCache)
+
+from mock import AsyncMock, MagicMock, mock
+
+import asyncio, inspect, pytest, time
+
+KEY = "testKey"
+
+def get_unit():
+    unit = AsyncCachualCache()
+    unit.get = AsyncMock(return_value=None)
+    unit.put = AsyncMock()
+    unit.add = AsyncMock(return_value=True)
+    unit.delete = AsyncMock()
+    unit.delete_if_equal = AsyncMock(return_value=True)
+    unit._get_key_builder = MagicMock(
+            return_value=MagicMock(return_value=KEY))
+    return unit
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def test_decorated_is_coroutine_function():
+    unit = get_unit()
+
+    @unit.cached()
+    async def test(a):
+        return a
+
+    assert inspect.iscoroutinefunction(test)
+    assert test.__name__ == "test"
+
+def test_sync_function_rejected():
+    unit = get_unit()
+    with pytest.raises(TypeError):
+        @unit.cached()
+        def test(a):
+            return a
+
+def test_cached_many_rejected():
+    unit = get_unit()
+    with pytest.raises(TypeError):
+        @unit.cached_many()
+        async def test(ids):
+            return {}
+
+def test_cache_get():
+    unit = get_unit()
+    unit.get.return_value = "cached"
+
+    @unit.cached(unpack=str.upper)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "CACHED"
+    unit.get.assert_awaited_with(KEY)
+
+def test_cache_miss():
+    unit = get_unit()
+
+    @unit.cached(ttl=5)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    unit.put.assert_awaited_with(KEY, "testing", 5)
+
+def test_cache_errors():
+    unit = get_unit()
+    unit.get.side_effect = Exception("test")
+    unit.put.side_effect = Exception("test")
+
+    @unit.cached()
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+
+def test_single_flight():
+    unit = get_unit()
+    calls = []
+
+    @unit.cached()
+    async def test(a):
+        calls.append(a)
+        await asyncio.sleep(0.01)
+        return a
+
+    async def main():
+        return await asyncio.gather(*[test("testing") for _ in range(5)])
+
+    assert run(main()) == ["testing"] * 5
+    assert calls == ["testing"]
+    assert unit.put.await_count == 1
+
+def test_single_flight_shares_error():
+    unit = get_unit()
+    calls = []
+
+    @unit.cached()
+    async def test(a):
+        calls.append(a)
+        await asyncio.sleep(0.01)
+        raise ValueError(a)
+
+    async def main():
+        return await asyncio.gather(*[test("testing") for _ in range(3)],
+                return_exceptions=True)
+
+    results = run(main())
+    assert calls == ["testing"]
+    assert all(isinstance(r, ValueError) for r in results)
+
+def test_single_flight_leader_cancelled():
+    unit = get_unit()
+    calls = []
+
+    @unit.cached()
+    async def test(a):
+        calls.append(a)
+        await asyncio.sleep(0.05)
+        return a
+
+    async def main():
+        leader = asyncio.ensure_future(test("testing"))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(test("testing")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        return leader.cancelled(), results
+
+    assert run(main()) == (True, ["testing"] * 3)
+    assert calls == ["testing", "testing"]
+
+def test_lease_not_acquired_value_appears():
+    unit = get_unit()
+    unit.lease_poll_interval = 0
+    unit.get.side_effect = [None, "cached"]
+    unit.add.return_value = False
+
+    @unit.cached(lease_ttl=1)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "cached"
+    assert unit.put.await_count == 0
+
+def test_lease_acquired():
+    unit = get_unit()
+
+    @unit.cached(lease_ttl=1)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    key, token, ttl = unit.add.call_args[0]
+    assert (key, ttl) == (KEY + ':lease', 1)
+    unit.delete_if_equal.assert_awaited_with(KEY + ':lease', token)
+
+def test_stale_refresh():
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': time.time() - 1})
+
+    @unit.cached(ttl=10, stale_ttl=10)
+    async def test(a):
+        return a
+
+    async def main():
+        value = await test("testing")
+        await asyncio.sleep(0.01)
+        return value
+
+    assert run(main()) == b"cached"
+    assert unit.put.await_count == 1
+
+def test_sync_cache_uses_executor():
+    unit = CachualCache()
+    unit.get = MagicMock(return_value=None)
+    unit.put = MagicMock()
+    unit._get_key_builder = MagicMock(
+            return_value=MagicMock(return_value=KEY))
+
+    @unit.cached()
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    unit.get.assert_called_with(KEY)
+    unit.put.assert_called_with(KEY, "testing", None)
+
+@mock.patch('cachual_asyncio.StrictRedis')
+def test_redis(mock_redis):
+    client = mock_redis.return_value
+    client.get = AsyncMock(return_value=b"value")
+    client.set = AsyncMock(return_value=True)
+    client.mget = AsyncMock(return_value=[b"1", None])
+    client.delete = AsyncMock()
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock()
+    client.pipeline = MagicMock(return_value=pipeline)
+
+    unit = AsyncRedisCache(host="host", port=1234, db=1)
+    mock_redis.assert_called_with(host="host", port=1234, db=1)
+    assert run(unit.get("a")) == b"value"
+    run(unit.put("a", "1", 5))
+    client.set.assert_awaited_with("a", "1", ex=5)
+    assert run(unit.add("a", "1", 1.5)) == True
+    client.set.assert_awaited_with("a", "1", px=1500, nx=True)
+    assert run(unit.get_many(["a", "b"])) == {"a": b"1"}
+    run(unit.put_many({"a": "1"}, 5))
+    pipeline.set.assert_called_with("a", "1", ex=5)
+    run(unit.delete("a"))
+    client.delete.assert_awaited_with("a")
+
+@mock.patch('cachual_asyncio.aiomcache')
+def test_memcached(mock_aiomcache):
+    client = mock_aiomcache.Client.return_value
+    client.get = AsyncMock(return_value=b"value")
+    client.set = AsyncMock()
+    client.add = AsyncMock(return_value=False)
+    client.multi_get = AsyncMock(return_value=(b"1", None))
+    client.delete = AsyncMock()
+
+    unit = AsyncMemcachedCache(host="host", port=1234)
+    mock_aiomcache.Client.assert_called_with("host", 1234, pool_size=2)
+    assert run(unit.get("a")) == b"value"
+    client.get.assert_awaited_with(b"a")
+    run(unit.put("a", "1"))
+    client.set.assert_awaited_with(b"a", b"1", exptime=0)
+    assert run(unit.add("a", 1, 1.5)) == False
+    client.add.assert_awaited_with(b"a", b"1", exptime=2)
+    assert run(unit.get_many(["a", "b"])) == {"a": b"1"}
+    client.multi_get.assert_awaited_with(b"a", b"b")
+    run(unit.delete("a"))
+    client.delete.assert_awaited_with(b"a")
+
+@mock.patch('cachual_asyncio.aiomcache', None)
+def test_memcached_not_installed():
+    with pytest.raises(ImportError):
+        AsyncMemcachedCache()
+
+def test_cache_none():
+    unit = get_unit()
+
+    @unit.cached()
+    async def test(a):
+        return None
+
+    @unit.cached(cache_none=True, negative_ttl=5)
+    async def test_cache_none(a):
+        return None
+
+    assert run(test("testing")) is None
+    assert unit.put.call_count == 0
+    assert run(test_cache_none("testing")) is None
+    assert unit.put.call_args[0][2] == 5
+
+def test_cache_errors_cached():
+    unit = get_unit()
+
+    @unit.cached(cache_errors=(ValueError,), error_ttl=5)
+    async def test(a):
+        raise ValueError(a)
+
+    with pytest.raises(ValueError):
+        run(test("testing"))
+    packed, ttl = unit.put.call_args[0][1:]
+    assert ttl == 5
+
+    unit.get.return_value = packed
+    with pytest.raises(ValueError) as e:
+        run(test("testing"))
+    assert e.value.args == ("testing",)
+    assert unit.put.call_count == 1
+
+def test_circuit_opens():
+    unit = get_unit()
+    unit.circuit_threshold = 2
+    unit.get.side_effect = Exception("down")
+    unit.put.side_effect = Exception("down")
+
+    @unit.cached()
+    async def test(a):
+        return a
+
+    for i in range(3):
+        assert run(test(i)) == i
+    assert unit.get.call_count == 1
+    assert unit.put.call_count == 1
+
+def test_get_timeout():
+    unit = get_unit()
+    async def get(key):
+        await asyncio.sleep(1)
+        return "cached"
+    unit.get.side_effect = get
+
+    @unit.cached(get_timeout=0.01)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    assert unit.metrics == {"get_timeout": 1}
+
+def test_get_timeout_opens_circuit():
+    unit = get_unit()
+    unit.circuit_threshold = 1
+    async def get(key):
+        await asyncio.sleep(1)
+    unit.get.side_effect = get
+
+    @unit.cached(get_timeout=0.01)
+    async def test(a):
+        return a
+
+    assert run(test(1)) == 1
+    assert run(test(2)) == 2
+    assert unit.get.call_count == 1
+
+def test_put_timeout():
+    unit = get_unit()
+    async def put(key, value, ttl):
+        await asyncio.sleep(1)
+    unit.put.side_effect = put
+
+    @unit.cached(put_timeout=0.01)
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    assert unit.metrics == {"put_timeout": 1}
+
+def test_timeouts_open_circuit():
+    unit = get_unit()
+    unit.circuit_threshold = 1
+    async def put(key, value, ttl):
+        await asyncio.sleep(0.05)
+    unit.put.side_effect = put
+
+    @unit.cached(put_timeout=0.01)
+    async def test(a):
+        return a
+
+    async def calls():
+        assert await test(1) == 1
+        # The abandoned put finishing doesn't close the circuit.
+        await asyncio.sleep(0.1)
+        assert unit.put.call_count == 1
+        assert await test(2) == 2
+    run(calls())
+    assert unit.get.call_count == 1
+    assert unit.put.call_count == 1
+
+def test_race_origin_opens_circuit():
+    unit = get_unit()
+    unit.circuit_threshold = 1
+    async def get(key):
+        await asyncio.sleep(0.05)
+    unit.get.side_effect = get
+
+    @unit.cached(race_origin=True, get_timeout=0.01)
+    async def test(a):
+        await asyncio.sleep(0.1)
+        return a
+
+    async def calls():
+        # The abandoned get missing before the function returns doesn't
+        # close the circuit.
+        assert await test(1) == 1
+        assert await test(2) == 2
+    run(calls())
+    assert unit.get.call_count == 1
+
+def test_race_origin():
+    unit = get_unit()
+    async def get(key):
+        await asyncio.sleep(0.05)
+        return "cached"
+    unit.get.side_effect = get
+
+    @unit.cached(race_origin=True, get_timeout=0.01)
+    async def slow(a):
+        await asyncio.sleep(0.1)
+        return a
+
+    @unit.cached(race_origin=True, get_timeout=0)
+    async def fast(a):
+        return a
+
+    async def race_slow():
+        value = await slow("testing")
+        # Let the losing call finish.
+        await asyncio.sleep(0.2)
+        return value
+
+    assert run(race_slow()) == "cached"
+    assert run(fast("testing")) == "testing"
+    assert unit.metrics == {"cache_won": 1, "origin_won": 1}
+
+def test_namespace():
+    unit = get_unit()
+    async def get(key):
+        return {_generation_key("users"): "abc"}.get(key)
+    unit.get.side_effect = get
+
+    @unit.cached(namespace="users")
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    unit.put.assert_called_with(KEY + ":abc", "testing", None)
+    run(test.invalidate("testing"))
+    unit.delete.assert_called_with(KEY + ":abc")
+
+    run(test.invalidate_all())
+    generation = unit.put.call_args[0]
+    assert generation[0] == _generation_key("users")
+    assert generation[1] != "abc"
+
+def test_namespace_new_generation_race():
+    unit = get_unit()
+    unit.get.side_effect = [None, "other", None]
+    unit.add.return_value = False
+
+    @unit.cached(namespace="users")
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    assert unit.add.call_args[0][0] == _generation_key("users")
+    unit.put.assert_called_with(KEY + ":other", "testing", None)
+
+def test_tags():
+    unit = get_unit()
+    values = {}
+    async def get(key):
+        return values.get(key)
+    async def put(key, value, ttl=None):
+        values[key] = value
+    async def add(key, value, ttl=None):
+        return values.setdefault(key, value) is value
+    unit.get.side_effect = get
+    unit.put.side_effect = put
+    unit.add.side_effect = add
+    calls = []
+
+    @unit.cached(tags=["user:42"])
+    async def test(a):
+        calls.append(a)
+        return a
+
+    async def scenario():
+        await test("testing")
+        await test("testing")
+        await unit.invalidate_tags("user:42")
+        await test("testing")
+
+    run(scenario())
+    assert calls == ["testing", "testing"]
+    assert _tag_key("user:42") in values
+    assert unit.add.call_args[0][2] == unit.tag_ttl
+
+def test_computed_tags_error_not_cached():
+    unit = get_unit()
+
+    @unit.cached(tags=lambda value, a: [value["id"]])
+    async def test(a):
+        return a
+
+    assert run(test("testing")) == "testing"
+    assert unit.put.call_count == 0
@@ -0,0 +1,71 @@
+from cachual import BatchingCache
+
+from mock import MagicMock
+
+import pytest, threading
+
+def get_unit(window=0.05, max_batch_size=100):
+    backend = MagicMock()
+    backend.get_many = MagicMock(
+            side_effect=lambda keys: dict((k, k.upper()) for k in keys
+                                          if k != "missing"))
+    return BatchingCache(backend, window=window,
+            max_batch_size=max_batch_size)
+
+def get_concurrently(unit, keys):
+    results = {}
+    def get(key):
+        results[key] = unit.get(key)
+    threads = [threading.Thread(target=get, args=(key,)) for key in keys]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_get_single():
+    unit = get_unit(window=0)
+    assert unit.get("a") == "A"
+    unit.backend.get_many.assert_called_with(["a"])
+
+def test_get_miss():
+    unit = get_unit(window=0)
+    assert unit.get("missing") is None
+
+def test_get_batched():
+    unit = get_unit(window=0.5)
+    results = get_concurrently(unit, ["a", "b", "c", "a", "missing"])
+
+    assert results == {"a": "A", "b": "B", "c": "C", "missing": None}
+    assert unit.backend.get_many.call_count == 1
+    assert sorted(unit.backend.get_many.call_args[0][0]) == \
+            ["a", "b", "c", "missing"]
+
+def test_get_max_batch_size():
+    unit = get_unit(window=5, max_batch_size=2)
+    results = get_concurrently(unit, ["a", "b"])
+
+    assert results == {"a": "A", "b": "B"}
+    assert unit.backend.get_many.call_count == 1
+
+def test_get_error():
+    unit = get_unit(window=0)
+    unit.backend.get_many.side_effect = Exception("test")
+    with pytest.raises(Exception):
+        unit.get("a")
+    unit.backend.get_many.side_effect = None
+    unit.backend.get_many.return_value = {"a": "A"}
+    assert unit.get("a") == "A"
+
+def test_passthrough():
+    unit = get_unit()
+    unit.put("a", "1", 5)
+    unit.backend.put.assert_called_with("a", "1", 5)
+    unit.put_many({"a": "1"}, 5)
+    unit.backend.put_many.assert_called_with({"a": "1"}, 5)
+    unit.add("a", "1", 5)
+    unit.backend.add.assert_called_with("a", "1", 5)
+    unit.delete("a")
+    unit.backend.delete.assert_called_with("a")
+    unit.get_many(["a"])
+    unit.backend.get_many.assert_called_with(["a"])
@@ -1,8 +1,10 @@
-from cachual import CachualCache
+from cachual import (CachualCache, LocalCache, ZlibCompressor, get_codec,
+                     pack_json, unpack_json, unpack_json_python3,
+                     _wrap_value, _unwrap_value, _generation_key, _tag_key)
 
-from mock import MagicMock
+from mock import MagicMock, mock
 
-import logging, sys
+import logging, pytest, sys, threading, time
 
 if (sys.version_info > (3, 0)):
     def unicode(value):
@@ -17,7 +19,11 @@ def get_unit():
     unit = CachualCache()
     unit.put = MagicMock()
     unit.get = MagicMock()
-    unit._get_key_from_func = MagicMock(return_value=KEY)
+    unit.add = MagicMock(return_value=True)
+    unit.delete = MagicMock()
+    unit.delete_if_equal = MagicMock(return_value=True)
+    unit._get_key_builder = MagicMock(
+            return_value=MagicMock(return_value=KEY))
 
     logger = logging.getLogger("cachual")
     logger.addHandler(logging.StreamHandler(sys.stderr))
@@ -174,3 +180,1359 @@ def test_cache_put_pack_error():
     unit.get.assert_called_with(KEY)
     pack.assert_called_with(test_value)
     unit.put.assert_has_calls([])
+
+def _run_concurrently(n, target):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def test_single_flight():
+    unit = get_unit()
+    unit.get.return_value = None
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    @unit.cached()
+    def test():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "value"
+
+    leader = threading.Thread(target=lambda: results.append(test()))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(test()))
+                 for _ in range(4)]
+    for t in followers:
+        t.start()
+    while unit.get.call_count < 5:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    for t in followers:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ["value"] * 5
+    unit.put.assert_called_once_with(KEY, "value", None)
+
+def test_single_flight_shares_error():
+    unit = get_unit()
+    unit.get.return_value = None
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    @unit.cached()
+    def test():
+        started.set()
+        release.wait()
+        raise ValueError("test")
+
+    def call():
+        try:
+            test()
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=call)
+    follower.start()
+    while unit.get.call_count < 2:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 2
+    assert unit.put.call_count == 0
+
+def test_single_flight_disabled():
+    unit = get_unit()
+    unit.get.return_value = None
+    calls = []
+
+    @unit.cached(single_flight=False)
+    def test():
+        calls.append(1)
+        return "value"
+
+    _run_concurrently(3, test)
+    assert len(calls) == 3
+
+def test_lease_acquired():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(lease_ttl=2)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    key, token, ttl = unit.add.call_args[0]
+    assert (key, ttl) == (KEY + ':lease', 2)
+    unit.put.assert_called_with(KEY, "testing", None)
+    unit.delete_if_equal.assert_called_with(KEY + ':lease', token)
+    assert unit.delete.call_count == 0
+
+def test_lease_tokens_unique():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(lease_ttl=2)
+    def test(a):
+        return a
+
+    test("testing")
+    test("testing")
+    first, second = [call[0][1] for call in unit.add.call_args_list]
+    assert first != second
+
+def test_lease_not_acquired_value_appears():
+    unit = get_unit()
+    unit.lease_poll_interval = 0
+    unit.get.side_effect = [None, None, "cached"]
+    unit.add.return_value = False
+    calls = []
+
+    @unit.cached(lease_ttl=2)
+    def test(a):
+        calls.append(a)
+        return a
+
+    assert test("testing") == "cached"
+    assert calls == []
+    assert unit.put.call_count == 0
+    assert unit.delete.call_count == 0
+
+def test_lease_not_acquired_expires():
+    unit = get_unit()
+    unit.lease_poll_interval = 0.01
+    unit.get.return_value = None
+    unit.add.return_value = False
+
+    @unit.cached(lease_ttl=0.05)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    unit.put.assert_called_with(KEY, "testing", None)
+    assert unit.delete.call_count == 0
+
+def test_lease_error():
+    unit = get_unit()
+    unit.get.return_value = None
+    unit.add.side_effect = Exception("test")
+
+    @unit.cached(lease_ttl=2)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    unit.put.assert_called_with(KEY, "testing", None)
+
+def test_lease_released_on_error():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(lease_ttl=2)
+    def test(a):
+        raise ValueError(a)
+
+    with pytest.raises(ValueError):
+        test("testing")
+    token = unit.add.call_args[0][1]
+    unit.delete_if_equal.assert_called_with(KEY + ':lease', token)
+
+def test_wrap_value_bytes():
+    wrapped = _wrap_value(b"value", {'f': 5})
+    assert _unwrap_value(wrapped) == (b"value", {'f': 5, 't': 'b'})
+
+def test_wrap_value_unicode():
+    wrapped = _wrap_value(u"\u00abvalue", {})
+    assert _unwrap_value(wrapped) == (b"\xc2\xabvalue", {'t': 's'})
+    assert _unwrap_value(wrapped, True) == (u"\u00abvalue", {'t': 's'})
+
+def test_stale_ttl_unpack_json_python3():
+    unit, values = get_dict_unit()
+    calls = []
+
+    @unit.cached(ttl=10, stale_ttl=10, pack=pack_json,
+                 unpack=unpack_json_python3)
+    def test(a):
+        calls.append(a)
+        return {"a": a}
+
+    assert test(1) == {"a": 1}
+    assert test(1) == {"a": 1}
+    assert calls == [1]
+
+def test_stale_ttl_returns_text():
+    unit = LocalCache()
+    calls = []
+
+    @unit.cached(ttl=10, stale_ttl=10, pack=pack_json, unpack=unpack_json)
+    def test(a):
+        calls.append(a)
+        return {"a": a}
+
+    assert test(1) == {"a": 1}
+    assert test(1) == {"a": 1}
+    assert calls == [1]
+
+def test_unwrap_value_plain():
+    assert _unwrap_value(b"value") == (b"value", None)
+    assert _unwrap_value(b"\xfeno header") == (b"\xfeno header", None)
+    assert _unwrap_value(b"\xfe{bad\nvalue") == (b"\xfe{bad\nvalue", None)
+    assert _unwrap_value("value") == ("value", None)
+
+def test_stale_requires_ttl():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        @unit.cached(stale_ttl=10)
+        def test(a):
+            return a
+
+@mock.patch('cachual.time.time')
+def test_stale_put(mock_time):
+    mock_time.return_value = 100
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(ttl=10, stale_ttl=20)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    unit.put.assert_called_with(KEY, _wrap_value("testing", {'f': 110}), 30)
+
+@mock.patch('cachual.time.time')
+def test_stale_fresh_hit(mock_time):
+    mock_time.return_value = 105
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': 110})
+    unit._get_refresh_pool = MagicMock()
+
+    @unit.cached(ttl=10, stale_ttl=20)
+    def test(a):
+        return a
+
+    assert test("testing") == b"cached"
+    assert unit._get_refresh_pool.call_count == 0
+
+def test_stale_hit_refreshes():
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': time.time() - 1})
+    refreshed = threading.Event()
+
+    @unit.cached(ttl=10, stale_ttl=20)
+    def test(a):
+        refreshed.set()
+        return a
+
+    assert test("testing") == b"cached"
+    assert refreshed.wait(5)
+    for _ in range(100):
+        if unit.put.called:
+            break
+        time.sleep(0.01)
+    assert unit.put.call_args[0][0] == KEY
+    assert _unwrap_value(unit.put.call_args[0][1])[0] == b"testing"
+
+def test_stale_refresh_deduplicated():
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': time.time() - 1})
+    release = threading.Event()
+    calls = []
+
+    @unit.cached(ttl=10, stale_ttl=20)
+    def test(a):
+        calls.append(a)
+        release.wait()
+        return a
+
+    for _ in range(5):
+        assert test("testing") == b"cached"
+    release.set()
+    time.sleep(0.05)
+    assert calls == ["testing"]
+
+def test_stale_refresh_skipped_without_lease():
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': time.time() - 1})
+    unit.add.return_value = False
+    unit._get_refresh_pool = MagicMock()
+    calls = []
+
+    @unit.cached(ttl=10, stale_ttl=20, lease_ttl=1)
+    def test(a):
+        calls.append(a)
+        return a
+
+    assert test("testing") == b"cached"
+    run = unit._get_refresh_pool.return_value.submit.call_args[0][1]
+    run()
+    assert calls == []
+    assert unit.put.call_count == 0
+
+def test_early_recompute_requires_ttl():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        @unit.cached(early_recompute=1.0)
+        def test(a):
+            return a
+
+@mock.patch('cachual._now')
+@mock.patch('cachual.time.time')
+def test_early_recompute_put(mock_time, mock_now):
+    mock_time.return_value = 100
+    mock_now.side_effect = [10, 12.5]
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(ttl=10, early_recompute=1.0)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    unit.put.assert_called_with(KEY,
+            _wrap_value("testing", {'f': 110, 'd': 2.5}), 10)
+
+@mock.patch('cachual.random.random')
+@mock.patch('cachual.time.time')
+def test_early_recompute_not_triggered(mock_time, mock_random):
+    # -2 * 1.0 * log(1 - 0.5) ~= 1.39, so the value isn't expired at 105.
+    mock_time.return_value = 105
+    mock_random.return_value = 0.5
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': 110, 'd': 2})
+
+    @unit.cached(ttl=10, early_recompute=1.0)
+    def test(a):
+        return a
+
+    assert test("testing") == b"cached"
+    assert unit.put.call_count == 0
+
+@mock.patch('cachual.random.random')
+@mock.patch('cachual.time.time')
+def test_early_recompute_triggered(mock_time, mock_random):
+    # -2 * 1.0 * log(1 - 0.5) ~= 1.39, so the value is expired at 109.
+    mock_time.return_value = 109
+    mock_random.return_value = 0.5
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': 110, 'd': 2})
+
+    @unit.cached(ttl=10, early_recompute=1.0)
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    assert unit.put.call_count == 1
+
+@mock.patch('cachual.random.random')
+@mock.patch('cachual.time.time')
+def test_early_recompute_with_stale_refreshes(mock_time, mock_random):
+    mock_time.return_value = 109
+    mock_random.return_value = 0.5
+    unit = get_unit()
+    unit.get.return_value = _wrap_value(b"cached", {'f': 110, 'd': 2})
+    unit._get_refresh_pool = MagicMock()
+
+    @unit.cached(ttl=10, stale_ttl=10, early_recompute=1.0)
+    def test(a):
+        return a
+
+    assert test("testing") == b"cached"
+    assert unit._get_refresh_pool.return_value.submit.call_count == 1
+    assert unit.put.call_count == 0
+
+def test_early_recompute_legacy_value():
+    unit = get_unit()
+    unit.get.return_value = b"cached"
+
+    @unit.cached(ttl=10, early_recompute=1.0)
+    def test(a):
+        return a
+
+    assert test("testing") == b"cached"
+
+def get_many_unit():
+    unit = CachualCache()
+    unit.get_many = MagicMock(return_value={})
+    unit.put_many = MagicMock()
+    unit._get_key_builder = MagicMock(return_value=MagicMock(
+            side_effect=lambda args, kwargs: "key%s" % args[0]))
+    return unit
+
+def test_default_get_many():
+    unit = get_unit()
+    unit.get.side_effect = lambda key: None if key == "b" else key.upper()
+    assert unit.get_many(["a", "b", "c"]) == {"a": "A", "c": "C"}
+
+def test_default_put_many():
+    unit = get_unit()
+    unit.put_many({"a": 1}, 5)
+    unit.put.assert_called_with("a", 1, 5)
+
+def test_cached_many_all_hits():
+    unit = get_many_unit()
+    unit.get_many.return_value = {"key1": "one", "key2": "two"}
+    calls = []
+
+    @unit.cached_many()
+    def test(ids):
+        calls.append(ids)
+        return {}
+
+    assert test([1, 2]) == {1: "one", 2: "two"}
+    unit.get_many.assert_called_with(["key1", "key2"])
+    assert calls == []
+    assert unit.put_many.call_count == 0
+
+def test_cached_many_partial_miss():
+    unit = get_many_unit()
+    unit.get_many.return_value = {"key1": "one"}
+    calls = []
+
+    @unit.cached_many(ttl=10, pack=str.upper)
+    def test(ids, suffix):
+        calls.append(ids)
+        return dict((i, "%s%s" % (i, suffix)) for i in ids)
+
+    assert test([1, 2, 3, 2], "x") == {1: "one", 2: "2x", 3: "3x"}
+    assert calls == [[2, 3]]
+    unit.put_many.assert_called_with({"key2": "2X", "key3": "3X"}, 10)
+
+def test_cached_many_unpack():
+    unit = get_many_unit()
+    unit.get_many.return_value = {"key1": "1"}
+
+    @unit.cached_many(unpack=int)
+    def test(ids):
+        return {}
+
+    assert test((1,)) == {1: 1}
+
+def test_cached_many_ids_arg():
+    unit = get_many_unit()
+    unit._get_key_builder.return_value.side_effect = \
+            lambda args, kwargs: "key%s" % args[1]
+
+    class Test(object):
+        @unit.cached_many(ids_arg=1)
+        def test(self, ids):
+            return dict((i, i) for i in ids)
+
+    assert Test().test(set([1])) == {1: 1}
+    unit.put_many.assert_called_with({"key1": 1}, None)
+
+def test_cached_many_ids_keyword():
+    unit = get_many_unit()
+    unit._get_key_builder = CachualCache()._get_key_builder
+    calls = []
+
+    @unit.cached_many()
+    def test(ids, suffix):
+        calls.append(ids)
+        return dict((i, "%s%s" % (i, suffix)) for i in ids)
+
+    assert test(ids=[1, 2], suffix="x") == {1: "1x", 2: "2x"}
+    assert calls == [[1, 2]]
+
+    # The keys are the same as when the ids are passed by position.
+    unit.get_many.return_value = unit.put_many.call_args[0][0]
+    assert test([1, 2], "x") == {1: "1x", 2: "2x"}
+    assert test(suffix="x", ids=(2,)) == {2: "2x"}
+    assert calls == [[1, 2]]
+
+def test_cached_many_ids_missing():
+    unit = get_many_unit()
+
+    @unit.cached_many(ids_arg=1)
+    def test(a, ids=()):
+        return {}
+
+    with pytest.raises(TypeError):
+        test(1)
+
+def test_cached_many_returns_none():
+    unit = get_many_unit()
+
+    @unit.cached_many()
+    def test(ids):
+        return None
+
+    assert test([1, 2]) == {}
+    assert unit.put_many.call_count == 0
+
+def test_cached_many_missing_not_cached():
+    unit = get_many_unit()
+
+    @unit.cached_many()
+    def test(ids):
+        return {1: None}
+
+    assert test([1, 2]) == {1: None}
+    assert unit.put_many.call_count == 0
+
+def test_cached_many_errors():
+    unit = get_many_unit()
+    unit.get_many.side_effect = Exception("test")
+    unit.put_many.side_effect = Exception("test")
+
+    @unit.cached_many()
+    def test(ids):
+        return dict((i, i) for i in ids)
+
+    assert test([1, 2]) == {1: 1, 2: 2}
+    assert unit.put_many.call_count == 1
+
+def test_unstable_key_bypasses_cache():
+    unit = CachualCache()
+    unit.get = MagicMock()
+    unit.put = MagicMock()
+
+    @unit.cached()
+    def test(a):
+        return "value"
+
+    assert test(object()) == "value"
+    assert unit.get.call_count == 0
+    assert unit.put.call_count == 0
+
+def test_cached_many_unstable_key_bypasses_cache():
+    unit = CachualCache()
+    unit.get_many = MagicMock()
+    unit.put_many = MagicMock()
+
+    @unit.cached_many()
+    def test(ids, a):
+        return dict((i, i) for i in ids)
+
+    assert test([1, 2], object()) == {1: 1, 2: 2}
+    assert unit.get_many.call_count == 0
+    assert unit.put_many.call_count == 0
+
+def test_cache_codec():
+    unit = get_unit()
+    unit.get.return_value = None
+    value = {"pair": (1, 2), "raw": b"x"}
+
+    @unit.cached(codec="pickle")
+    def test(a):
+        return value
+
+    assert test(1) == value
+    packed = unit.put.call_args[0][1]
+    assert packed.startswith(b"\xfdp")
+
+    unit.get.return_value = packed
+    assert test(1) == value
+    assert unit.put.call_count == 1
+
+def test_cache_codec_rejects_other_codec():
+    unit = get_unit()
+    unit.get.return_value = get_codec("pickle").pack({"a": 1})
+
+    @unit.cached(codec="json")
+    def test(a):
+        return {"a": 2}
+
+    assert test(1) == {"a": 2}
+    unit.put.assert_called_with(KEY, b'\xfdj{"a":2}', None)
+
+def test_cache_default_codec():
+    unit = get_unit()
+    unit.codec = get_codec("json")
+    unit.get.return_value = None
+
+    @unit.cached()
+    def test(a):
+        return [a]
+
+    @unit.cached(pack=str)
+    def test_pack(a):
+        return [a]
+
+    test(1)
+    unit.put.assert_called_with(KEY, b"\xfdj[1]", None)
+    test_pack(1)
+    unit.put.assert_called_with(KEY, "[1]", None)
+
+def test_cache_codec_init():
+    unit = CachualCache(codec="pickle")
+    assert unit.codec is get_codec("pickle")
+    assert CachualCache().codec is None
+
+def test_cache_codec_with_pack():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        unit.cached(codec="json", pack=str)(lambda a: a)
+
+def test_cached_many_codec():
+    unit = get_many_unit()
+    unit.get_many.return_value = {"key1": get_codec("json").pack([1])}
+
+    @unit.cached_many(codec="json")
+    def test(ids):
+        return dict((i, [i]) for i in ids)
+
+    assert test([1, 2]) == {1: [1], 2: [2]}
+    unit.put_many.assert_called_with({"key2": b"\xfdj[2]"}, None)
+
+def test_cache_compress():
+    unit = get_unit()
+    unit.get.return_value = None
+    value = "a" * 2000
+
+    @unit.cached(compress="zlib", ttl=10, stale_ttl=10)
+    def test(a):
+        return value
+
+    assert test(1) == value
+    packed = unit.put.call_args[0][1]
+    assert packed.startswith(b"\xffz")
+    assert len(packed) < 100
+
+    unit.get.return_value = packed
+    assert test(1) == value.encode('utf-8')
+    assert unit.put.call_count == 1
+
+def test_cache_compress_returns_text():
+    unit = LocalCache()
+    put = unit.put
+    unit.put = MagicMock(side_effect=put)
+    value = u"\u00e9" * 2000
+    calls = []
+
+    @unit.cached(compress="zlib")
+    def test(a):
+        calls.append(a)
+        return value
+
+    assert test(1) == value
+    assert test(1) == value
+    assert calls == [1]
+    assert unit.put.call_args[0][1].startswith(b"\xffzs")
+
+def test_cache_compress_small_value():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(compress=ZlibCompressor(threshold=10))
+    def test(a):
+        return "small"
+
+    test(1)
+    unit.put.assert_called_with(KEY, "small", None)
+
+def test_cache_default_compress():
+    unit = CachualCache(compress=ZlibCompressor(threshold=1))
+    unit.get = MagicMock(return_value=None)
+    unit.put = MagicMock()
+
+    @unit.cached(codec="json")
+    def test(a):
+        return [a]
+
+    @unit.cached(compress=False)
+    def test_uncompressed(a):
+        return "value"
+
+    test(1)
+    packed = unit.put.call_args[0][1]
+    assert packed.startswith(b"\xffz")
+    unit.get.return_value = packed
+    assert test(1) == [1]
+
+    unit.get.return_value = None
+    test_uncompressed(1)
+    assert unit.put.call_args[0][1] == "value"
+
+def test_cached_many_compress():
+    unit = get_many_unit()
+    compressor = ZlibCompressor(threshold=1)
+    unit.get_many.return_value = {"key1": compressor.pack(b"one")}
+
+    @unit.cached_many(compress=compressor)
+    def test(ids):
+        return dict((i, b"two") for i in ids)
+
+    assert test([1, 2]) == {1: b"one", 2: b"two"}
+    assert unit.put_many.call_args[0][0]["key2"] == compressor.pack(b"two")
+
+def test_none_not_cached():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached()
+    def test(a):
+        return None
+
+    assert test(1) is None
+    assert unit.put.call_count == 0
+
+def test_cache_none():
+    unit = get_unit()
+    unit.get.return_value = None
+    calls = []
+
+    @unit.cached(ttl=10, cache_none=True, unpack=MagicMock())
+    def test(a):
+        calls.append(a)
+        return None
+
+    assert test(1) is None
+    packed, ttl = unit.put.call_args[0][1:]
+    assert ttl == 10
+    assert _unwrap_value(packed) == (b"", {"n": 1, "t": "b"})
+
+    unit.get.return_value = packed
+    assert test(1) is None
+    assert calls == [1]
+
+def test_negative_ttl():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(ttl=300, cache_none=True, negative_ttl=5)
+    def test(a):
+        return None if a is None else a
+
+    test(None)
+    assert unit.put.call_args[0][2] == 5
+    test("value")
+    unit.put.assert_called_with(KEY, "value", 300)
+
+def test_negative_ttl_requires_cache_none():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        unit.cached(negative_ttl=5)(lambda a: a)
+
+class OriginError(Exception):
+    pass
+
+class OriginTimeout(OriginError):
+    pass
+
+def test_cache_errors():
+    unit = get_unit()
+    unit.get.return_value = None
+    calls = []
+
+    @unit.cached(ttl=300, cache_errors=(OriginError,), error_ttl=5)
+    def test(a):
+        calls.append(a)
+        raise OriginTimeout("down", 3)
+
+    with pytest.raises(OriginTimeout):
+        test(1)
+    packed, ttl = unit.put.call_args[0][1:]
+    assert ttl == 5
+
+    unit.get.return_value = packed
+    with pytest.raises(OriginTimeout) as e:
+        test(1)
+    assert e.value.args == ("down", 3)
+    assert calls == [1]
+
+def test_uncached_errors():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(cache_errors=(OriginError,), error_ttl=5)
+    def test(a):
+        raise KeyError(a)
+
+    with pytest.raises(KeyError):
+        test(1)
+    assert unit.put.call_count == 0
+
+def test_cached_error_of_other_type_is_miss():
+    unit = get_unit()
+    unit.get.return_value = _wrap_value('["x"]', {"e": "builtins.KeyError"})
+
+    @unit.cached(cache_errors=(OriginError,), error_ttl=5)
+    def test(a):
+        return "value"
+
+    assert test(1) == "value"
+
+def test_cache_errors_requires_error_ttl():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        unit.cached(cache_errors=(OriginError,))(lambda a: a)
+
+def _open_circuit(unit, test):
+    unit.get.side_effect = Exception("down")
+    unit.put.side_effect = Exception("down")
+    for i in range(3):
+        test(i)
+    assert unit.get.call_count == 3
+    assert unit.put.call_count == 2
+    unit.get.reset_mock()
+    unit.put.reset_mock()
+
+@mock.patch("cachual._now")
+def test_circuit_opens(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit()
+    unit.circuit_threshold = 5
+
+    @unit.cached()
+    def test(a):
+        return "value"
+
+    _open_circuit(unit, test)
+    assert test(1) == "value"
+    assert unit.get.call_count == 0
+    assert unit.put.call_count == 0
+
+@mock.patch("cachual._now")
+def test_circuit_half_open_probe(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit()
+    unit.circuit_threshold = 5
+    unit.circuit_reset_timeout = 10
+
+    @unit.cached()
+    def test(a):
+        return "value"
+
+    _open_circuit(unit, test)
+
+    # A failed probe keeps the circuit open for another reset timeout.
+    mock_now.return_value = 110
+    test(1)
+    assert unit.get.call_count == 1
+    assert unit.put.call_count == 0
+    mock_now.return_value = 119
+    test(1)
+    assert unit.get.call_count == 1
+
+    # A successful probe closes it.
+    mock_now.return_value = 120
+    unit.get.side_effect = None
+    unit.get.return_value = None
+    unit.put.side_effect = None
+    test(1)
+    test(1)
+    assert unit.get.call_count == 3
+    assert unit.put.call_count == 2
+
+def test_circuit_disabled():
+    unit = get_unit()
+    unit.circuit_threshold = None
+    unit.get.side_effect = Exception("down")
+
+    @unit.cached()
+    def test(a):
+        return "value"
+
+    for i in range(10):
+        test(i)
+    assert unit.get.call_count == 10
+
+@mock.patch("cachual._now")
+def test_circuit_open_lease(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit()
+    unit.circuit_threshold = 1
+    unit.get.side_effect = Exception("down")
+
+    @unit.cached(lease_ttl=5)
+    def test(a):
+        return "value"
+
+    assert test(1) == "value"
+    assert test(1) == "value"
+    assert unit.add.call_count == 0
+    assert unit.get.call_count == 1
+
+def test_circuit_cached_many():
+    unit = get_many_unit()
+    unit.circuit_threshold = 1
+    unit.get_many.side_effect = Exception("down")
+
+    @unit.cached_many()
+    def test(ids):
+        return dict((i, i) for i in ids)
+
+    assert test([1]) == {1: 1}
+    assert test([1]) == {1: 1}
+    assert unit.get_many.call_count == 1
+    assert unit.put_many.call_count == 0
+
+def _slow(value, delay=0.5):
+    def call(*args):
+        time.sleep(delay)
+        return value
+    return call
+
+def test_get_timeout():
+    unit = get_unit()
+    unit.get.side_effect = _slow("cached")
+
+    @unit.cached(get_timeout=0.01)
+    def test(a):
+        return "value"
+
+    assert test(1) == "value"
+    assert unit.metrics == {"get_timeout": 1}
+
+def test_get_within_timeout():
+    unit = get_unit()
+    unit.get.return_value = "cached"
+
+    @unit.cached(get_timeout=1)
+    def test(a):
+        return "value"
+
+    assert test(1) == "cached"
+    assert unit.metrics == {}
+
+def test_default_timeouts():
+    unit = CachualCache(get_timeout=0.01, put_timeout=0.01)
+    unit.get = MagicMock(side_effect=_slow(None))
+    unit.put = MagicMock(side_effect=_slow(None))
+
+    @unit.cached()
+    def test(a):
+        return "value"
+
+    start = time.time()
+    assert test(1) == "value"
+    assert time.time() - start < 0.4
+    assert unit.metrics == {"get_timeout": 1, "put_timeout": 1}
+
+def test_timeouts_open_circuit():
+    unit = get_unit()
+    unit.circuit_threshold = 4
+    unit.get.side_effect = _slow("cached", 0.2)
+    unit.put.side_effect = _slow(None, 0.2)
+
+    @unit.cached(get_timeout=0.01, put_timeout=0.01)
+    def test(a):
+        return a
+
+    assert test(1) == 1
+    assert test(2) == 2
+    assert test(3) == 3
+    assert unit.get.call_count == 2
+
+    # The abandoned calls finishing doesn't close the circuit.
+    time.sleep(0.5)
+    assert test(4) == 4
+    assert unit.get.call_count == 2
+
+def test_io_queue_full():
+    unit = get_unit()
+    unit.io_workers = 1
+    unit.io_queue_size = 1
+    unit.get.return_value = "cached"
+    release = threading.Event()
+
+    @unit.cached(get_timeout=0.01)
+    def test(a):
+        return "value"
+
+    unit._submit_io(release.wait, 5)
+    # Queued behind the blocked worker, then cancelled when it times out.
+    assert test(1) == "value"
+    unit._submit_io(release.wait, 5)
+    # Skipped without waiting, as the queue is full.
+    start = time.time()
+    assert test(2) == "value"
+    assert time.time() - start < 0.01
+    release.set()
+    time.sleep(0.05)
+    assert unit.get.call_count == 0
+    assert unit.metrics == {"get_timeout": 1, "io_queue_full": 1}
+
+def test_race_origin_wins():
+    unit = get_unit()
+    unit.get.side_effect = _slow("cached")
+
+    @unit.cached(race_origin=True, get_timeout=0.01)
+    def test(a):
+        return "value"
+
+    assert test(1) == "value"
+    assert unit.metrics == {"origin_won": 1}
+    unit.put.assert_called_with(KEY, "value", None)
+
+def test_race_cache_wins():
+    unit = get_unit()
+    unit.get.side_effect = _slow("cached", 0.05)
+    done = threading.Event()
+
+    @unit.cached(race_origin=True, get_timeout=0.01)
+    def test(a):
+        time.sleep(0.5)
+        done.set()
+        return "value"
+
+    assert test(1) == "cached"
+    assert unit.metrics == {"cache_won": 1}
+    assert done.wait(5)
+
+def test_race_cache_miss():
+    unit = get_unit()
+    unit.get.side_effect = _slow(None, 0.05)
+
+    @unit.cached(race_origin=True, get_timeout=0)
+    def test(a):
+        time.sleep(0.2)
+        return "value"
+
+    assert test(1) == "value"
+    assert unit.metrics == {"origin_won": 1}
+
+def test_race_fast_cache():
+    unit = get_unit()
+    unit.get.return_value = "cached"
+
+    @unit.cached(race_origin=True, get_timeout=1)
+    def test(a):
+        return "value"
+
+    assert test(1) == "cached"
+    assert unit.metrics == {}
+
+def test_race_origin_requires_get_timeout():
+    unit = get_unit()
+    with pytest.raises(ValueError):
+        unit.cached(race_origin=True)(lambda a: a)
+
+def test_race_origin_separate_pool():
+    unit = get_unit()
+    unit.io_workers = 1
+    unit.origin_workers = 1
+    unit.get.side_effect = _slow(None, 0.2)
+    release = threading.Event()
+
+    @unit.cached(race_origin=True, get_timeout=0)
+    def test(a):
+        release.wait(5)
+        return a
+
+    # The origin pool is busy, but cache calls still get a thread.
+    thread = threading.Thread(target=test, args=(1,))
+    thread.start()
+    time.sleep(0.05)
+    assert unit._get_io_pool().submit(lambda: "io").future.result(1) == "io"
+    release.set()
+    thread.join(5)
+
+def test_record_metric():
+    unit = get_unit()
+    unit.record_metric("a")
+    unit.record_metric("a", 2)
+    assert unit.metrics == {"a": 3}
+
+def test_invalidate():
+    unit = get_unit()
+
+    @unit.cached()
+    def test(a):
+        return a
+
+    test.invalidate("testing")
+    unit.delete.assert_called_with(KEY)
+
+def test_invalidate_all_requires_namespace():
+    unit = get_unit()
+
+    @unit.cached()
+    def test(a):
+        return a
+
+    with pytest.raises(ValueError):
+        test.invalidate_all()
+
+def test_namespace_generation():
+    unit = get_unit()
+    unit.get.side_effect = lambda key: {
+        _generation_key("users"): "abc"}.get(key)
+
+    @unit.cached(namespace="users")
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    unit.put.assert_called_with(KEY + ":abc", "testing", None)
+    test.invalidate("testing")
+    unit.delete.assert_called_with(KEY + ":abc")
+
+def test_namespace_new_generation():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(namespace="users")
+    def test(a):
+        return a
+
+    test("testing")
+    key, generation, ttl = unit.add.call_args_list[0][0]
+    assert (key, ttl) == (_generation_key("users"), None)
+    unit.put.assert_called_with(KEY + ":" + generation, "testing", None)
+
+def test_namespace_new_generation_race():
+    unit = get_unit()
+    unit.get.side_effect = [None, "other", None]
+    unit.add.return_value = False
+
+    @unit.cached(namespace="users")
+    def test(a):
+        return a
+
+    test("testing")
+    assert unit.add.call_args_list[0][0][0] == _generation_key("users")
+    unit.put.assert_called_with(KEY + ":other", "testing", None)
+
+@mock.patch("cachual._now")
+def test_namespace_generation_kept_locally(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit()
+    unit.get.side_effect = lambda key: {
+        _generation_key("users"): "abc"}.get(key)
+
+    @unit.cached(namespace="users")
+    def test(a):
+        return a
+
+    test("testing")
+    test("testing")
+    generation_gets = [c for c in unit.get.call_args_list
+                       if c[0][0] == _generation_key("users")]
+    assert len(generation_gets) == 1
+
+    mock_now.return_value = 100 + unit.generation_ttl + 1
+    test("testing")
+    generation_gets = [c for c in unit.get.call_args_list
+                       if c[0][0] == _generation_key("users")]
+    assert len(generation_gets) == 2
+
+def test_invalidate_namespace():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(namespace=True)
+    def test(a):
+        return a
+
+    test("testing")
+    old_key = unit.put.call_args[0][0]
+    test.invalidate_all()
+    test("testing")
+    new_key = unit.put.call_args[0][0]
+    assert old_key != new_key
+    assert old_key.startswith(KEY + ":")
+    assert new_key.startswith(KEY + ":")
+
+def test_namespace_generation_error_bypasses_cache():
+    unit = get_unit()
+    unit.get.side_effect = Exception("Error!")
+
+    @unit.cached(namespace="users")
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    assert unit.put.call_count == 0
+
+def test_cached_many_namespace():
+    unit = get_many_unit()
+    unit.get = MagicMock(return_value="abc")
+    unit.delete = MagicMock()
+    unit.get_many.return_value = {"key1:abc": "one"}
+
+    @unit.cached_many(namespace="users")
+    def test(ids):
+        return dict((i, str(i)) for i in ids)
+
+    assert test([1, 2]) == {1: "one", 2: "2"}
+    unit.put_many.assert_called_with({"key2:abc": "2"}, None)
+    test.invalidate([1, 2])
+    unit.delete.assert_any_call("key1:abc")
+    unit.delete.assert_any_call("key2:abc")
+
+def get_dict_unit():
+    unit = get_unit()
+    values = {}
+    unit.get.side_effect = values.get
+    unit.put.side_effect = lambda key, value, ttl=None: values.update(
+            {key: value})
+    def add(key, value, ttl=None):
+        if key in values:
+            return False
+        values[key] = value
+        return True
+    unit.add.side_effect = add
+    return unit, values
+
+def test_tags():
+    unit, values = get_dict_unit()
+    calls = []
+
+    @unit.cached(tags=["user:42"])
+    def test(a):
+        calls.append(a)
+        return a
+
+    assert test("testing") == "testing"
+    version = values[_tag_key("user:42")]
+    value, meta = _unwrap_value(values[KEY])
+    assert value == b"testing"
+    assert meta["g"] == {"user:42": version}
+    assert test("testing") == b"testing"
+    assert calls == ["testing"]
+
+    unit.invalidate_tags("user:42")
+    assert values[_tag_key("user:42")] != version
+    assert test("testing") == "testing"
+    assert calls == ["testing", "testing"]
+
+@mock.patch("cachual._now")
+def test_tags_invalidated_by_other_process(mock_now):
+    mock_now.return_value = 100
+    unit, values = get_dict_unit()
+    calls = []
+
+    @unit.cached(tags=["user:42", "team:1"])
+    def test(a):
+        calls.append(a)
+        return a
+
+    test("testing")
+    values[_tag_key("team:1")] = "other"
+    test("testing")
+    assert calls == ["testing"]
+
+    mock_now.return_value = 100 + unit.generation_ttl + 1
+    test("testing")
+    assert calls == ["testing", "testing"]
+
+def test_computed_tags():
+    unit, values = get_dict_unit()
+
+    @unit.cached(tags=lambda value, a: ["user:%s" % value["id"]])
+    def test(a):
+        return {"id": a}
+
+    test(42)
+    assert _tag_key("user:42") in values
+    _, meta = _unwrap_value(values[KEY])
+    assert list(meta["g"]) == ["user:42"]
+
+def test_tags_error_not_cached():
+    unit = get_unit()
+    unit.get.side_effect = Exception("Error!")
+
+    @unit.cached(tags=["user:42"])
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    assert unit.put.call_count == 0
+
+def test_computed_tags_error_not_cached():
+    unit = get_unit()
+    unit.get.return_value = None
+
+    @unit.cached(tags=lambda value, a: [value["id"]])
+    def test(a):
+        return a
+
+    assert test("testing") == "testing"
+    assert unit.put.call_count == 0
+
+def test_invalidate_tags_single_put_many():
+    unit = get_unit()
+    unit.put_many = MagicMock()
+    unit.invalidate_tags("user:42", "team:1")
+    assert unit.put_many.call_count == 1
+    assert sorted(unit.put_many.call_args[0][0]) == sorted([
+            _tag_key("team:1"), _tag_key("user:42")])
+    assert unit.put_many.call_args[0][1] == unit.tag_ttl
+
+def test_tag_versions_expire():
+    unit, values = get_dict_unit()
+    unit.tag_ttl = 60
+
+    @unit.cached(ttl=30, tags=["user:42"])
+    def test(a):
+        return a
+
+    test("testing")
+    unit.add.assert_any_call(_tag_key("user:42"),
+            values[_tag_key("user:42")], 60)
+
+def test_tag_and_namespace_keys_hashed():
+    # Valid Memcached keys, whatever the tag or namespace contains.
+    for name in ("user 42", u"caf\xe9", "x" * 300):
+        for key in (_tag_key(name), _generation_key(name)):
+            assert len(key) < 250
+            assert " " not in key
+    assert _tag_key("a") != _tag_key("b")
+    assert _tag_key("a") != _generation_key("a")
+
+def test_max_generations():
+    unit = get_unit()
+    unit.max_generations = 2
+    for tag in ("a", "b", "c"):
+        unit._remember_generation(tag, tag + "1")
+    assert unit._recall_generation("a") is None
+    assert unit._recall_generation("b") == "b1"
+    assert unit._recall_generation("c") == "c1"
+
+def test_new_tag_version_race():
+    unit, values = get_dict_unit()
+    # Another process adds a version between our get_many and add.
+    def get_many(keys):
+        values[_tag_key("user:42")] = "theirs"
+        return {}
+    unit.get_many = MagicMock(side_effect=get_many)
+    assert unit._get_tag_versions(["user:42"]) == {"user:42": "theirs"}
+    assert values[_tag_key("user:42")] == "theirs"
+
+def test_tags_invalidated_during_call():
+    unit, values = get_dict_unit()
+    calls = []
+
+    @unit.cached(tags=["user:42"])
+    def test(a):
+        calls.append(a)
+        if len(calls) == 1:
+            unit.invalidate_tags("user:42")
+        return a
+
+    test("testing")
+    test("testing")
+    assert calls == ["testing", "testing"]
+
+def test_unstable_key_warned_once():
+    unit = get_unit()
+    unit._get_key_builder = CachualCache()._get_key_builder
+    unit.logger = MagicMock()
+
+    class Test(object):
+        @unit.cached()
+        def test(self, a):
+            return a
+
+    assert Test().test(1) == 1
+    assert Test().test(2) == 2
+    assert unit.get.call_count == 0
+    assert unit.logger.warn.call_count == 1
+    assert "exc_info" not in unit.logger.warn.call_args[1]
@@ -0,0 +1,81 @@
+from cachual import (Codec, JSONCodec, PickleCodec, get_codec,
+                     register_codec, _CODECS)
+
+import datetime, pytest
+
+class UpperCodec(Codec):
+    name = 'upper'
+    id = b'u'
+
+    def dumps(self, value):
+        return value.upper().encode('utf-8')
+
+    def loads(self, data):
+        return data.decode('utf-8')
+
+def test_pickle_codec_round_trips_types():
+    codec = get_codec('pickle')
+    value = {'when': datetime.datetime(2020, 1, 2, 3, 4, 5),
+             'pair': (1, 2), 'raw': b'\x00\xff', 'nested': [set([1])]}
+    packed = codec.pack(value)
+    assert packed.startswith(b'\xfdp')
+    assert codec.unpack(packed) == value
+
+def test_json_codec_round_trip():
+    codec = get_codec('json')
+    packed = codec.pack({'a': [1, 2]})
+    assert packed == b'\xfdj{"a":[1,2]}'
+    assert codec.unpack(packed) == {'a': [1, 2]}
+
+def test_unpack_rejects_other_codec():
+    packed = get_codec('pickle').pack([1, 2])
+    with pytest.raises(ValueError):
+        get_codec('json').unpack(packed)
+    with pytest.raises(ValueError):
+        get_codec('pickle').unpack(get_codec('json').pack([1, 2]))
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        Codec()
+
+    class NoLoads(Codec):
+        def dumps(self, value):
+            return b''
+
+    with pytest.raises(TypeError):
+        NoLoads()
+
+def test_unpack_without_header():
+    assert JSONCodec().unpack(b'{"a": 1}') == {'a': 1}
+    assert JSONCodec().unpack(u'{"a": 1}') == {'a': 1}
+
+def test_unpack_unknown_codec():
+    with pytest.raises(ValueError):
+        JSONCodec().unpack(b'\xfdz{}')
+
+def test_unregistered_codec_unpacks_its_own_values():
+    codec = UpperCodec()
+    assert codec.unpack(codec.pack('abc')) == 'ABC'
+
+def test_register_codec():
+    codec = UpperCodec()
+    try:
+        register_codec(codec)
+        assert get_codec('upper') is codec
+        with pytest.raises(ValueError):
+            JSONCodec().unpack(codec.pack('abc'))
+    finally:
+        del _CODECS['upper']
+
+def test_register_codec_bad_id():
+    codec = UpperCodec()
+    codec.id = b'uu'
+    with pytest.raises(ValueError):
+        register_codec(codec)
+
+def test_get_codec():
+    codec = PickleCodec(protocol=2)
+    assert get_codec(codec) is codec
+    assert isinstance(get_codec('json'), JSONCodec)
+    with pytest.raises(ValueError):
+        get_codec('nope')
@@ -0,0 +1,94 @@
+from cachual import (Compressor, ZlibCompressor,
+                     get_compressor, register_compressor, _decompress,
+                     _COMPRESSORS, _COMPRESSORS_BY_ID)
+
+import pytest, zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+needs_lz4 = pytest.mark.skipif(lz4 is None, reason="lz4 is not installed")
+
+class ReverseCompressor(Compressor):
+    name = 'reverse'
+    id = b'r'
+
+    def compress(self, data):
+        return data[::-1]
+
+    def decompress(self, data):
+        return data[::-1]
+
+def test_zlib_round_trip():
+    compressor = ZlibCompressor(level=1, threshold=10)
+    data = b'a' * 100
+    packed = compressor.pack(data)
+    assert packed.startswith(b'\xffzb')
+    assert len(packed) < len(data)
+    assert zlib.decompress(packed[3:]) == data
+    assert _decompress(packed) == data
+
+def test_below_threshold_not_compressed():
+    compressor = ZlibCompressor(threshold=10)
+    assert compressor.pack(b'short') == b'short'
+    assert compressor.pack(u'short') == u'short'
+
+def test_unicode_compressed_as_utf8():
+    compressor = ZlibCompressor(threshold=1)
+    packed = compressor.pack(u'\u00e9' * 10)
+    assert packed.startswith(b'\xffzs')
+    assert _decompress(packed) == (u'\u00e9' * 10).encode('utf-8')
+
+def test_unicode_decompressed_as_text():
+    compressor = ZlibCompressor(threshold=1)
+    assert _decompress(compressor.pack(u'\u00e9' * 10), text=True) == (
+            u'\u00e9' * 10)
+    assert _decompress(compressor.pack(b'a' * 10), text=True) == b'a' * 10
+
+def test_compressor_is_abstract():
+    with pytest.raises(TypeError):
+        Compressor()
+
+def test_decompress_leaves_other_values():
+    assert _decompress(u'value') == u'value'
+    assert _decompress(b'value') == b'value'
+    assert _decompress(b'\xffqdata') == b'\xffqdata'
+    assert _decompress(b'\xffzbnot zlib') == b'\xffzbnot zlib'
+    assert _decompress(b'\xffzx' + zlib.compress(b'a')) == (
+            b'\xffzx' + zlib.compress(b'a'))
+
+def test_decompress_unregistered_compressor():
+    compressor = ReverseCompressor(threshold=1)
+    packed = compressor.pack(b'abc')
+    assert _decompress(packed) == packed
+    assert _decompress(packed, compressor) == b'abc'
+    assert _decompress(ZlibCompressor(threshold=1).pack(b'abc'),
+            compressor) == b'abc'
+
+def test_register_compressor():
+    compressor = ReverseCompressor(threshold=1)
+    try:
+        register_compressor(compressor)
+        assert get_compressor('reverse') is compressor
+        assert _decompress(compressor.pack(b'abc')) == b'abc'
+    finally:
+        del _COMPRESSORS['reverse']
+        del _COMPRESSORS_BY_ID[b'r']
+
+def test_get_compressor():
+    compressor = ZlibCompressor()
+    assert get_compressor(compressor) is compressor
+    assert isinstance(get_compressor('zlib'), ZlibCompressor)
+    with pytest.raises(ValueError):
+        get_compressor('nope')
+
+@needs_lz4
+def test_lz4_round_trip():
+    compressor = get_compressor('lz4')
+    data = b'a' * 2000
+    packed = compressor.pack(data)
+    assert packed.startswith(b'\xff4b')
+    assert len(packed) < len(data)
+    assert _decompress(packed) == data
@@ -0,0 +1,191 @@
+from cachual import DiskCache
+
+from mock import MagicMock, mock
+
+import gc, multiprocessing, sqlite3, time, weakref
+
+def get_unit(tmpdir, **kwargs):
+    return DiskCache(str(tmpdir.join("cache.db")), **kwargs)
+
+def count(unit):
+    return unit._connection().execute(
+            "SELECT COUNT(*) FROM cachual").fetchone()[0]
+
+def test_get_put(tmpdir):
+    unit = get_unit(tmpdir)
+    assert unit.get("key") is None
+    unit.put("key", b"value")
+    unit.put("text", u"\u00e9t\u00e9")
+    unit.put("number", 42)
+    assert unit.get("key") == b"value"
+    assert unit.get("text") == u"\u00e9t\u00e9"
+    assert unit.get("number") == u"42"
+    unit.flush()
+    assert unit.get("key") == b"value"
+    assert unit.get("text") == u"\u00e9t\u00e9"
+
+def test_persistent(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("key", b"value")
+    unit.close()
+    assert get_unit(tmpdir).get("key") == b"value"
+
+def test_wal(tmpdir):
+    unit = get_unit(tmpdir)
+    assert unit._connection().execute(
+            "PRAGMA journal_mode").fetchone()[0] == "wal"
+
+def test_ttl(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("key", b"value", 0.05)
+    unit.put("forever", b"value")
+    unit.flush()
+    assert unit.get("key") == b"value"
+    time.sleep(0.1)
+    assert unit.get("key") is None
+    assert unit.get("forever") == b"value"
+
+def test_batched_puts(tmpdir):
+    unit = get_unit(tmpdir, batch_size=3, flush_interval=60)
+    other = get_unit(tmpdir)
+    unit.put("a", b"a")
+    unit.put("b", b"b")
+    assert count(unit) == 0
+    assert unit.get("a") == b"a"
+    assert other.get("a") is None
+    unit.put("c", b"c")
+    assert count(unit) == 3
+    assert other.get("a") == b"a"
+
+def test_flush_interval(tmpdir):
+    unit = get_unit(tmpdir, flush_interval=0.01)
+    unit.put("a", b"a")
+    time.sleep(0.2)
+    assert count(unit) == 1
+
+def test_flushes_share_connection(tmpdir):
+    connect = MagicMock(side_effect=sqlite3.connect)
+    with mock.patch("cachual.sqlite3.connect", connect):
+        unit = get_unit(tmpdir, flush_interval=0.01)
+        for i in range(20):
+            unit.put("key%d" % i, b"value")
+            time.sleep(0.03)
+        assert count(unit) == 20
+    # One connection for writes, and one for this thread's reads.
+    assert connect.call_count == 2
+
+def test_read_times_written_with_puts(tmpdir):
+    unit = get_unit(tmpdir, flush_interval=0.01)
+    unit.put("key", b"value")
+    time.sleep(0.1)
+    unit._transaction = MagicMock(wraps=unit._transaction)
+    start = time.time()
+    for i in range(10):
+        assert unit.get("key") == b"value"
+    time.sleep(0.1)
+    assert unit._transaction.call_count == 0
+    unit.put("other", b"value")
+    unit.flush()
+    assert unit._connection().execute("SELECT accessed FROM cachual "
+            "WHERE key = 'key'").fetchone()[0] >= start
+
+def test_access_batch_size(tmpdir):
+    unit = get_unit(tmpdir, flush_interval=0.01)
+    unit.access_batch_size = 2
+    unit.put_many({"a": b"a", "b": b"b"})
+    time.sleep(0.1)
+    unit._transaction = MagicMock(wraps=unit._transaction)
+    unit.get("a")
+    unit.get("a")
+    time.sleep(0.1)
+    assert unit._transaction.call_count == 0
+    unit.get("b")
+    time.sleep(0.1)
+    assert unit._transaction.call_count == 1
+
+def test_close(tmpdir):
+    unit = get_unit(tmpdir, flush_interval=60)
+    unit.put("key", b"value")
+    flusher = unit._flusher
+    unit.close()
+    assert not flusher.is_alive()
+    assert get_unit(tmpdir).get("key") == b"value"
+    ref = weakref.ref(unit)
+    del unit
+    gc.collect()
+    assert ref() is None
+
+def test_add(tmpdir):
+    unit = get_unit(tmpdir)
+    assert unit.add("key", b"value", 0.05)
+    assert not unit.add("key", b"other")
+    unit.put("pending", b"value")
+    assert not unit.add("pending", b"other")
+    time.sleep(0.1)
+    assert unit.add("key", b"other")
+    assert unit.get("key") == b"other"
+
+def test_delete(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("pending", b"value")
+    unit.put("written", b"value")
+    unit.flush()
+    unit.put("pending", b"new")
+    unit.delete("pending")
+    unit.delete("written")
+    assert unit.get("pending") is None
+    assert unit.get("written") is None
+    unit.flush()
+    assert count(unit) == 0
+
+def test_delete_if_equal(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("pending", b"value")
+    unit.put("written", b"value")
+    unit.flush()
+    unit.put("pending", b"new")
+    assert not unit.delete_if_equal("pending", b"value")
+    assert unit.delete_if_equal("pending", b"new")
+    assert not unit.delete_if_equal("written", b"other")
+    assert unit.delete_if_equal("written", b"value")
+    assert unit.get("pending") is None
+    assert unit.get("written") is None
+
+def test_eviction(tmpdir):
+    unit = get_unit(tmpdir, max_bytes=1000, batch_size=1)
+    unit.put("old", b"x" * 397)
+    unit.put("new", b"x" * 397)
+    unit.get("old")
+    unit.put("newest", b"x" * 394)
+    assert unit.get("old") == b"x" * 397
+    assert unit.get("new") is None
+    assert unit.get("newest") == b"x" * 394
+    assert unit._connection().execute(
+            "SELECT size FROM cachual_size").fetchone()[0] == 800
+
+def test_flush_error_logged(tmpdir):
+    unit = get_unit(tmpdir, batch_size=1)
+    unit.logger = MagicMock()
+    unit._transaction = MagicMock(side_effect=Exception("Error!"))
+    unit.put("key", b"value")
+    assert unit.logger.warn.call_count == 1
+    assert unit.get("key") == b"value"
+
+def _put_in_child(path):
+    unit = DiskCache(path)
+    for i in range(50):
+        unit.put("key%d" % i, b"value")
+    unit.flush()
+
+def test_processes(tmpdir):
+    unit = get_unit(tmpdir)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_put_in_child, args=(unit.path,))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert count(unit) == 50
+    assert unit.get("key42") == b"value"
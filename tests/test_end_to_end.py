@@ -1,4 +1,4 @@
-from cachual import CachualCache
+from cachual import CachualCache, _encode_key_arg
 
 from mock import MagicMock
 
@@ -28,7 +28,7 @@ def test_function():
     
     a = 'a'
     b = 'b'
-    expected_key = get_hash('test_end_to_end.testing(a, b=b)')
+    expected_key = get_hash("test_end_to_end.testing('a', 'b')")
     testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
@@ -47,7 +47,8 @@ def test_classmethod():
     
     a = 'a'
     b = 'b'
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % Test)
+    expected_key = get_hash("test_end_to_end.testing(%s, 'a', 'b')" %
+            _encode_key_arg(Test))
     Test().testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
@@ -55,6 +56,8 @@ def test_classmethod():
 
 def test_instancemethod():
     unit = get_unit()
+    unit.get.reset_mock()
+    unit.put.reset_mock()
 
     class Test(object):
         def __init__(self):
@@ -67,7 +70,31 @@ def test_instancemethod():
     a = 'a'
     b = 'b'
     t = Test()
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % t)
+    # The default representation of the instance includes its memory
+    # address, so the cache is bypassed.
+    assert t.testing(a, b=b) == 'test'
+
+    assert unit.get.call_count == 0
+    assert unit.put.call_count == 0
+
+def test_instancemethod_cachual_key():
+    unit = get_unit()
+
+    class Test(object):
+        def __init__(self, name):
+            self.name = name
+
+        def __cachual_key__(self):
+            return self.name
+        
+        @unit.cached()
+        def testing(self, a, b):
+            return 'test'
+    
+    a = 'a'
+    b = 'b'
+    t = Test('instance')
+    expected_key = get_hash("test_end_to_end.testing('instance', 'a', 'b')")
     t.testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
@@ -90,7 +117,8 @@ def test_subclass_classmethod():
     
     a = 'a'
     b = 'b'
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % SubTest)
+    expected_key = get_hash("test_end_to_end.testing(%s, 'a', 'b')" %
+            _encode_key_arg(SubTest))
     SubTest().testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
@@ -115,11 +143,12 @@ def test_subclass_instancemethod():
     a = 'a'
     b = 'b'
     t = SubTest()
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % t)
-    t.testing(a, b=b)
+    unit.get.reset_mock()
+    unit.put.reset_mock()
+    assert t.testing(a, b=b) == 'test'
 
-    unit.get.assert_called_with(expected_key)
-    unit.put.assert_called_with(expected_key, 'test', None)
+    assert unit.get.call_count == 0
+    assert unit.put.call_count == 0
 
 def test_instancemethod_use_class_for_self():
     unit = get_unit()
@@ -135,7 +164,8 @@ def test_instancemethod_use_class_for_self():
     a = 'a'
     b = 'b'
     t = Test()
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % Test)
+    expected_key = get_hash("test_end_to_end.testing(%s, 'a', 'b')" %
+            _encode_key_arg(Test))
     t.testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
@@ -159,7 +189,8 @@ def test_subclass_instancemethod_use_class_for_self():
     a = 'a'
     b = 'b'
     t = SubTest()
-    expected_key = get_hash('test_end_to_end.testing(%s, a, b=b)' % SubTest)
+    expected_key = get_hash("test_end_to_end.testing(%s, 'a', 'b')" %
+            _encode_key_arg(SubTest))
     t.testing(a, b=b)
 
     unit.get.assert_called_with(expected_key)
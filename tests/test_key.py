@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-from cachual import CachualCache
+from cachual import CachualCache, UnstableKeyError, _encode_key_arg
 
 from mock import MagicMock
 
-import hashlib, sys
+import hashlib, inspect, pytest, sys
+
+# Arguments are only normalised against the signature where inspect supports
+# it.
+needs_signature = pytest.mark.skipif(not hasattr(inspect, 'signature'),
+        reason="requires inspect.signature")
 
 def get_unit():
     return CachualCache()
@@ -29,6 +34,7 @@ def test_positional_args():
     key = get_unit()._get_key_from_func(test, [1, 2], None)
     assert key == get_hash('test.module.test(1, 2)')
 
+@needs_signature
 def test_kwargs():
     def test(a, b):
         pass
@@ -36,15 +42,16 @@ def test_kwargs():
 
     key = get_unit()._get_key_from_func(test, None,
             {'a': "test1", 'b': "test2"})
-    assert key == get_hash('test.module.test(a=test1, b=test2)')
+    assert key == get_hash("test.module.test('test1', 'test2')")
 
+@needs_signature
 def test_positional_and_kwargs():
     def test(a, b):
         pass
     test.__module__ = 'test.module'
 
     key = get_unit()._get_key_from_func(test, ['test1'], {'b': "test2"})
-    assert key == get_hash('test.module.test(test1, b=test2)')
+    assert key == get_hash("test.module.test('test1', 'test2')")
 
 def test_unicode():
     def test(a):
@@ -58,4 +65,217 @@ def test_unicode():
         uni = utf8_str.decode('utf-8')
 
     key = get_unit()._get_key_from_func(test, [utf8_str], None)
-    assert key == get_hash('test.module.test(%s)' % uni)
+    assert key == get_hash("test.module.test('%s')" % uni)
+
+@needs_signature
+def test_defaults():
+    def test(a, b=2):
+        pass
+    test.__module__ = 'test.module'
+
+    unit = get_unit()
+    key = unit._get_key_from_func(test, [1], None)
+    assert key == get_hash('test.module.test(1, 2)')
+    assert unit._get_key_from_func(test, [1, 2], None) == key
+    assert unit._get_key_from_func(test, [1], {'b': 2}) == key
+    assert unit._get_key_from_func(test, None, {'b': 2, 'a': 1}) == key
+
+@needs_signature
+def test_sentinel_default():
+    missing = object()
+    def test(a, b=missing, c=None):
+        pass
+    test.__module__ = 'test.module'
+
+    unit = get_unit()
+    key = unit._get_key_from_func(test, [1], None)
+    assert key == get_hash('test.module.test(1, <default b>, None)')
+    assert unit._get_key_from_func(test, [1], {'c': None}) == key
+    assert unit._get_key_from_func(test, [1, 2], None) != key
+    assert unit._get_key_from_func(test, [1, '<default b>'], None) != key
+    assert unit._get_key_from_func(test, [1, '<default b>', None],
+            None) != key
+
+@needs_signature
+def test_var_positional():
+    def test(a, *args):
+        pass
+    test.__module__ = 'test.module'
+
+    key = get_unit()._get_key_from_func(test, [1, 2, 3], None)
+    assert key == get_hash('test.module.test(1, 2, 3)')
+
+@needs_signature
+def test_keyword_only_and_var_keyword():
+    def test(*args, **kwargs):
+        pass
+    test.__module__ = 'test.module'
+    Parameter = inspect.Parameter
+    test.__signature__ = inspect.Signature([
+        Parameter('a', Parameter.POSITIONAL_OR_KEYWORD),
+        Parameter('b', Parameter.KEYWORD_ONLY, default=2),
+        Parameter('kwargs', Parameter.VAR_KEYWORD)])
+
+    key = get_unit()._get_key_from_func(test, None, {'z': 3, 'a': 1})
+    assert key == get_hash('test.module.test(1, b=2, z=3)')
+
+@needs_signature
+def test_positional_defaults():
+    default = [1]
+    def test(a, b=2, c='x', d=default):
+        pass
+    test.__module__ = 'test.module'
+
+    unit = get_unit()
+    key = unit._get_key_from_func(test, [1], None)
+    assert key == get_hash("test.module.test(1, 2, 'x', [1])")
+    assert unit._get_key_from_func(test, [1, 2], None) == key
+    assert unit._get_key_from_func(test, [1, 2, 'x'], None) == key
+    assert unit._get_key_from_func(test, [1], {'c': 'x'}) == key
+    # Defaults which aren't scalars are encoded as they are at call time.
+    default.append(2)
+    assert unit._get_key_from_func(test, [1, 2, 'x'], None) == get_hash(
+            "test.module.test(1, 2, 'x', [1, 2])")
+
+@needs_signature
+def test_positional_keyword_only():
+    def test(*args, **kwargs):
+        pass
+    test.__module__ = 'test.module'
+    Parameter = inspect.Parameter
+    test.__signature__ = inspect.Signature([
+        Parameter('a', Parameter.POSITIONAL_OR_KEYWORD),
+        Parameter('args', Parameter.VAR_POSITIONAL),
+        Parameter('b', Parameter.KEYWORD_ONLY, default=2)])
+
+    unit = get_unit()
+    key = unit._get_key_from_func(test, [1, 3], None)
+    assert key == get_hash('test.module.test(1, 3, b=2)')
+    assert unit._get_key_from_func(test, [1, 3], {'b': 2}) == key
+
+    test.__signature__ = inspect.Signature([
+        Parameter('a', Parameter.POSITIONAL_OR_KEYWORD),
+        Parameter('b', Parameter.KEYWORD_ONLY)])
+    key = get_unit()._get_key_from_func(test, [1], None)
+    assert key == get_hash('test.module.test(1)')
+
+@needs_signature
+def test_unbindable():
+    def test(a):
+        pass
+    test.__module__ = 'test.module'
+
+    key = get_unit()._get_key_from_func(test, [1], {'c': 2})
+    assert key == get_hash('test.module.test(1, c=2)')
+
+def test_no_signature():
+    test = MagicMock(__module__='test.module', __name__='test')
+    test.__signature__ = 'invalid'
+
+    key = get_unit()._get_key_from_func(test, [1], {'c': 2})
+    assert key == get_hash('test.module.test(1, c=2)')
+
+def test_encode_scalars():
+    assert _encode_key_arg('a') == "'a'"
+    assert _encode_key_arg("it's \\") == "'it\\'s \\\\'"
+    assert _encode_key_arg(5) == '5'
+    assert _encode_key_arg(1.5) == '1.5'
+    assert _encode_key_arg(None) == 'None'
+    assert _encode_key_arg(True) == 'True'
+
+def test_encode_containers():
+    assert _encode_key_arg([1, 'a']) == "[1, 'a']"
+    assert _encode_key_arg((1,)) == "(1,)"
+    assert _encode_key_arg((1, (2, 3))) == "(1, (2, 3))"
+    assert _encode_key_arg({'b': 1, 'a': [2]}) == "{'a': [2], 'b': 1}"
+
+def test_encode_sets():
+    assert _encode_key_arg(set(['b', 'c', 'a'])) == "{'a', 'b', 'c'}"
+    assert _encode_key_arg(frozenset([2, 1])) == "frozenset({1, 2})"
+    assert _encode_key_arg(set()) == "set()"
+    assert _encode_key_arg(frozenset()) == "frozenset()"
+
+def test_encode_namedtuple():
+    from collections import namedtuple
+    Point = namedtuple('Point', ['x', 'y'])
+    assert _encode_key_arg(Point(1, 'a')) == "Point(x=1, y='a')"
+
+def test_encode_hook():
+    class Test(object):
+        def __cachual_key__(self):
+            return {'id': 5}
+    assert _encode_key_arg(Test()) == "{'id': 5}"
+    assert _encode_key_arg([Test()]) == "[{'id': 5}]"
+
+def test_encode_function():
+    def test():
+        pass
+    expected = ('test_key.test_encode_function.<locals>.test'
+                if sys.version_info > (3, 3) else 'test_key.test')
+    assert _encode_key_arg(test) == expected
+
+def test_encode_class():
+    class Test(object):
+        pass
+    expected = ('test_key.test_encode_class.<locals>.Test'
+                if sys.version_info > (3, 3) else 'test_key.Test')
+    assert _encode_key_arg(Test) == expected
+
+def test_encode_custom_str():
+    class Custom(object):
+        def __str__(self):
+            return 'custom'
+    Custom.__qualname__ = 'Custom'
+    assert _encode_key_arg(Custom()) == "Custom('custom')"
+    assert _encode_key_arg([Custom()]) == "[Custom('custom')]"
+
+def test_encode_unstable():
+    class Test(object):
+        pass
+    with pytest.raises(UnstableKeyError):
+        _encode_key_arg(Test())
+    with pytest.raises(UnstableKeyError):
+        _encode_key_arg({'a': Test()})
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires dataclasses")
+def test_encode_dataclass():
+    import dataclasses
+    Test = dataclasses.make_dataclass('Test', ['a', 'b'])
+    assert _encode_key_arg(Test(1, set(['y', 'x']))) == \
+            "Test(a=1, b={'x', 'y'})"
+
+def test_set_key_is_order_independent():
+    def test(a):
+        pass
+    test.__module__ = 'test.module'
+
+    unit = get_unit()
+    key = unit._get_key_from_func(test, [set(['a', 'b', 'c'])], None)
+    assert key == unit._get_key_from_func(test, [set(['c', 'a', 'b'])], None)
+    assert key == get_hash("test.module.test({'a', 'b', 'c'})")
+
+def test_unstable_key():
+    def test(a):
+        pass
+    test.__module__ = 'test.module'
+
+    with pytest.raises(UnstableKeyError):
+        get_unit()._get_key_from_func(test, [object()], None)
+
+@pytest.mark.parametrize('first,second', [
+    ((['p, x'], None), (['p', 'x, x'], None)),
+    ((['a, b'], None), (['a', 'b'], None)),
+    (([1], None), (['1'], None)),
+    (([None], None), (['None'], None)),
+    (([b'x'], None), (["b'x'"], None)),
+    (([['a', 'b']], None), (["['a', 'b']"], None)),
+    ((['a'], {'b': 'x, c=y'}), (['a'], {'b': 'x', 'c': 'y'})),
+])
+def test_distinct_arguments_distinct_keys(first, second):
+    def test(a, b='x', *args, **kwargs):
+        pass
+    test.__module__ = 'test.module'
+
+    unit = get_unit()
+    assert (unit._get_key_from_func(test, *first) !=
+            unit._get_key_from_func(test, *second))
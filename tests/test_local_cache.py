@@ -0,0 +1,195 @@
+from cachual import LocalCache
+
+from mock import mock
+
+import pytest, random, threading
+
+def test_get_put():
+    unit = LocalCache()
+    assert unit.get("key") is None
+    unit.put("key", "value")
+    assert unit.get("key") == "value"
+    unit.put("key", "new")
+    assert unit.get("key") == "new"
+    assert len(unit) == 1
+
+@mock.patch('cachual._now')
+def test_ttl(mock_now):
+    mock_now.return_value = 100
+    unit = LocalCache()
+    unit.put("key", "value", 5)
+    unit.put("forever", "value")
+
+    mock_now.return_value = 104
+    assert unit.get("key") == "value"
+    mock_now.return_value = 106
+    assert unit.get("key") is None
+    assert unit.get("forever") == "value"
+    assert len(unit) == 1
+
+@mock.patch('cachual._now')
+def test_add(mock_now):
+    mock_now.return_value = 100
+    unit = LocalCache()
+    assert unit.add("key", "value", 5)
+    assert not unit.add("key", "other", 5)
+    assert unit.get("key") == "value"
+
+    mock_now.return_value = 106
+    assert unit.add("key", "other", 5)
+    assert unit.get("key") == "other"
+
+def test_delete():
+    unit = LocalCache()
+    unit.put("key", "value")
+    unit.delete("key")
+    unit.delete("missing")
+    assert unit.get("key") is None
+    assert len(unit) == 0
+
+def test_delete_if_equal():
+    unit = LocalCache()
+    unit.put("key", "value")
+    assert not unit.delete_if_equal("key", "other")
+    assert unit.get("key") == "value"
+    assert unit.delete_if_equal("key", "value")
+    assert unit.get("key") is None
+    assert not unit.delete_if_equal("key", "value")
+
+def test_get_many_put_many():
+    unit = LocalCache()
+    unit.put_many({"a": 1, "b": 2})
+    assert unit.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+
+def test_lru_eviction():
+    unit = LocalCache(max_entries=2)
+    unit.put("a", "a")
+    unit.put("b", "b")
+    unit.get("a")
+    unit.put("c", "c")
+    assert unit.get("a") == "a"
+    assert unit.get("b") is None
+    assert unit.get("c") == "c"
+
+def test_lfu_eviction():
+    unit = LocalCache(max_entries=2, policy="lfu")
+    unit.put("a", "a")
+    unit.put("b", "b")
+    unit.get("a")
+    unit.get("a")
+    unit.get("b")
+    unit.put("c", "c")
+    unit.put("d", "d")
+    assert unit.get("a") == "a"
+    assert unit.get("b") is None
+    assert unit.get("c") is None
+    assert unit.get("d") == "d"
+
+def test_max_bytes():
+    unit = LocalCache(max_bytes=20)
+    unit.put("a", b"123456789")
+    unit.put("b", b"123456789")
+    assert len(unit) == 2
+    unit.put("c", b"123456789")
+    assert len(unit) == 2
+    assert unit.get("a") is None
+
+    unit.put("big", b"x" * 20)
+    assert unit.get("big") is None
+    assert len(unit) == 2
+
+def test_both_limits():
+    with pytest.raises(ValueError):
+        LocalCache(max_entries=10, max_bytes=10)
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        LocalCache(policy="fifo")
+
+def test_shards():
+    unit = LocalCache(max_entries=1000, shards=8)
+    assert len(unit._shards) == 8
+    assert sum(s.policy.capacity for s in unit._shards) == 1000
+    assert len(LocalCache(max_entries=10, shards=8)._shards) == 1
+
+@pytest.mark.parametrize("policy", ["lru", "lfu", "tinylfu"])
+def test_bounded(policy):
+    unit = LocalCache(max_entries=100, policy=policy)
+    for i in range(1000):
+        unit.put(i, i)
+        unit.get(i % 50)
+    assert len(unit) <= 100
+    for i in range(1000):
+        value = unit.get(i)
+        assert value is None or value == i
+
+def test_tinylfu_resists_scan():
+    unit = LocalCache(max_entries=100, policy="tinylfu")
+    hot = ["hot%d" % i for i in range(50)]
+    for _ in range(20):
+        for key in hot:
+            if unit.get(key) is None:
+                unit.put(key, key)
+    for i in range(1000):
+        unit.get("scan%d" % i)
+        unit.put("scan%d" % i, i)
+    assert sum(unit.get(key) is not None for key in hot) >= 45
+
+def test_lru_flushed_by_scan():
+    unit = LocalCache(max_entries=100)
+    hot = ["hot%d" % i for i in range(50)]
+    for key in hot:
+        unit.put(key, key)
+    for i in range(1000):
+        unit.put("scan%d" % i, i)
+    assert all(unit.get(key) is None for key in hot)
+
+def test_threads():
+    unit = LocalCache(max_entries=1000, policy="tinylfu", shards=4)
+    errors = []
+
+    def run(seed):
+        rand = random.Random(seed)
+        try:
+            for _ in range(2000):
+                key = rand.randint(0, 2000)
+                if unit.get(key) is None:
+                    unit.put(key, key)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(unit) <= 1000
+
+@pytest.mark.parametrize('options', [{}, {'stale_ttl': 5},
+        {'early_recompute': 1.0}, {'tags': ['user:42']},
+        {'cache_none': True}])
+def test_cached_values_keep_their_type(options):
+    unit = LocalCache()
+    calls = []
+
+    @unit.cached(ttl=10, **options)
+    def test(a):
+        calls.append(a)
+        return {'a': a}
+
+    assert test(1) == {'a': 1}
+    assert test(1) == {'a': 1}
+    assert calls == [1]
+
+def test_cached_none_with_metadata():
+    unit = LocalCache()
+    calls = []
+
+    @unit.cached(ttl=10, cache_none=True, stale_ttl=5)
+    def test(a):
+        calls.append(a)
+
+    assert test(1) is None
+    assert test(1) is None
+    assert calls == [1]
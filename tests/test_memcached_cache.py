@@ -1,17 +1,66 @@
-from cachual import MemcachedCache
+from cachual import MemcachedCache, MemcachedClient, _MEMCACHED_EXPIRED
 
 from mock import MagicMock, mock
+from pymemcache.exceptions import MemcacheError
+
+import pytest, threading, time
 
 @mock.patch('cachual.MemcachedClient')
 def test_ctor(mock_memcached):
     host = "host"
     port = 1234
 
-    mock_memcached.return_value = "test"
+    client = MagicMock()
+    mock_memcached.return_value = client
     unit = MemcachedCache(host, port)
 
-    mock_memcached.assert_called_with((host, port))
-    assert unit.client == "test"
+    mock_memcached.assert_called_with((host, port), max_pool_size=16,
+            no_delay=True)
+    assert unit.client is client
+
+def test_pool_exhausted_waits():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def get(key, default=None):
+        with lock:
+            active.append(key)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(key)
+        return b"value"
+
+    def create_client(self):
+        connection = MagicMock()
+        connection.get.side_effect = get
+        return connection
+
+    with mock.patch.object(MemcachedClient, '_create_client', create_client):
+        unit = MemcachedCache(pool_size=2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                unit.get("key"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    assert results == [b"value"] * 8
+    assert max(peak) == 2
+
+@mock.patch('cachual.MemcachedClient')
+def test_ctor_options(mock_memcached):
+    MemcachedCache("host", 1234, pool_size=4, connect_timeout=1, timeout=0.5,
+            no_delay=False, keepalive=True)
+
+    args, kwargs = mock_memcached.call_args
+    assert args == (("host", 1234),)
+    keepalive = kwargs.pop('socket_keepalive')
+    assert kwargs == {'max_pool_size': 4, 'connect_timeout': 1,
+            'timeout': 0.5, 'no_delay': False}
+    assert keepalive.idle > 0
 
 @mock.patch('cachual.MemcachedClient')
 def test_get(mock_memcached):
@@ -48,3 +97,175 @@ def test_put_no_ttl(mock_memcached):
     unit = MemcachedCache()
     unit.put(key, value)
     client.set.assert_called_with(key, value, expire=0)
+
+@mock.patch('cachual.MemcachedClient')
+def test_add(mock_memcached):
+    client = MagicMock()
+    client.add = MagicMock(return_value=True)
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    assert unit.add("test", "value", 1.5) == True
+    client.add.assert_called_with("test", "value", expire=2, noreply=False)
+
+@mock.patch('cachual.MemcachedClient')
+def test_add_no_ttl(mock_memcached):
+    client = MagicMock()
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    unit.add("test", "value")
+    client.add.assert_called_with("test", "value", expire=0, noreply=False)
+
+@mock.patch('cachual.MemcachedClient')
+def test_delete(mock_memcached):
+    client = MagicMock()
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    unit.delete("test")
+    client.delete.assert_called_with("test", noreply=False)
+
+@mock.patch('cachual.MemcachedClient')
+def test_delete_if_equal(mock_memcached):
+    client = MagicMock()
+    client.gets = MagicMock(return_value=(b"value", b"7"))
+    client.cas = MagicMock(return_value=True)
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    assert unit.delete_if_equal("test", "value") == True
+    client.cas.assert_called_with("test", b"", b"7",
+            expire=_MEMCACHED_EXPIRED, noreply=False)
+
+@mock.patch('cachual.MemcachedClient')
+def test_delete_if_equal_different(mock_memcached):
+    client = MagicMock()
+    client.gets = MagicMock(return_value=(b"other", b"7"))
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    assert unit.delete_if_equal("test", "value") == False
+    assert client.cas.call_count == 0
+
+@mock.patch('cachual.MemcachedClient')
+def test_get_many(mock_memcached):
+    client = MagicMock()
+    client.get_many = MagicMock(return_value={"a": b"1"})
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    assert unit.get_many(["a", "b"]) == {"a": b"1"}
+    client.get_many.assert_called_with(["a", "b"])
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_many(mock_memcached):
+    client = MagicMock()
+    mock_memcached.return_value = client
+
+    unit = MemcachedCache()
+    unit.put_many({"a": "1"})
+    client.set_many.assert_called_with({"a": "1"}, expire=0)
+
+class FakeClient(object):
+    """A dictionary-backed stand-in for the Memcached client."""
+    def __init__(self):
+        self.client_pool = None
+        self.values = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append("get")
+        return self.values.get(key)
+
+    def get_many(self, keys):
+        self.calls.append("get_many")
+        return dict((k, self.values[k]) for k in keys if k in self.values)
+
+    def set(self, key, value, expire=0):
+        self.calls.append("set")
+        self.values[key] = value
+
+    def set_many(self, values, expire=0, noreply=True):
+        self.calls.append("set_many")
+        self.values.update(values)
+        return []
+
+    def add(self, key, value, expire=0, noreply=True):
+        self.calls.append("add")
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+def get_chunking_unit(mock_memcached):
+    client = FakeClient()
+    mock_memcached.return_value = client
+    return MemcachedCache(max_item_size=10), client
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_chunked(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    value = b"0123456789" * 3 + b"x"
+
+    unit.put("key", value, 5)
+    assert client.calls == ["set_many"]
+    assert len(client.values) == 5
+    assert client.values["key"][:1] == b"\xfc"
+
+    del client.calls[:]
+    assert unit.get("key") == value
+    assert client.calls == ["get", "get_many"]
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_small_not_chunked(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    unit.put("key", b"0123456789")
+    assert client.values == {"key": b"0123456789"}
+    assert unit.get("key") == b"0123456789"
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_chunked_text(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    unit.put("key", u"\u00e9" * 10)
+    assert unit.get("key") == (u"\u00e9" * 10).encode("utf-8")
+
+@mock.patch('cachual.MemcachedClient')
+def test_torn_chunks_miss(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    unit.put("key", b"0123456789" * 3)
+    chunk_key = sorted(k for k in client.values if k != "key")[1]
+
+    client.values[chunk_key] = b"9876543210"
+    assert unit.get("key") is None
+    del client.values[chunk_key]
+    assert unit.get("key") is None
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_many_chunked(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    values = {"a": b"a" * 25, "b": b"b", "c": b"c" * 11}
+
+    unit.put_many(values)
+    assert client.calls == ["set_many"]
+    del client.calls[:]
+    assert unit.get_many(["a", "b", "c", "d"]) == values
+    assert client.calls == ["get_many", "get_many"]
+
+@mock.patch('cachual.MemcachedClient')
+def test_put_chunked_failure(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    client.set_many = MagicMock(return_value=["key"])
+    client.delete_many = MagicMock()
+
+    with pytest.raises(MemcacheError):
+        unit.put("key", b"0123456789" * 3)
+    client.delete_many.assert_called_with(["key"])
+
+@mock.patch('cachual.MemcachedClient')
+def test_add_chunked(mock_memcached):
+    unit, client = get_chunking_unit(mock_memcached)
+    assert unit.add("key", b"0123456789" * 3)
+    assert client.calls == ["set_many", "add"]
+    assert not unit.add("key", b"9876543210" * 3)
+    assert unit.get("key") == b"0123456789" * 3
@@ -1,4 +1,4 @@
-from cachual import RedisCache
+from cachual import RedisCache, _REDIS_DELETE_IF_EQUAL
 
 from mock import MagicMock, mock
 
@@ -14,6 +14,19 @@ def test_ctor(mock_redis):
     mock_redis.assert_called_with(host=host, port=port, db=db)
     assert unit.client == "test"
 
+@mock.patch('cachual.StrictRedis')
+def test_ctor_connection_pool(mock_redis):
+    pool = MagicMock()
+    RedisCache(connection_pool=pool, socket_timeout=1)
+    mock_redis.assert_called_with(connection_pool=pool)
+
+@mock.patch('cachual.StrictRedis')
+def test_ctor_unix_socket(mock_redis):
+    RedisCache(unix_socket_path="/tmp/redis.sock", db=2, max_connections=8,
+            socket_timeout=1, socket_connect_timeout=0.5)
+    mock_redis.assert_called_with(unix_socket_path="/tmp/redis.sock", db=2,
+            max_connections=8, socket_timeout=1, socket_connect_timeout=0.5)
+
 @mock.patch('cachual.StrictRedis')
 def test_get(mock_redis):
     client = MagicMock()
@@ -49,3 +62,76 @@ def test_put_no_ttl(mock_redis):
     unit = RedisCache()
     unit.put(key, value)
     client.set.assert_called_with(key, value, ex=None)
+
+@mock.patch('cachual.StrictRedis')
+def test_add(mock_redis):
+    client = MagicMock()
+    client.set = MagicMock(return_value=True)
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    assert unit.add("test", "value", 1.5) == True
+    client.set.assert_called_with("test", "value", px=1500, nx=True)
+
+@mock.patch('cachual.StrictRedis')
+def test_add_exists(mock_redis):
+    client = MagicMock()
+    client.set = MagicMock(return_value=None)
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    assert unit.add("test", "value") == False
+    client.set.assert_called_with("test", "value", px=None, nx=True)
+
+@mock.patch('cachual.StrictRedis')
+def test_delete(mock_redis):
+    client = MagicMock()
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    unit.delete("test")
+    client.delete.assert_called_with("test")
+
+@mock.patch('cachual.StrictRedis')
+def test_delete_if_equal(mock_redis):
+    client = MagicMock()
+    client.eval = MagicMock(return_value=1)
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    assert unit.delete_if_equal("test", "value") == True
+    client.eval.assert_called_with(_REDIS_DELETE_IF_EQUAL, 1, "test", "value")
+
+    client.eval.return_value = 0
+    assert unit.delete_if_equal("test", "value") == False
+
+@mock.patch('cachual.StrictRedis')
+def test_get_many(mock_redis):
+    client = MagicMock()
+    client.mget = MagicMock(return_value=[b"1", None, b"3"])
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    assert unit.get_many(["a", "b", "c"]) == {"a": b"1", "c": b"3"}
+    client.mget.assert_called_with(["a", "b", "c"])
+
+@mock.patch('cachual.StrictRedis')
+def test_get_many_empty(mock_redis):
+    client = MagicMock()
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    assert unit.get_many([]) == {}
+    assert client.mget.call_count == 0
+
+@mock.patch('cachual.StrictRedis')
+def test_put_many(mock_redis):
+    client = MagicMock()
+    pipeline = client.pipeline.return_value
+    mock_redis.return_value = client
+
+    unit = RedisCache()
+    unit.put_many({"a": "1"}, 5)
+    client.pipeline.assert_called_with(transaction=False)
+    pipeline.set.assert_called_with("a", "1", ex=5)
+    pipeline.execute.assert_called_with()
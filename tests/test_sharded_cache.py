@@ -0,0 +1,125 @@
+from cachual import CachualCache, ShardedCache
+
+from mock import MagicMock, mock
+
+import pytest
+
+class DictCache(CachualCache):
+    def __init__(self):
+        super(DictCache, self).__init__()
+        self.data = {}
+        self.get_many_calls = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value, ttl=None):
+        self.data[key] = value
+
+    def get_many(self, keys):
+        self.get_many_calls.append(keys)
+        return super(DictCache, self).get_many(keys)
+
+def get_unit(n=4, **kwargs):
+    return ShardedCache(dict(("node%d" % i, DictCache()) for i in range(n)),
+            **kwargs)
+
+KEYS = ["key%d" % i for i in range(2000)]
+
+def test_requires_nodes():
+    with pytest.raises(ValueError):
+        ShardedCache({})
+
+def test_routing_is_stable():
+    unit = get_unit()
+    other = get_unit()
+    assert ([unit.node_for(k) for k in KEYS] ==
+            [other.node_for(k) for k in KEYS])
+
+def test_keys_spread_over_nodes():
+    unit = get_unit()
+    counts = {}
+    for key in KEYS:
+        name = unit.node_for(key)
+        counts[name] = counts.get(name, 0) + 1
+    assert len(counts) == 4
+    assert min(counts.values()) > len(KEYS) / 8
+
+def test_removing_node_moves_only_its_keys():
+    unit = get_unit(5)
+    smaller = ShardedCache(dict((name, node) for name, node in
+            unit.nodes.items() if name != "node4"))
+    moved = [k for k in KEYS if unit.node_for(k) != smaller.node_for(k)]
+    assert all(unit.node_for(k) == "node4" for k in moved)
+    assert len(moved) < len(KEYS) / 3
+
+def test_get_put():
+    unit = get_unit()
+    unit.put("a", "value")
+    assert unit.get("a") == "value"
+    assert unit.nodes[unit.node_for("a")].data == {"a": "value"}
+
+def test_add_delete():
+    unit = get_unit()
+    node = unit.nodes[unit.node_for("a")]
+    node.add = MagicMock(return_value=True)
+    node.delete = MagicMock()
+
+    assert unit.add("a", "1", 5)
+    node.add.assert_called_with("a", "1", 5)
+    unit.delete("a")
+    node.delete.assert_called_with("a")
+
+def test_many_split_per_node():
+    unit = get_unit()
+    values = dict((k, k.upper()) for k in KEYS[:50])
+    unit.put_many(values)
+    for name, node in unit.nodes.items():
+        assert node.data == dict((k, v) for k, v in values.items()
+                                 if unit.node_for(k) == name)
+
+    assert unit.get_many(KEYS[:60]) == values
+    for node in unit.nodes.values():
+        assert len(node.get_many_calls) == 1
+
+def test_failed_node_ejected():
+    unit = get_unit(retry_delay=30)
+    name = unit.node_for("a")
+    unit.nodes[name].get = MagicMock(side_effect=Exception("down"))
+
+    with pytest.raises(Exception):
+        unit.get("a")
+    assert unit.node_for("a") != name
+    assert unit.get("a") is None
+
+@mock.patch("cachual._now")
+def test_failed_node_retried(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit(retry_delay=30)
+    name = unit.node_for("a")
+    unit.nodes[name].put = MagicMock(side_effect=Exception("down"))
+
+    with pytest.raises(Exception):
+        unit.put("a", "value")
+    mock_now.return_value = 129
+    assert unit.node_for("a") != name
+    mock_now.return_value = 130
+    assert unit.node_for("a") == name
+
+def test_all_nodes_ejected():
+    unit = get_unit(1)
+    unit.nodes["node0"].get = MagicMock(side_effect=Exception("down"))
+    with pytest.raises(Exception):
+        unit.get("a")
+    assert unit.node_for("a") == "node0"
+
+def test_get_many_failed_node():
+    unit = get_unit()
+    unit.put_many(dict((k, k) for k in KEYS[:50]))
+    failed = unit.node_for(KEYS[0])
+    owners = dict((k, unit.node_for(k)) for k in KEYS[:50])
+    unit.nodes[failed].get_many = MagicMock(side_effect=Exception("down"))
+
+    assert unit.get_many(KEYS[:50]) == dict((k, k) for k in KEYS[:50]
+                                            if owners[k] != failed)
+    assert unit.node_for(KEYS[0]) != failed
@@ -0,0 +1,104 @@
+from cachual import SharedMemoryCache
+
+import multiprocessing, pytest, threading, time
+
+def get_unit(tmpdir, **kwargs):
+    return SharedMemoryCache(str(tmpdir.join("cache")), **kwargs)
+
+def test_get_put(tmpdir):
+    unit = get_unit(tmpdir)
+    assert unit.get("key") is None
+    unit.put("key", b"value")
+    unit.put("text", u"\u00e9t\u00e9")
+    unit.put("number", 42)
+    assert unit.get("key") == b"value"
+    assert unit.get("text") == u"\u00e9t\u00e9"
+    assert unit.get("number") == u"42"
+    unit.put("key", b"new")
+    assert unit.get("key") == b"new"
+
+def test_ttl(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("key", b"value", 0.05)
+    unit.put("forever", b"value")
+    assert unit.get("key") == b"value"
+    time.sleep(0.1)
+    assert unit.get("key") is None
+    assert unit.get("forever") == b"value"
+
+def test_add_delete(tmpdir):
+    unit = get_unit(tmpdir)
+    assert unit.add("key", b"value")
+    assert not unit.add("key", b"other")
+    assert unit.get("key") == b"value"
+    unit.delete("key")
+    assert unit.get("key") is None
+    assert unit.add("key", b"other")
+
+def test_delete_if_equal(tmpdir):
+    unit = get_unit(tmpdir)
+    unit.put("key", b"value")
+    assert not unit.delete_if_equal("key", b"other")
+    assert unit.delete_if_equal("key", b"value")
+    assert unit.get("key") is None
+
+def test_too_large(tmpdir):
+    unit = get_unit(tmpdir, slot_size=64)
+    unit.put("key", b"small")
+    unit.put("key", b"x" * 64)
+    assert unit.get("key") is None
+
+def test_bucket_eviction(tmpdir):
+    unit = get_unit(tmpdir, buckets=1, ways=2)
+    unit.put("a", b"a")
+    unit.put("b", b"b")
+    unit.get("a")
+    unit.put("c", b"c")
+    assert unit.get("a") == b"a"
+    assert unit.get("b") is None
+    assert unit.get("c") == b"c"
+
+def test_shared_between_instances(tmpdir):
+    unit = get_unit(tmpdir)
+    other = get_unit(tmpdir)
+    unit.put("key", b"value")
+    assert other.get("key") == b"value"
+    other.close()
+
+def test_layout_mismatch(tmpdir):
+    get_unit(tmpdir)
+    with pytest.raises(ValueError):
+        get_unit(tmpdir, buckets=16)
+
+def _put_in_child(path):
+    SharedMemoryCache(path).put("key", b"from child")
+
+def test_shared_between_processes(tmpdir):
+    unit = get_unit(tmpdir)
+    process = multiprocessing.get_context("fork").Process(
+            target=_put_in_child, args=(unit.path,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert unit.get("key") == b"from child"
+
+def test_threads(tmpdir):
+    unit = get_unit(tmpdir, buckets=4)
+    errors = []
+
+    def run(i):
+        try:
+            for j in range(200):
+                key = "key%d" % (j % 10)
+                unit.put(key, key)
+                value = unit.get(key)
+                assert value is None or value == key
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
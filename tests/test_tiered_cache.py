@@ -0,0 +1,77 @@
+from cachual import TieredCache
+
+from mock import MagicMock, mock
+
+def get_unit(max_entries=2, local_ttl=5):
+    remote = MagicMock()
+    remote.get = MagicMock(return_value=None)
+    remote.put = MagicMock()
+    remote.get_many = MagicMock(return_value={})
+    remote.put_many = MagicMock()
+    return TieredCache(remote, max_entries=max_entries, local_ttl=local_ttl)
+
+def test_get_miss():
+    unit = get_unit()
+    assert unit.get("key") is None
+    unit.remote.get.assert_called_with("key")
+    assert len(unit.local) == 0
+
+def test_get_remote_hit_populates_local():
+    unit = get_unit()
+    unit.remote.get.return_value = b"value"
+
+    assert unit.get("key") == b"value"
+    assert unit.get("key") == b"value"
+    assert unit.remote.get.call_count == 1
+
+def test_put():
+    unit = get_unit()
+    unit.remote.get.return_value = b"old"
+    unit.get("key")
+
+    unit.put("key", "new", 10)
+    unit.remote.put.assert_called_with("key", "new", 10)
+    assert len(unit.local) == 0
+
+def test_local_eviction():
+    unit = get_unit(max_entries=2)
+    unit.remote.get.side_effect = lambda key: key
+    unit.get("a")
+    unit.get("b")
+    unit.get("a")
+    unit.get("c")
+
+    assert len(unit.local) == 2
+    assert unit.local.get("a") == "a"
+    assert unit.local.get("b") is None
+
+@mock.patch('cachual._now')
+def test_local_expiry(mock_now):
+    mock_now.return_value = 100
+    unit = get_unit(local_ttl=5)
+    unit.remote.get.return_value = b"value"
+    unit.get("key")
+
+    mock_now.return_value = 106
+    assert unit.local.get("key") is None
+    unit.get("key")
+    assert unit.remote.get.call_count == 2
+
+def test_get_many():
+    unit = get_unit(max_entries=10)
+    unit.remote.get.return_value = b"a"
+    unit.get("a")
+    unit.remote.get_many.return_value = {"b": b"b"}
+
+    assert unit.get_many(["a", "b", "c"]) == {"a": b"a", "b": b"b"}
+    unit.remote.get_many.assert_called_with(["b", "c"])
+    assert unit.local.get("b") == b"b"
+
+def test_put_many():
+    unit = get_unit()
+    unit.remote.get.return_value = b"old"
+    unit.get("a")
+
+    unit.put_many({"a": "new"}, 10)
+    unit.remote.put_many.assert_called_with({"a": "new"}, 10)
+    assert len(unit.local) == 0
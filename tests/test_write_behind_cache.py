@@ -0,0 +1,230 @@
+from cachual import (LocalCache, WriteBehindCache, pack_json,
+                     unpack_json_python3)
+
+from mock import MagicMock, mock
+
+import gc, multiprocessing, pytest, threading, time, weakref
+
+def get_unit(**kwargs):
+    backend = MagicMock()
+    backend.get = MagicMock(return_value=None)
+    backend.get_many = MagicMock(return_value={})
+    return WriteBehindCache(backend, **kwargs)
+
+def blocked_unit(**kwargs):
+    """Returns a unit whose first put_many blocks until the returned event is
+    set."""
+    unit = get_unit(**kwargs)
+    release = threading.Event()
+    started = threading.Event()
+    def put_many(values, ttl):
+        started.set()
+        release.wait(5)
+    unit.backend.put_many.side_effect = put_many
+    return unit, started, release
+
+def test_put_written_in_background():
+    unit = get_unit()
+    unit.put("a", "1", 10)
+    unit.put_many({"b": "2", "c": "3"}, 10)
+    assert unit.flush(5)
+
+    written = {}
+    for args, _ in unit.backend.put_many.call_args_list:
+        assert args[1] == 10
+        written.update(args[0])
+    assert written == {"a": "1", "b": "2", "c": "3"}
+
+def test_grouped_by_ttl():
+    unit, started, release = blocked_unit()
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put("a", "1", 10)
+    unit.put("b", "2", 20)
+    release.set()
+    assert unit.flush(5)
+    unit.backend.put_many.assert_any_call({"a": "1"}, 10)
+    unit.backend.put_many.assert_any_call({"b": "2"}, 20)
+
+def test_read_your_writes():
+    unit, started, release = blocked_unit()
+    unit.put("a", "1")
+    started.wait(5)
+    unit.put("b", "2")
+
+    assert unit.get("a") == "1"
+    assert unit.get("b") == "2"
+    assert unit.get_many(["a", "b", "c"]) == {"a": "1", "b": "2"}
+    unit.backend.get_many.assert_called_with(["c"])
+    assert unit.backend.get.call_count == 0
+    assert not unit.add("a", "x")
+
+    release.set()
+    assert unit.flush(5)
+    assert unit.get("a") is None
+    unit.backend.get.assert_called_with("a")
+
+def test_drop_newest():
+    unit, started, release = blocked_unit(max_queue=2)
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put_many({"a": "1", "b": "2"})
+    unit.put("c", "3")
+    unit.put("a", "4")
+    assert unit.get("c") is None
+    assert unit.get("a") == "4"
+    release.set()
+
+def test_drop_oldest():
+    unit, started, release = blocked_unit(max_queue=2, drop_policy="oldest")
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put("a", "1")
+    unit.put("b", "2")
+    unit.put("c", "3")
+    assert unit.get("a") is None
+    assert unit.get("c") == "3"
+    release.set()
+
+def test_block():
+    unit, started, release = blocked_unit(max_queue=1, drop_policy="block")
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put("a", "1")
+
+    done = threading.Event()
+    def put():
+        unit.put("b", "2")
+        done.set()
+    threading.Thread(target=put).start()
+    assert not done.wait(0.1)
+    release.set()
+    assert done.wait(5)
+    assert unit.flush(5)
+
+def test_block_before_writer_started():
+    unit = WriteBehindCache(LocalCache(), max_queue=2, drop_policy='block')
+    thread = threading.Thread(target=unit.put_many,
+            args=({"a": 1, "b": 2, "c": 3},))
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert unit.flush(5)
+    assert unit.backend.get_many(["a", "b", "c"]) == {"a": 1, "b": 2, "c": 3}
+
+def test_unknown_drop_policy():
+    with pytest.raises(ValueError):
+        get_unit(drop_policy="random")
+
+def test_flush_timeout():
+    unit, started, release = blocked_unit()
+    unit.put("a", "1")
+    assert not unit.flush(0.05)
+    release.set()
+    assert unit.flush(5)
+
+def test_write_error_logged():
+    unit = get_unit()
+    unit.backend.put_many.side_effect = Exception("down")
+    unit.put("a", "1")
+    assert unit.flush(5)
+    unit.put("b", "2")
+    assert unit.flush(5)
+    assert unit.backend.put_many.call_count == 2
+
+def test_delete_waits_for_write():
+    unit, started, release = blocked_unit()
+    calls = []
+    unit.backend.delete.side_effect = lambda key: calls.append("delete")
+    unit.put("a", "1")
+    started.wait(5)
+    threading.Timer(0.05, lambda: (calls.append("written"),
+                                    release.set())).start()
+    unit.delete("a")
+    assert calls == ["written", "delete"]
+
+def test_delete_queued():
+    unit, started, release = blocked_unit()
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put("a", "1")
+    unit.delete("a")
+    assert unit.get("a") is None
+    unit.backend.delete.assert_called_with("a")
+    release.set()
+    assert unit.flush(5)
+    assert unit.backend.put_many.call_count == 1
+
+def test_delete_if_equal_queued():
+    unit, started, release = blocked_unit()
+    unit.put("first", "0")
+    started.wait(5)
+    unit.put("a", "1")
+    assert not unit.delete_if_equal("a", "2")
+    assert unit.delete_if_equal("a", "1")
+    assert unit.get("a") is None
+    assert unit.backend.delete_if_equal.call_count == 0
+    release.set()
+    assert unit.flush(5)
+
+def test_queued_values_returned_as_backend_would():
+    store = {}
+    unit = get_unit()
+    unit.backend.returns_text = False
+    unit.backend.get.side_effect = store.get
+    def put_many(values, ttl):
+        store.update((k, v.encode('utf-8')) for k, v in values.items())
+    unit.backend.put_many.side_effect = put_many
+    calls = []
+
+    @unit.cached(pack=pack_json, unpack=unpack_json_python3)
+    def as_json():
+        calls.append(1)
+        return "v"
+
+    @unit.cached()
+    def as_is():
+        calls.append(1)
+        return "v"
+
+    as_json()
+    as_is()
+    queued = (as_json(), as_is())
+    assert unit.flush(5)
+    flushed = (as_json(), as_is())
+
+    assert queued == flushed == ("v", b"v")
+    assert [type(value) for value in queued] == [str, bytes]
+    assert [type(value) for value in flushed] == [str, bytes]
+    assert len(calls) == 2
+
+@mock.patch('cachual._WRITE_BEHIND_IDLE', 0.01)
+def test_discarded_cache_collected():
+    unit = get_unit()
+    unit.put("a", "1")
+    assert unit.flush(5)
+    thread = unit._thread
+    ref = weakref.ref(unit)
+    del unit
+    for _ in range(100):
+        gc.collect()
+        if ref() is None:
+            break
+        time.sleep(0.01)
+    assert ref() is None
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_forked_child_restarts_writer():
+    unit = WriteBehindCache(LocalCache())
+    unit.put("parent", b"value")
+    assert unit.flush(5)
+
+    def child():
+        unit.put("child", b"value")
+        if not unit.flush(2) or unit.backend.get("child") != b"value":
+            raise SystemExit(1)
+    process = multiprocessing.get_context("fork").Process(target=child)
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0